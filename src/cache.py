@@ -0,0 +1,229 @@
+import hashlib
+import inspect
+import json
+import logging
+import os
+import pickle
+import time
+from contextlib import nullcontext
+
+# 不参与指纹计算的worker字段（运行时生成或只影响显示/保存）
+FINGERPRINT_EXCLUDE_KEYS = {'source', 'data', 'results', 'processor', 'name', 'fingerprint', 'keep',
+                            'show_log', 'save_result', 'cache', 'shard_workers', 'read_workers', 'timeout'}
+
+# 不参与指纹计算的args字段（只影响并行度）
+FINGERPRINT_EXCLUDE_ARGS = {'workers'}
+
+# 参数中的文件路径，文件改动后指纹随之改变
+FINGERPRINT_FILE_ARGS = ('file_path', 'lengths_path')
+
+# 类型前缀: 影响结果的环境变量，worker参数中的同名设置已包含在参数中
+FINGERPRINT_ENVIRON = {
+    'llm': ('LLM_API_BASE', 'LLM_API_KEY'),
+}
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CODE_HASHES = {}
+
+
+def set_cache_root(save_root: str) -> None:
+    # 环境变量中的SAVE_ROOT会被转为小写，由LingData按参数文件中的SAVE_ROOT设置，分片子进程继承环境变量
+    os.environ['CACHE_ROOT'] = os.path.join(save_root, '.cache')
+
+
+def cache_dir() -> str:
+    cache_root = os.getenv('CACHE_ROOT')
+    if cache_root:
+        return cache_root
+    return os.path.join(os.getenv('SAVE_ROOT', default='data/saves'), '.cache')
+
+
+def source_hash(path) -> str:
+    if path not in CODE_HASHES:
+        with open(path, 'rb') as f:
+            CODE_HASHES[path] = hashlib.sha256(f.read()).hexdigest()
+    return CODE_HASHES[path]
+
+
+def package_version() -> str:
+    """
+    src下全部源文件的哈希，处理器调用的其他模块改动后缓存同样失效
+    """
+    if PACKAGE_DIR not in CODE_HASHES:
+        sha256 = hashlib.sha256()
+        for root, dirs, files in os.walk(PACKAGE_DIR):
+            dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+            for file in sorted(files):
+                if file.endswith('.py'):
+                    path = os.path.join(root, file)
+                    sha256.update(os.path.relpath(path, PACKAGE_DIR).encode('utf-8'))
+                    sha256.update(source_hash(path).encode('utf-8'))
+        CODE_HASHES[PACKAGE_DIR] = sha256.hexdigest()
+    return CODE_HASHES[PACKAGE_DIR]
+
+
+def code_version(processor) -> str:
+    """
+    代码版本：src包的哈希，处理器定义在包外时再加上其源文件的哈希，源码改动后缓存自动失效
+    """
+    try:
+        source_file = inspect.getsourcefile(processor)
+    except TypeError:
+        source_file = None
+    if source_file is None:
+        return f"{package_version()}:{getattr(processor, '__qualname__', repr(processor))}"
+    source_file = os.path.abspath(source_file)
+    if os.path.commonpath([source_file, PACKAGE_DIR]) == PACKAGE_DIR:
+        return package_version()
+    return f"{package_version()}:{source_hash(source_file)}"
+
+
+def file_signatures(file_path) -> list:
+    """
+    输入文件的(路径, 大小, 修改时间)，用于读取类worker的指纹
+    """
+    if type(file_path) is str:
+        file_path = [file_path]
+    signatures = []
+    for path in file_path:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for file in sorted(files):
+                    full_path = os.path.join(root, file)
+                    stat = os.stat(full_path)
+                    signatures.append([full_path, stat.st_size, stat.st_mtime_ns])
+        elif os.path.isfile(path):
+            stat = os.stat(path)
+            signatures.append([path, stat.st_size, stat.st_mtime_ns])
+    return signatures
+
+
+def fingerprint(worker_config: dict, source_fingerprints: list, processor, version: str, files: bool = True) -> str:
+    """
+    计算worker结果的指纹
+    :param worker_config: worker的参数（类型、args等）
+    :param source_fingerprints: 每个source的[指纹, 起始位置, 结束位置]
+    :param processor: 处理器函数
+    :param version: LingData版本
+    :param files: 是否包含输入文件（file_path）的签名，按文档计算指纹时每个文档单独计入
+    :return: 指纹字符串
+    """
+    config = {key: value for key, value in worker_config.items() if key not in FINGERPRINT_EXCLUDE_KEYS}
+    args = worker_config.get('args')
+    if isinstance(args, dict):
+        config['args'] = {key: value for key, value in args.items() if key not in FINGERPRINT_EXCLUDE_ARGS}
+        for key in FINGERPRINT_FILE_ARGS:
+            if args.get(key) is not None and (files or key != 'file_path'):
+                config['file_signatures' if key == 'file_path' else f"{key}_signatures"] = file_signatures(args[key])
+    payload = {
+        'config': config,
+        'sources': source_fingerprints,
+        'code': code_version(processor),
+        'version': version,
+    }
+    environ_keys = FINGERPRINT_ENVIRON.get(str(worker_config.get('type', '')).split('_')[0], ())
+    if environ_keys:
+        payload['environ'] = {key: os.getenv(key) for key in environ_keys}
+    encoded = json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def cache_path(key: str) -> str:
+    return os.path.join(cache_dir(), key[:2], f"{key}.pkl")
+
+
+def load_cache(key: str) -> tuple:
+    """
+    读取缓存
+    :return: (是否命中, 结果)
+    """
+    path = cache_path(key)
+    if not os.path.exists(path):
+        return False, None
+    try:
+        results = read_pickle(path)
+        os.utime(path)  # 修改时间记录最近一次使用，clear_cache按此清理长期未使用的缓存
+        return True, results
+    except Exception as e:
+        logging.warning(f"读取缓存{path}错误：" + str(e))
+        return False, None
+
+
+def save_cache(key: str, results, externalize: bool = True) -> None:
+    write_pickle(cache_path(key), results, externalize)
+
+
+def write_pickle(path: str, obj, externalize: bool = True) -> None:
+    """
+    片段的原文已登记（见LingData.share_results）时只保存原文的键，读取时重新指向登记的原文
+    :param externalize: 为False时保存原文，用于之后的运行中原文可能没有登记的缓存（如按文档的缓存）
+    """
+    from src.tools import externalized_texts
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as f, (externalized_texts() if externalize else nullcontext()):
+        pickle.dump(obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def read_pickle(path: str):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def contains_exception(results) -> bool:
+    """
+    结果中含有异常（如llm请求失败）时不写入缓存，下次运行会重试
+    """
+    stack = [results]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, Exception):
+            return True
+        if isinstance(item, (list, tuple)):
+            stack.extend(item)
+    return False
+
+
+def clear_cache(cache_root: str = None, max_age_days: float = None) -> tuple:
+    """
+    清理缓存目录（结果缓存与章节索引），缓存不会自动删除
+    增量运行按文档的缓存被清理后，下一次运行会报错并在之后的运行中读取全部文件
+    :param cache_root: 缓存目录，默认为当前的cache_dir()
+    :param max_age_days: 只删除超过这么多天未使用的缓存，None为全部删除
+    :return: (删除的文件数, 释放的字节数)
+    """
+    cache_root = cache_root or cache_dir()
+    cutoff = None if max_age_days is None else time.time() - max_age_days * 86400
+    removed, freed = 0, 0
+    for root, dirs, files in os.walk(cache_root, topdown=False):
+        for file in files:
+            path = os.path.join(root, file)
+            stat = os.stat(path)
+            if cutoff is not None and stat.st_mtime >= cutoff:
+                continue
+            os.remove(path)
+            removed += 1
+            freed += stat.st_size
+        if root != cache_root and not os.listdir(root):
+            os.rmdir(root)
+    logging.info(f"已清理缓存{cache_root}：删除{removed}个文件，释放{freed / 1024 / 1024:.1f} MB")
+    return removed, freed
+
+
+if __name__ == '__main__':
+    # python -m src.cache clear [缓存目录] [--days 天数]
+    import argparse
+
+    parser = argparse.ArgumentParser(prog="python -m src.cache")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    clear_parser = subparsers.add_parser('clear', help="清理缓存目录")
+    clear_parser.add_argument('cache_root', nargs='?', default=None, help="缓存目录，默认为SAVE_ROOT/.cache")
+    clear_parser.add_argument('--days', type=float, default=None, help="只删除超过这么多天未使用的缓存")
+    arguments = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    count, size = clear_cache(arguments.cache_root, arguments.days)
+    print(f"删除{count}个文件，释放{size / 1024 / 1024:.1f} MB")
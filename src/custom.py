@@ -8,3 +8,11 @@ CUSTOM_PROCESSOR_DICT = {}
 
 def get_custom_processor(processor_name: str):
     return CUSTOM_PROCESSOR_DICT[processor_name]
+
+
+# 流式模式下的自定义处理器在CUSTOM_STREAM_PROCESSOR_DICT中注册，未注册的处理器在流式模式下按批处理方式运行。
+CUSTOM_STREAM_PROCESSOR_DICT = {}
+
+
+def get_custom_stream_processor(processor_name: str):
+    return CUSTOM_STREAM_PROCESSOR_DICT[processor_name]
@@ -1,6 +1,11 @@
 import json
+import textwrap
+from itertools import zip_longest
 
-from src.tools import show_log_base
+from src.tools import show_log_base, ResultView, SpanArray
+
+# 按列表比较结构的类型
+LIST_TYPES = (list, ResultView, SpanArray)
 
 
 def clean_error(results):
@@ -153,13 +158,13 @@ def compare_list_structures(lst1, lst2):
     # 遍历列表中的每个元素
     for elem1, elem2 in zip(lst1, lst2):
         # 如果两个元素都是列表，递归比较它们的结构
-        if isinstance(elem1, list) and isinstance(elem2, list):
+        if isinstance(elem1, LIST_TYPES) and isinstance(elem2, LIST_TYPES):
             if not compare_list_structures(elem1, elem2):
                 print("不匹配的元素：")
                 print(elem1, elem2)
                 return False
         # 如果一个是列表而另一个不是，结构不同
-        elif isinstance(elem1, list) or isinstance(elem2, list):
+        elif isinstance(elem1, LIST_TYPES) or isinstance(elem2, LIST_TYPES):
             print("不匹配的列表：")
             print(elem1, elem2)
             return False
@@ -237,8 +242,100 @@ def dataset_sharegpt(worker_dict):
     return results
 
 
+def iter_save_dataset(converted_data, output_path):
+    """
+    逐条写入json文件，文件格式与save_dataset相同，同时原样产出每条数据
+    """
+    if not output_path.endswith('.json'):
+        output_path += '.json'
+    with open(output_path, 'w', encoding='utf-8') as f:
+        first = True
+        for entry in converted_data:
+            f.write('[\n' if first else ',\n')
+            f.write(textwrap.indent(json.dumps(entry, ensure_ascii=False, indent=2), '  '))
+            first = False
+            yield entry
+        f.write('[]' if first else '\n]')
+
+
+def dataset_sharegpt_stream(worker_dict):
+    source_list = worker_dict.get('source')
+    if source_list is None:
+        raise ValueError("No source provided for dataset_sharegpt")
+    source_data = worker_dict.get('data')
+    if source_data is None:
+        raise ValueError("No data provided for dataset_sharegpt")
+
+    conversations = worker_dict['args']['conversations']
+
+    human_conversations = conversations[0::2]
+    gpt_conversations = conversations[1::2]
+
+    if len(human_conversations) != len(gpt_conversations):
+        raise ValueError("Number of human and gpt conversations do not match")
+
+    rounds = list(zip(human_conversations, gpt_conversations))
+    sources = []
+    for human_conversation, gpt_conversation in rounds:
+        human_source = human_conversation['source']
+        gpt_source = gpt_conversation['source']
+        if human_source not in source_data or gpt_source not in source_data:
+            raise ValueError(f"Source {human_source} or {gpt_source} not found in data")
+        for source in (human_source, gpt_source):
+            if source not in sources:
+                sources.append(source)
+
+    system = worker_dict['args'].get('system')
+    missing = object()
+
+    def iter_conversations():
+        # 各source按文档、按条目同步读取，每个条目的多轮对话合并为一条数据
+        for documents in zip(*[source_data[source] for source in sources]):
+            for items in zip_longest(*documents, fillvalue=missing):
+                if any(item is missing for item in items):
+                    raise ValueError(f"Data structures for {sources} do not match")
+                item_dict = dict(zip(sources, items))
+
+                merged = None
+                for human_conversation, gpt_conversation in rounds:
+                    human_data = item_dict[human_conversation['source']]
+                    gpt_data = item_dict[gpt_conversation['source']]
+                    if isinstance(human_data, Exception) or isinstance(gpt_data, Exception):
+                        merged = None
+                        break
+
+                    converted = write_dataset_sharegpt(
+                        system=system,
+                        human_datas=[human_data],
+                        gpt_datas=[gpt_data],
+                        human_source_tag=human_conversation.get('source_tag'),
+                        human_output_tag=human_conversation.get('output_tag'),
+                        gpt_tag=gpt_conversation.get('output_tag'),
+                        instruction=human_conversation.get('instruction')
+                    )[0]
+                    if merged is None:
+                        merged = converted
+                    else:
+                        merged['conversations'].extend(converted['conversations'])
+
+                if merged is not None:
+                    yield merged
+
+    output_path = worker_dict.get('output_path')
+    if output_path is not None:
+        yield iter_save_dataset(iter_conversations(), output_path)
+    else:
+        yield iter_conversations()
+
+
 DATASET_DICT = {"dataset_sharegpt": dataset_sharegpt}
 
+DATASET_STREAM_DICT = {"dataset_sharegpt": dataset_sharegpt_stream}
+
 
 def get_dataset_builder(builder_type):
     return DATASET_DICT[builder_type]
+
+
+def get_dataset_stream_builder(builder_type):
+    return DATASET_STREAM_DICT[builder_type]
@@ -0,0 +1,214 @@
+# Incremental.py
+# 增量运行：reader根据清单（路径、大小、修改时间、内容哈希）只读取新增或改动的文件，
+# 下游只处理这些文档，保存时按文档与上一次保存的结果合并。
+# 数据集等无法按文档合并的worker需要上游的全部文档，上游按文档缓存结果，未改动的文档从缓存读取。
+import hashlib
+import json
+import logging
+import os
+import shutil
+
+from src.store import find_results_path, load_results
+
+INCREMENTAL_DIR = ".incremental"
+SNAPSHOT_DIR = "previous"
+
+# 结果把全部文档合并为一项的处理器（如数据集），无法按文档与上一次的结果合并
+UNKEYED_PREFIXES = ('dataset',)
+
+FINGERPRINTS_FILE = "fingerprints.json"
+
+
+def incremental_enabled() -> bool:
+    return os.getenv('INCREMENTAL', default='false') == 'true'
+
+
+def document_keyed(processor_type) -> bool:
+    return processor_type.split('_')[0] not in UNKEYED_PREFIXES
+
+
+def file_hash(path, block_size: int = 1 << 20) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def manifest_path(save_dir, worker) -> str:
+    return os.path.join(save_dir, INCREMENTAL_DIR, f"{worker}.manifest.json")
+
+
+def keys_path(save_dir, worker) -> str:
+    # 结果中每个文档对应的输入文件，与结果文件放在一起
+    return os.path.join(save_dir, f"{worker}.keys.json")
+
+
+def snapshot_dir(save_dir) -> str:
+    return os.path.join(save_dir, INCREMENTAL_DIR, SNAPSHOT_DIR)
+
+
+class Manifest:
+    """
+    reader输入文件的清单，大小与修改时间不变时认为文件未改动，否则比较内容哈希
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        self.pending = {}
+
+    def changed(self, file_paths) -> list:
+        """
+        :param file_paths: 当前的全部输入文件
+        :return: 新增或改动的文件，顺序与输入一致
+        """
+        self.pending = {}
+        changed = []
+        for path in file_paths:
+            stat = os.stat(path)
+            entry = self.entries.get(path)
+            if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                self.pending[path] = entry
+                continue
+            entry_hash = file_hash(path)
+            if entry is None or entry['sha256'] != entry_hash:
+                changed.append(path)
+            self.pending[path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': entry_hash}
+        return changed
+
+    def commit(self) -> None:
+        # 只在整次运行成功后写入，失败时下次运行重新处理同样的文件
+        self.entries = self.pending
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, self.path)
+
+
+def fingerprints_path(save_dir) -> str:
+    # 上一次成功运行时各worker按文档计算指纹的基础，不同时已缓存的文档不再可用
+    return os.path.join(save_dir, INCREMENTAL_DIR, FINGERPRINTS_FILE)
+
+
+def load_base_fingerprints(save_dir) -> dict:
+    path = fingerprints_path(save_dir)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_base_fingerprints(save_dir, fingerprints: dict) -> None:
+    path = fingerprints_path(save_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(fingerprints, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+
+def reset_base_fingerprints(save_dir) -> None:
+    # 下次运行读取全部文件，重新缓存每个文档
+    path = fingerprints_path(save_dir)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def document_fingerprint(base: str, *parts) -> str:
+    """
+    单个文档的指纹：worker的基础指纹加上输入文件的内容哈希或上游文档的指纹
+    """
+    encoded = json.dumps([base, *parts], ensure_ascii=False)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def take_snapshot(save_dir, workers) -> None:
+    """
+    把上一次保存的结果移入快照目录，本次保存时从快照读取并合并
+    上一次运行失败留下的快照直接沿用
+    """
+    snapshot = snapshot_dir(save_dir)
+    if os.path.exists(snapshot):
+        logging.warning(f"沿用上一次未完成运行的快照{snapshot}")
+        return
+    os.makedirs(snapshot)
+    for worker in workers:
+        for path in (find_results_path(save_dir, worker), keys_path(save_dir, worker)):
+            if path is not None and os.path.exists(path):
+                os.replace(path, os.path.join(snapshot, os.path.basename(path)))
+
+
+def remove_snapshot(save_dir) -> None:
+    shutil.rmtree(snapshot_dir(save_dir), ignore_errors=True)
+
+
+def load_previous(save_dir, worker) -> tuple:
+    """
+    读取快照中worker的结果与文档对应的文件
+    :return: (文档键列表, 结果)，没有时返回两个空列表
+    """
+    snapshot = snapshot_dir(save_dir)
+    results_path = find_results_path(snapshot, worker)
+    if results_path is None or not os.path.exists(keys_path(snapshot, worker)):
+        return [], []
+    with open(keys_path(snapshot, worker), 'r', encoding='utf-8') as f:
+        keys = json.load(f)
+    return keys, load_results(results_path)
+
+
+def save_keys(save_dir, worker, keys) -> None:
+    with open(keys_path(save_dir, worker), 'w', encoding='utf-8') as f:
+        json.dump(keys, f, ensure_ascii=False)
+
+
+def key_mode(source_keys: dict, n_results: int) -> str | None:
+    """
+    判断输出文档与上游文档的对应方式
+    所有上游的键相同且数量一致时按位置对应（aligned）；数量等于上游之和时按上游顺序拼接（concat）
+    :param source_keys: 字典，键为上游名称，值为上游文档的键列表
+    :param n_results: 输出的文档数
+    :return: aligned、concat，无法按文档对应时返回None
+    """
+    key_lists = list(source_keys.values())
+    if not key_lists:
+        return None
+    if all(keys == key_lists[0] for keys in key_lists) and len(key_lists[0]) == n_results:
+        return 'aligned'
+    if sum(len(keys) for keys in key_lists) == n_results:
+        return 'concat'
+    return None
+
+
+def combine_keys(source_keys: dict, mode: str) -> list:
+    if mode == 'aligned':
+        return list(next(iter(source_keys.values())))
+    return [f"{name}/{key}" for name, keys in source_keys.items() for key in keys]
+
+
+def group_documents(keys, results) -> dict:
+    groups = {}
+    for key, document in zip(keys, results):
+        groups.setdefault(key, []).append(document)
+    return groups
+
+
+def merge_documents(order, new_keys, new_results, old_keys, old_results) -> tuple:
+    """
+    按全部输入文件的顺序合并本次与上一次的结果，本次的文档优先，已删除文件的文档丢弃
+    :param order: 当前全部文档键的顺序
+    :return: (合并后的键列表, 合并后的结果)
+    """
+    new_groups = group_documents(new_keys, new_results)
+    old_groups = group_documents(old_keys, old_results)
+    keys = []
+    results = []
+    for key in order:
+        documents = new_groups[key] if key in new_groups else old_groups.get(key, [])
+        keys.extend([key] * len(documents))
+        results.extend(documents)
+    return keys, results
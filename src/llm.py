@@ -1,9 +1,72 @@
 from typing import Tuple
 
-from openai import OpenAI
+import atexit
 from concurrent.futures import ThreadPoolExecutor, as_completed
-from tqdm import tqdm
+from contextlib import contextmanager
 import os
+import queue
+import threading
+
+from src.trace import get_worker_trace, NULL_TRACE
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+class PooledClient:
+    """
+    共享的客户端与正在使用它的请求数，被更大连接池的客户端替换后，最后一个请求结束时关闭
+    """
+
+    def __init__(self, client, pool_size: int):
+        self.client = client
+        self.pool_size = pool_size
+        self.users = 0
+        self.retired = False
+
+
+@contextmanager
+def use_client(base_url, api_key, pool_size: int = 1):
+    """
+    进程内共享的OpenAI客户端，按(base_url, api_key)复用，请求之间保持长连接，可以在多个线程中同时使用
+    :param pool_size: 保持的空闲连接数，通常与workers相同；同时的请求更多时临时建立连接，用完后关闭
+    :return: OpenAI客户端，已有的客户端连接池较小时以更大的连接池重新创建，旧的客户端在不再使用后关闭
+    """
+    key = (base_url, api_key)
+    retired = None
+    with _clients_lock:
+        entry = _clients.get(key)
+        if entry is None or entry.pool_size < pool_size:
+            from openai import OpenAI, DefaultHttpxClient
+            import httpx
+
+            if entry is not None:
+                entry.retired = True
+                retired = entry if entry.users == 0 else None
+            limits = httpx.Limits(max_connections=None, max_keepalive_connections=pool_size)
+            entry = PooledClient(OpenAI(base_url=base_url, api_key=api_key,
+                                        http_client=DefaultHttpxClient(limits=limits)), pool_size)
+            _clients[key] = entry
+        entry.users += 1
+    if retired is not None:
+        retired.client.close()
+    try:
+        yield entry.client
+    finally:
+        with _clients_lock:
+            entry.users -= 1
+            close = entry.retired and entry.users == 0
+        if close:
+            entry.client.close()
+
+
+@atexit.register
+def close_clients() -> None:
+    with _clients_lock:
+        entries = list(_clients.values())
+        _clients.clear()
+    for entry in entries:
+        entry.client.close()
 
 
 def llm_base(
@@ -14,19 +77,20 @@ def llm_base(
         top_p=None,
         base_url="https://ling-api.com/v1",
         api_key=None,
+        timeout=None,
+        pool_size=1,
 ) -> str:
     if base_url is None:
         base_url = "https://ling-api.com/v1"
-    client = OpenAI(base_url=base_url,
-                    api_key=api_key)
-
-    chat_response = client.chat.completions.create(
-        model=model,
-        messages=[{'role': 'system', 'content': system_input},
-                  {'role': 'user', 'content': user_input}],
-        temperature=temperature,
-        top_p=top_p,
-    )
+    with use_client(base_url, api_key, pool_size) as client:
+        chat_response = client.chat.completions.create(
+            model=model,
+            messages=[{'role': 'system', 'content': system_input},
+                      {'role': 'user', 'content': user_input}],
+            temperature=temperature,
+            top_p=top_p,
+            timeout=timeout,
+        )
     if chat_response.choices[0].finish_reason != "stop":
         if chat_response.choices[0].finish_reason == "length":
             raise ValueError("Response length reached maximum")
@@ -47,11 +111,16 @@ def single_request(
         top_p=None,
         base_url=None,
         api_key=None,
+        trace=None,
+        timeout=None,
+        pool_size=1,
 ) -> tuple[str, str]:
     prompt_parts = [instruction, example, source_tag, source_text, output_tag]
     human_conversation_part = "\n\n".join([part for part in prompt_parts if part is not None])
     prompt = human_conversation_part.strip()
-    result = llm_base(prompt, sys_prompt, model=model, temperature=temperature, top_p=top_p, base_url=base_url, api_key=api_key)
+    with (trace or NULL_TRACE).llm_request():
+        result = llm_base(prompt, sys_prompt, model=model, temperature=temperature, top_p=top_p, base_url=base_url,
+                          api_key=api_key, timeout=timeout, pool_size=pool_size)
 
     return prompt, result
 
@@ -69,11 +138,16 @@ def multi_request(
         workers=1,
         base_url=None,
         api_key=None,
+        trace=None,
+        timeout=None,
+        pool_size=None,
 ) -> list[(str, str)]:
     """
     使用多线程并发请求
     :param base_url:
     :param api_key:
+    :param timeout: 每个请求的超时（秒），None为openai的默认值
+    :param pool_size: 与API保持的连接数，默认与workers相同
     :param workers:
     :param sys_prompt:
     :param model:
@@ -86,8 +160,12 @@ def multi_request(
     :param chunk_texts:
     :return: 列表，每个元素是一个元组，包含原始文本和处理后的文本
     """
+    from tqdm import tqdm
+
     if workers is None:
         workers = 1
+    if pool_size is None:
+        pool_size = workers
 
     # 使用with语句自动管理线程池
     with ThreadPoolExecutor(max_workers=workers) as executor:
@@ -105,6 +183,9 @@ def multi_request(
             top_p,
             base_url,
             api_key,
+            trace,
+            timeout,
+            pool_size,
         ): index for index, chunk_text in enumerate(chunk_texts)}
 
         # 初始化一个足够大的列表，用None填充，保证有足够的空间存储每个结果
@@ -136,15 +217,90 @@ def multi_request(
     return results
 
 
-def llm_instruction_001(worker_dict):
-    results = []
-    source_list = worker_dict.get('source')
-    if source_list is None:
-        raise ValueError("No source provided for llm_instruction")
-    source_data = worker_dict.get('data')
-    if source_data is None:
-        raise ValueError("No data provided for llm_instruction")
+def iter_request(
+        chunk_texts,
+        sys_prompt=None,
+        model=None,
+        example=None,
+        instruction=None,
+        source_tag="文本",
+        output_tag="输出",
+        temperature=None,
+        top_p=None,
+        workers=1,
+        base_url=None,
+        api_key=None,
+        trace=None,
+        timeout=None,
+        pool_size=None,
+):
+    """
+    流式并发请求：边读取输入边提交，按输入顺序逐个产出结果，最前面的请求完成后即产出，
+    最多同时有workers*2个请求在等待
+    输入在单独的线程中读取，等待上游时已完成的结果照常产出，上游反过来等待这些结果时不会死锁
+    :return: 生成器，每个元素是一个元组，包含原始文本和处理后的文本
+    """
+    if workers is None:
+        workers = 1
+    if pool_size is None:
+        pool_size = workers
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        slots = threading.Semaphore(workers * 2)
+        submitted = queue.Queue()
+        stop = threading.Event()
+
+        def feed():
+            try:
+                for chunk_text in chunk_texts:
+                    slots.acquire()
+                    if stop.is_set():
+                        break
+                    submitted.put(executor.submit(
+                        single_request,
+                        chunk_text,
+                        sys_prompt,
+                        model,
+                        example,
+                        instruction,
+                        source_tag,
+                        output_tag,
+                        temperature,
+                        top_p,
+                        base_url,
+                        api_key,
+                        trace,
+                        timeout,
+                        pool_size,
+                    ))
+            except Exception as e:
+                submitted.put(e)  # 读取上游出错，在产出结果的线程中抛出
+                return
+            submitted.put(None)
+
+        feeder = threading.Thread(target=feed, name=f"{threading.current_thread().name}/feed", daemon=True)
+        feeder.start()
+        try:
+            while True:
+                future = submitted.get()
+                if future is None:
+                    break
+                if isinstance(future, Exception):
+                    raise future
+                try:
+                    result = future.result()
+                except Exception as e:
+                    result = None, e
+                slots.release()
+                yield result
+        finally:
+            # 提前关闭时通知读取线程停止，等它退出后上游才能被其他线程继续读取
+            stop.set()
+            slots.release()
+            feeder.join()
+
 
+def get_llm_001_args(worker_dict):
     model = worker_dict['args'].get('model')
     instruction = worker_dict['args'].get('instruction')
     example = worker_dict['args'].get('example')
@@ -154,7 +310,6 @@ def llm_instruction_001(worker_dict):
     temperature = worker_dict['args'].get('temperature', 0.7)
     top_p = worker_dict['args'].get('top_p', 0.8)
     workers = worker_dict['args'].get('workers')
-    # print(model, instruction, example, sys_prompt, source_tag, output_tag, temperature, top_p, workers)
 
     base_url = os.getenv('LLM_API_BASE', default='https://ling-api.com/v1')
     if worker_dict.get('base_url') is not None:
@@ -162,35 +317,75 @@ def llm_instruction_001(worker_dict):
     api_key = os.getenv('LLM_API_KEY', default='0')
     if worker_dict.get('api_key') is not None:
         api_key = worker_dict.get('api_key')
+    timeout = float(os.getenv('LLM_TIMEOUT', default='600'))
+    if worker_dict.get('timeout') is not None:
+        timeout = float(worker_dict.get('timeout'))
+    # 0为与workers相同
+    pool_size = int(os.getenv('LLM_POOL_SIZE', default='0')) or None
+
+    return {
+        'sys_prompt': sys_prompt,
+        'model': model,
+        'example': example,
+        'instruction': instruction,
+        'source_tag': source_tag,
+        'output_tag': output_tag,
+        'temperature': temperature,
+        'top_p': top_p,
+        'workers': workers,
+        'base_url': base_url,
+        'api_key': api_key,
+        'timeout': timeout,
+        'pool_size': pool_size,
+    }
+
+
+def llm_instruction_001(worker_dict):
+    results = []
+    source_list = worker_dict.get('source')
+    if source_list is None:
+        raise ValueError("No source provided for llm_instruction")
+    source_data = worker_dict.get('data')
+    if source_data is None:
+        raise ValueError("No data provided for llm_instruction")
+
+    llm_args = get_llm_001_args(worker_dict)
+    trace = get_worker_trace(worker_dict.get('name'))
 
     for source in source_list:
         if source not in source_data:
             raise ValueError(f"Source {source} not found in data")
         else:
             for data in source_data[source]:
-                # print(data)
-                results.append(
-                    multi_request(
-                        chunk_texts=data,
-                        sys_prompt=sys_prompt,
-                        model=model,
-                        example=example,
-                        instruction=instruction,
-                        source_tag=source_tag,
-                        output_tag=output_tag,
-                        temperature=temperature,
-                        top_p=top_p,
-                        workers=workers,
-                        base_url=base_url,
-                        api_key=api_key
-                    )
-                )
+                results.append(multi_request(chunk_texts=data[:worker_dict.get('limit')], trace=trace, **llm_args))
 
     return results
 
 
+def llm_instruction_001_stream(worker_dict):
+    source_list = worker_dict.get('source')
+    if source_list is None:
+        raise ValueError("No source provided for llm_instruction")
+    source_data = worker_dict.get('data')
+    if source_data is None:
+        raise ValueError("No data provided for llm_instruction")
+
+    llm_args = get_llm_001_args(worker_dict)
+    trace = get_worker_trace(worker_dict.get('name'))
+
+    for source in source_list:
+        for data in source_data[source]:
+            yield iter_request(chunk_texts=data, trace=trace, **llm_args)
+
+
 LLM_PROCESSOR_DICT = {"llm_001": llm_instruction_001}
 
+LLM_STREAM_PROCESSOR_DICT = {"llm_001": llm_instruction_001_stream}
+
 
 def get_llm_processor(processor_name: str):
     return LLM_PROCESSOR_DICT[processor_name]
+
+
+def get_llm_stream_processor(processor_name: str):
+    return LLM_STREAM_PROCESSOR_DICT[processor_name]
@@ -2,8 +2,9 @@ import json
 import os
 import sys
 from datetime import datetime
-import copy
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 # 获取当前时间的时间戳
 timestamp = datetime.now().timestamp()
@@ -18,6 +19,8 @@ DEFAULT_CONFIG_DICT = {
     "DATA_ROOT": "data",
     "LLM_API_BASE": "https://ling-api.com/v1",
     "LLM_API_KEY": "0",
+    "LLM_TIMEOUT": 600,
+    "LLM_POOL_SIZE": 0,
     "SHOW_LOG": True,
     "SAVE_RESULTS": True,
     "SAVE_ARGS": True,
@@ -25,6 +28,28 @@ DEFAULT_CONFIG_DICT = {
     "SEPERATOR": "⫘",
     "VERSION": "0.0.4 beta 05090105",
     "OVERWRITE": False,
+    "MAX_PARALLEL": 4,
+    "SHARD_WORKERS": 1,
+    "READ_WORKERS": 4,
+    "CACHE": True,
+    "STREAM_MODE": False,
+    "STREAM_QUEUE_SIZE": 64,
+    "SLICE_PUSHDOWN": True,
+    "RELEASE_RESULTS": True,
+    "SPILL_RESULTS": False,
+    "RESULT_STORE": "jsonl",
+    "RESULT_COMPRESS": "none",
+    "ASYNC_SAVE": True,
+    "TRACE": False,
+    "INCREMENTAL": False,
+}
+
+# 输出的第i项只依赖输入的第i项的处理器，下游的切片范围可以继续向上游传递
+ELEMENTWISE_PROCESSORS = {
+    "transformer_id",
+    "transformer_spliter_chapter_spliter",
+    "transformer_llm_001_dataset",
+    "llm_001",
 }
 
 
@@ -44,23 +69,46 @@ def welcome():
     logging.info(f"数据源路径：{os.getenv('DATA_ROOT')}")
     logging.info(f"模型API地址：{os.getenv('LLM_API_BASE')}")
     logging.info(f"模型API密钥：{os.getenv('LLM_API_KEY')}")
+    logging.info(f"模型请求超时：{os.getenv('LLM_TIMEOUT')}秒，连接池大小：{os.getenv('LLM_POOL_SIZE')}")
     logging.info(f"是否显示日志：{os.getenv('SHOW_LOG')}")
     logging.info(f"是否保存结果：{os.getenv('SAVE_RESULTS')}")
     logging.info(f"是否保存参数文件：{os.getenv('SAVE_ARGS')}")
+    logging.info(f"结果保存格式：{os.getenv('RESULT_STORE')}，压缩：{os.getenv('RESULT_COMPRESS')}")
     logging.info(f"分隔符：{os.getenv('SEPERATOR')}")
     logging.info(f"是否覆盖结果：{os.getenv('OVERWRITE')}")
+    logging.info(f"最大并行数：{os.getenv('MAX_PARALLEL')}")
+    logging.info(f"分片进程数：{os.getenv('SHARD_WORKERS')}")
+    logging.info(f"读取线程数：{os.getenv('READ_WORKERS')}")
+    logging.info(f"是否使用结果缓存：{os.getenv('CACHE')}")
+    logging.info(f"是否流式运行：{os.getenv('STREAM_MODE')}")
+    logging.info(f"是否记录运行情况：{os.getenv('TRACE')}")
+    logging.info(f"是否增量运行：{os.getenv('INCREMENTAL')}")
     logging.info(os.getenv('SEPERATOR') * 50)
 
 
 class LingData:
 
     def __init__(self, databuilder_args_path):
+        from src.trace import start_trace
+
         set_default_environ()
         self.databuilder_args_path = databuilder_args_path
         self.builders_args = self.read_databuilder_args()
         self.read_env_args()
+        self.set_cache_root()
         welcome()
         self.workers_dict = self.get_processors()
+        self.demands = None
+        self.incremental = False
+        self.partial_input = False
+        self.document_cached = set()
+        self.base_fingerprints = {}
+        self.save_executor = ThreadPoolExecutor(max_workers=1)
+        self.save_futures = []
+        self.save_lock = threading.Lock()
+        self.base_refs = {}
+        self.shared_keys = []
+        self.tracer = start_trace()
         self.mk_dir()
         self.save_args()
 
@@ -75,6 +123,11 @@ class LingData:
             logging.error("未找到environ参数")
             raise ValueError("未找到environ参数")
 
+    def set_cache_root(self) -> None:
+        from src.cache import set_cache_root
+
+        set_cache_root(self.get_save_root())
+
     def read_databuilder_args(self) -> dict | None:
         try:
             with open(self.databuilder_args_path, 'r', encoding='utf-8') as f:
@@ -84,46 +137,32 @@ class LingData:
             logging.error(f"读取{self.databuilder_args_path}错误：" + str(e))
             return None
 
-    @staticmethod
-    def get_processor(processor_type, get_processor_func) -> callable:
-        try:
-            return get_processor_func(processor_type)
-        except Exception as e:
-            logging.error(f"读取{processor_type}错误："+ str(e))
-            return None
-
     def get_processors(self) -> dict:
-        from src.reader import get_reader
-        from src.spliter import get_spliter
-        from src.dataset import get_dataset_builder
-        from src.llm import get_llm_processor
-        from src.custom import get_custom_processor
-        from src.transformer import get_transformer
-
-        processor_funcs = {
-            'reader': get_reader,
-            'spliter': get_spliter,
-            'llm': get_llm_processor,
-            'dataset': get_dataset_builder,
-            'custom': get_custom_processor,
-            'transformer': get_transformer,
-        }
-
-        workers_dict = copy.deepcopy(self.builders_args)
+        from src.registry import LazyProcessor
+        from src.tools import check_tokenizer
+
+        # 只复制每个worker的第一层，参数本身在运行中只读
+        workers_dict = {key: dict(value) for key, value in self.builders_args.items()}
         keys = list(workers_dict.keys())
 
         for key in keys:
             processor = self.builders_args[key]['type']
-            processor_type = processor.split('_')[0]
-            get_processor_func = processor_funcs.get(processor_type)
-
-            if get_processor_func:
-                workers_dict[key]['processor'] = self.get_processor(processor, get_processor_func)
-            elif processor_type == 'environ':
+            if processor.split('_')[0] == 'environ':
                 workers_dict[key]['processor'] = 'no_run'
-            else:
-                logging.error(f"未注册{processor}")
-                raise KeyError(f"未注册{processor}")
+                continue
+            try:
+                # 处理器所在模块在worker运行时才导入
+                workers_dict[key]['processor'] = LazyProcessor(processor)
+            except KeyError as e:
+                logging.error(e.args[0])
+                raise
+            tokenizer = (self.builders_args[key].get('args') or {}).get('tokenizer')
+            if tokenizer is not None:
+                try:
+                    check_tokenizer(tokenizer)  # 读取参数时检查，不等到worker运行
+                except ValueError as e:
+                    logging.error(f"{key}：" + str(e))
+                    raise
 
         return workers_dict
 
@@ -139,105 +178,724 @@ class LingData:
                 return name, start_index, end_index
             return name, None, None
 
+    def get_sources(self, worker) -> list:
+        """
+        解析worker在参数文件中的source
+        :param worker: worker名称
+        :return: 列表，每个元素是(source名称, 起始位置, 结束位置)
+        """
+        source = self.builders_args[worker].get('source')
+        if not source:
+            return []
+        if type(source) is str:
+            source = [source]
+        elif type(source) is not list:
+            logging.error(f"{worker}的source数据类型错误：{source}")
+            raise ValueError(f"{worker}的source数据类型错误：{source}")
+
+        sources = []
+        for s in source:
+            extracted = self.extract_source(s)
+            if extracted is None:
+                logging.error(f"{worker}的source格式错误：{s}")
+                raise ValueError(f"{worker}的source格式错误：{s}")
+            sources.append(extracted)
+        return sources
+
+    def build_dependency_graph(self) -> dict:
+        """
+        根据每个worker的source构建依赖图
+        :return: 字典，键为worker名称，值为其依赖的worker名称列表（按参数文件顺序）
+        """
+        graph = {}
+        for worker in self.workers_dict:
+            dependencies = []
+            for source_name, _, _ in self.get_sources(worker):
+                if source_name not in self.workers_dict:
+                    logging.error(f"{worker}的source未找到：{source_name}")
+                    raise KeyError(f"{worker}的source未找到：{source_name}")
+                if source_name not in dependencies:
+                    dependencies.append(source_name)
+            graph[worker] = dependencies
+
+        # 拓扑排序检查循环依赖
+        in_degree = {worker: len(dependencies) for worker, dependencies in graph.items()}
+        ready = [worker for worker, degree in in_degree.items() if degree == 0]
+        visited = 0
+        while ready:
+            worker = ready.pop()
+            visited += 1
+            for consumer, dependencies in graph.items():
+                if worker in dependencies:
+                    in_degree[consumer] -= 1
+                    if in_degree[consumer] == 0:
+                        ready.append(consumer)
+        if visited != len(graph):
+            cycle = [worker for worker, degree in in_degree.items() if degree > 0]
+            logging.error(f"存在循环依赖：{cycle}")
+            raise ValueError(f"存在循环依赖：{cycle}")
+
+        return graph
+
+    def compute_demands(self) -> dict:
+        """
+        切片下推：根据下游的切片范围计算每个worker每个文档实际需要输出的条目数
+        :return: 字典，键为worker名称，值为需要的条目数，None表示需要全部
+        """
+        graph = self.build_dependency_graph()
+        consumers = {worker: [] for worker in graph}
+        for worker in graph:
+            for source_name, _, end in self.get_sources(worker):
+                consumers[source_name].append((worker, end))
+
+        demands = {}
+
+        def demand(worker):
+            if worker in demands:
+                return demands[worker]
+            needed = []
+            for consumer, end in consumers[worker]:
+                if end is None and self.workers_dict[consumer]['type'] in ELEMENTWISE_PROCESSORS:
+                    end = demand(consumer)
+                if end is None:
+                    needed = None
+                    break
+                needed.append(end)
+            # 没有下游的worker需要全部输出
+            demands[worker] = max(needed) if needed else None
+            return demands[worker]
+
+        for worker in graph:
+            demand(worker)
+        return demands
+
+    def get_limit(self, worker) -> int | None:
+        if os.getenv('SLICE_PUSHDOWN', default='true') != 'true':
+            return None
+        if self.demands is None:
+            self.demands = self.compute_demands()
+        return self.demands.get(worker)
+
+    def get_fingerprint(self, worker, sources) -> str | None:
+        """
+        计算worker结果的指纹：处理器类型、参数、上游指纹与切片范围、代码版本
+        :return: 指纹，上游没有指纹时返回None
+        """
+        from src.cache import fingerprint
+
+        source_fingerprints = []
+        for source_name, start, end in sources:
+            source_fingerprint = self.workers_dict[source_name].get('fingerprint')
+            if source_fingerprint is None:
+                return None
+            source_fingerprints.append([source_fingerprint, start, end])
+        worker_config = self.builders_args[worker]
+        if self.workers_dict[worker].get('limit') is not None:
+            worker_config = {**worker_config, 'limit': self.workers_dict[worker]['limit']}
+        if self.workers_dict[worker].get('only_files') is not None:
+            worker_config = {**worker_config, 'only_files': self.workers_dict[worker]['only_files']}
+        try:
+            return fingerprint(worker_config, source_fingerprints,
+                               self.workers_dict[worker]['processor'].resolve(), DEFAULT_CONFIG_DICT['VERSION'])
+        except Exception as e:
+            logging.warning(f"计算{worker}指纹错误：" + str(e))
+            return None
+
+    def get_base_fingerprint(self, worker) -> str | None:
+        """
+        增量运行时按文档计算指纹的基础：处理器类型、参数、切片范围、代码版本，不含输入文件与上游
+        每个文档的指纹再加上输入文件的内容哈希或上游文档的指纹，见track_documents
+        """
+        from src.cache import fingerprint
+
+        worker_config = {**self.builders_args[worker], 'limit': self.get_limit(worker)}
+        ranges = [[start, end] for _, start, end in self.get_sources(worker)]
+        try:
+            return fingerprint(worker_config, ranges, self.workers_dict[worker]['processor'].resolve(),
+                               DEFAULT_CONFIG_DICT['VERSION'], files=False)
+        except Exception as e:
+            logging.warning(f"计算{worker}指纹错误：" + str(e))
+            return None
+
+    def use_cache(self, worker) -> bool:
+        # 带output_path的worker有写文件的副作用，始终重新运行
+        if self.workers_dict[worker].get('output_path') is not None:
+            return False
+        if self.workers_dict[worker].get('cache') is None:
+            return os.getenv('CACHE', default='true') == 'true'
+        return str(self.workers_dict[worker].get('cache')).lower() == 'true'
+
+    def share_results(self, worker) -> None:
+        """
+        登记结果中的长文本，下游结果写入缓存或写出时，引用这些原文的片段只保存原文的键
+        读取时片段重新指向登记的原文，全部运行完成后取消登记
+        """
+        from src.tools import document_texts, share_texts
+
+        keys = share_texts(text for doc in self.workers_dict[worker]['results'] if isinstance(doc, str)
+                           for text in document_texts(doc))
+        with self.save_lock:
+            self.shared_keys.extend(keys)
+
+    def unshare_results(self) -> None:
+        from src.tools import unshare_texts
+
+        with self.save_lock:
+            keys, self.shared_keys = self.shared_keys, []
+        unshare_texts(keys)
+
     def run(self, worker) -> dict:
+        from src.tools import result_view
+        from src.cache import load_cache, save_cache, contains_exception
+        from src.trace import get_worker_trace, count_items
+        from src.incremental import document_keyed
+
         processor = self.workers_dict[worker]['processor']
         if processor == 'no_run':
             return self.workers_dict[worker]
-        source = self.workers_dict[worker].get('source')
-
-        if source:
-            source_data = {}
-            source_name_list = []
-            if type(source) is str:
-                source = [source]
-            elif type(source) is not list:
-                logging.error(f"{worker}的source数据类型错误：{source}")
-                raise ValueError(f"{worker}的source数据类型错误：{source}")
-            for s in source:
-                source_name, start, end = self.extract_source(s)
-                source_data[source_name] = [result[start:end] for result in
-                                            self.workers_dict[source_name]['results']]  # 切分
-                source_name_list.append(source_name)
-                self.workers_dict[worker]['source'] = source_name_list
-            self.workers_dict[worker]['data'] = source_data
 
-        self.workers_dict[worker]['name'] = worker
+        with get_worker_trace(worker).run() as trace:
+            sources = self.get_sources(worker)
+
+            if sources:
+                # 增量运行时无法按文档合并的worker使用上游全部文档的结果
+                full = self.incremental and not document_keyed(self.workers_dict[worker]['type'])
+                source_data = {}
+                source_name_list = []
+                for source_name, start, end in sources:
+                    results = self.full_results(source_name) if full else self.get_results(source_name)
+                    source_data[source_name] = [result_view(result, start, end) for result in results]  # 切分（只读视图）
+                    source_name_list.append(source_name)
+                    trace.add_items(items_in=count_items(source_data[source_name]))
+                self.workers_dict[worker]['source'] = source_name_list
+                self.workers_dict[worker]['data'] = source_data
+
+            self.workers_dict[worker]['name'] = worker
+            self.workers_dict[worker]['limit'] = self.get_limit(worker)
+
+            with trace.span('fingerprint'):
+                fingerprint = self.get_fingerprint(worker, sources)
+            self.workers_dict[worker]['fingerprint'] = fingerprint
+            use_cache = fingerprint is not None and self.use_cache(worker)
+
+            self.workers_dict[worker].pop('released', None)
+            with trace.span('load_cache'):
+                hit, results = load_cache(fingerprint) if use_cache else (False, None)
+            if hit:
+                self.workers_dict[worker]['results'] = results
+                logging.info(f"{worker}命中缓存，跳过运行")
+            elif self.nothing_changed(worker):
+                self.workers_dict[worker]['results'] = []
+                logging.info(f"{worker}没有新增或改动的文档，跳过运行")
+            else:
+                worker_dict = dict(self.workers_dict[worker])
+                with trace.span('process'):
+                    self.workers_dict[worker]['results'] = processor(worker_dict)  # 运行processor
+                if use_cache and not contains_exception(self.workers_dict[worker]['results']):
+                    try:
+                        with trace.span('save_cache'):
+                            save_cache(fingerprint, self.workers_dict[worker]['results'])
+                    except Exception as e:
+                        logging.error(f"缓存{worker}结果错误：" + str(e))
+            self.share_results(worker)
+            trace.add_items(items_out=count_items(self.workers_dict[worker]['results']))
+            if self.incremental:
+                self.track_documents(worker)
+
+            if os.getenv('SHOW_LOG') == 'true':
+                logging.info(f"{worker}运行完成")
+
+            if self.should_save(worker):
+                try:
+                    self.save_result(worker)
+                except Exception as e:
+                    logging.error(f"保存{worker}结果错误：" + str(e))
 
-        worker_dict = copy.deepcopy(self.workers_dict[worker])
-        self.workers_dict[worker]['results'] = processor(worker_dict)  # 运行processor
+        return self.workers_dict[worker]
 
-        if os.getenv('SHOW_LOG') == 'true':
-            logging.info(f"{worker}运行完成")
+    def get_save_root(self) -> str:
+        # environ参数中的SAVE_ROOT优先，环境变量会被转为小写，因此从参数文件读取
+        for worker_args in self.builders_args.values():
+            if isinstance(worker_args, dict) and worker_args.get('type', '').split('_')[0] == 'environ':
+                save_root = (worker_args.get('args') or {}).get('SAVE_ROOT')
+                if save_root is not None:
+                    return save_root
+        return self.builders_args.get('SAVE_ROOT', DEFAULT_CONFIG_DICT['SAVE_ROOT'])
 
-        if self.workers_dict[worker].get('save_result') is None:
-            save_result = os.getenv('SAVE_RESULTS', default='true') == 'true'
-        else:
-            save_result = str(self.workers_dict[worker].get('save_result')).lower() == 'true'
-            self.mk_dir(save_result)
-        if save_result == 'true':
+    def get_save_dir(self) -> str:
+        save_dir = os.getenv('SAVE_DIR')
+        if save_dir is None:
+            # 全局未开启保存时只为单个worker保存
+            save_dir = os.path.join(self.get_save_root(), os.getenv('PROJECT_NAME'))
+        return save_dir
+
+    def spill_path(self, worker) -> str:
+        return os.path.join(self.get_save_dir(), '.spill', f"{worker}.pkl")
+
+    def release(self, worker) -> None:
+        """
+        释放已被全部下游使用的结果，keep为true的worker保留结果
+        开启SPILL_RESULTS时，没有缓存的结果先写入保存目录，之后可通过get_results重新读取
+        """
+        from src.cache import cache_path, write_pickle
+
+        if str(self.workers_dict[worker].get('keep')).lower() == 'true':
+            return
+        if 'results' not in self.workers_dict[worker]:
+            return
+
+        fingerprint = self.workers_dict[worker].get('fingerprint')
+        cached = fingerprint is not None and os.path.exists(cache_path(fingerprint))
+        if os.getenv('SPILL_RESULTS') == 'true' and not cached:
             try:
-                self.save_result(worker)
+                write_pickle(self.spill_path(worker), self.workers_dict[worker]['results'])
             except Exception as e:
-                logging.error(f"保存{worker}结果错误：" + str(e))
-
-        return self.workers_dict[worker]
+                logging.error(f"写出{worker}结果错误：" + str(e))
+                return
+
+        self.workers_dict[worker].pop('results')
+        self.workers_dict[worker]['released'] = True
+        logging.info(f"{worker}的结果已释放")
+
+    def get_results(self, worker) -> list:
+        """
+        读取worker的结果，已释放的结果从缓存或写出的文件中重新读取
+        """
+        from src.cache import load_cache, read_pickle
+        from src.tools import unshare_texts
+
+        if 'results' in self.workers_dict[worker]:
+            return self.workers_dict[worker]['results']
+        if self.workers_dict[worker].get('released'):
+            # 全部运行完成后原文已取消登记，先重新登记上游结果中的原文
+            keys = [] if self.shared_keys else self.share_sources(worker)
+            try:
+                fingerprint = self.workers_dict[worker].get('fingerprint')
+                if fingerprint is not None:
+                    hit, results = load_cache(fingerprint)
+                    if hit:
+                        return results
+                if os.path.exists(self.spill_path(worker)):
+                    return read_pickle(self.spill_path(worker))
+            finally:
+                unshare_texts(keys)
+            raise ValueError(f"{worker}的结果已释放，请设置keep为true或开启SPILL_RESULTS")
+        raise ValueError(f"{worker}还没有运行结果")
+
+    def share_sources(self, worker) -> list:
+        """
+        登记worker全部上游结果中的原文，读取时片段重新指向这些原文
+        :return: 键列表，不再需要时传给unshare_texts
+        """
+        from src.tools import document_texts, share_texts
+
+        keys = []
+        for source_name, _, _ in self.get_sources(worker):
+            if self.workers_dict[source_name]['processor'] == 'no_run':
+                continue
+            keys.extend(self.share_sources(source_name))
+            keys.extend(share_texts(text for doc in self.get_results(source_name) if isinstance(doc, str)
+                                    for text in document_texts(doc)))
+        return keys
+
+    def full_results(self, worker) -> list:
+        """
+        增量运行时读取worker全部文档的结果：本次处理的文档加上按文档缓存的未改动文档，按输入文件顺序排列
+        """
+        from src.cache import load_cache
+        from src.incremental import group_documents, reset_base_fingerprints
+
+        results = self.get_results(worker)
+        if self.workers_dict[worker].get('complete', True):
+            return results
+        groups = group_documents(self.workers_dict[worker]['doc_keys'], results)
+        delta = set(self.workers_dict[worker]['doc_delta'])
+        doc_fingerprints = self.workers_dict[worker].get('doc_fingerprints', {})
+        merged = []
+        for key in self.workers_dict[worker]['doc_order']:
+            if key in delta:
+                merged.extend(groups.get(key, []))
+                continue
+            hit, documents = load_cache(doc_fingerprints[key]) if key in doc_fingerprints else (False, None)
+            if not hit:
+                # 清除基础指纹，下次运行读取全部文件并重新缓存每个文档
+                reset_base_fingerprints(self.get_save_dir())
+                logging.error(f"{worker}的文档{key}没有缓存，下次运行将读取全部文件")
+                raise ValueError(f"{worker}的文档{key}没有缓存")
+            merged.extend(documents)
+        return merged
+
+    def should_save(self, worker) -> bool:
+        if self.workers_dict[worker].get('save_result') is None:
+            return os.getenv('SAVE_RESULTS', default='true') == 'true'
+        return str(self.workers_dict[worker].get('save_result')).lower() == 'true'
+
+    def prepare_incremental(self, graph) -> dict:
+        """
+        增量运行：对比reader的输入文件与上一次成功运行的清单，只读取新增或改动的文件
+        下游worker只处理这些文件对应的文档，保存时与上一次的结果合并
+        结果无法按文档合并的worker（如数据集）需要全部文档，其上游按文档缓存结果，未改动的文档从缓存读取；
+        上游的参数或代码改动、没有开启缓存时读取全部文件
+        :return: 字典，键为reader名称，值为本次运行成功后需要写入的清单
+        """
+        from src.incremental import (incremental_enabled, document_keyed, Manifest, manifest_path, take_snapshot,
+                                     load_base_fingerprints)
+
+        if not incremental_enabled():
+            return {}
+        from src.reader import get_file_list
+
+        save_dir = self.get_save_dir()
+        self.incremental = True
+        unkeyed = [worker for worker in graph if self.workers_dict[worker]['processor'] != 'no_run'
+                   and not document_keyed(self.workers_dict[worker]['type'])]
+        self.document_cached = {source_name for worker in unkeyed for source_name in graph[worker]
+                                if document_keyed(self.workers_dict[source_name]['type'])}
+        read_all = False
+        if unkeyed:
+            # 无法按文档合并的worker的全部上游都按文档计算指纹
+            upstream, stack = set(), list(self.document_cached)
+            while stack:
+                worker = stack.pop()
+                if worker not in upstream and document_keyed(self.workers_dict[worker]['type']):
+                    upstream.add(worker)
+                    stack.extend(graph[worker])
+            self.base_fingerprints = {worker: self.get_base_fingerprint(worker) for worker in graph
+                                      if worker in upstream and self.workers_dict[worker]['processor'] != 'no_run'}
+            previous = load_base_fingerprints(save_dir)
+            changed = [worker for worker, base in self.base_fingerprints.items()
+                       if base is None or previous.get(worker) != base]
+            uncached = sorted(worker for worker in self.document_cached if not self.use_cache(worker))
+            if uncached:
+                logging.warning(f"{uncached}没有开启缓存，{unkeyed}需要全部文档，本次读取全部文件")
+                read_all = True
+            elif changed:
+                logging.warning(f"{changed}没有上一次按文档的缓存或参数已改动，本次读取全部文件")
+                read_all = True
+        manifests = {}
+        for worker in graph:
+            if self.workers_dict[worker]['type'].split('_')[0] != 'reader':
+                continue
+            file_paths = get_file_list(self.workers_dict[worker])
+            manifests[worker] = Manifest(manifest_path(save_dir, worker))
+            changed = manifests[worker].changed(file_paths)
+            self.workers_dict[worker]['only_files'] = file_paths if read_all else changed
+            self.workers_dict[worker]['doc_order'] = file_paths
+            self.workers_dict[worker]['doc_signatures'] = {path: entry['sha256'] for path, entry in
+                                                          manifests[worker].pending.items()}
+            self.partial_input |= len(self.workers_dict[worker]['only_files']) < len(file_paths)
+            logging.info(f"{worker}共{len(file_paths)}个文件，新增或改动{len(changed)}个")
+        take_snapshot(save_dir, [worker for worker in graph if self.should_save(worker)])
+        return manifests
+
+    def nothing_changed(self, worker) -> bool:
+        # 增量运行时reader没有需要读取的文件，或上游全部为空，不运行processor
+        if not self.incremental:
+            return False
+        if self.workers_dict[worker].get('only_files') is not None:
+            return not self.workers_dict[worker]['only_files']
+        sources = self.workers_dict[worker].get('source', [])
+        return bool(sources) and all(self.workers_dict[source_name].get('doc_keys') is not None and
+                                     len(self.workers_dict[worker]['data'][source_name]) == 0
+                                     for source_name in sources)
+
+    def track_documents(self, worker) -> None:
+        """
+        记录结果中每个文档对应的输入文件，作为保存时合并的键
+        reader的文档按元数据中的path或读取的文件对应；下游的文档与上游一一对应或按上游顺序拼接
+        结果只包含本次处理的文档时complete为False，doc_delta为本次处理的文档键
+        """
+        from src.incremental import key_mode, combine_keys, document_keyed
+
+        if not document_keyed(self.workers_dict[worker]['type']):
+            # 已使用上游全部文档运行，保存全部结果
+            self.workers_dict[worker].pop('doc_keys', None)
+            self.workers_dict[worker].pop('doc_order', None)
+            self.workers_dict[worker]['complete'] = True
+            return
 
-    def run_all(self) -> dict:
-        for key in self.workers_dict:
+        results = self.workers_dict[worker]['results']
+        only_files = self.workers_dict[worker].get('only_files')
+        if only_files is not None:
+            paths = [(getattr(doc, 'meta', None) or {}).get('path') for doc in results]
+            if all(paths):
+                self.workers_dict[worker]['doc_keys'] = paths
+            elif len(results) == len(only_files):
+                self.workers_dict[worker]['doc_keys'] = list(only_files)
+            else:
+                self.untrack_documents(worker)
+                return
+            self.workers_dict[worker]['doc_delta'] = list(only_files)
+            self.workers_dict[worker]['complete'] = len(only_files) == len(self.workers_dict[worker]['doc_order'])
+            self.cache_documents(worker)
+            return
+
+        source_keys, source_order, source_delta = {}, {}, {}
+        for source_name in self.workers_dict[worker].get('source', []):
+            source_keys[source_name] = self.workers_dict[source_name].get('doc_keys')
+            source_order[source_name] = self.workers_dict[source_name].get('doc_order')
+            source_delta[source_name] = self.workers_dict[source_name].get('doc_delta')
+        if any(keys is None for keys in source_keys.values()):
+            self.untrack_documents(worker)
+            return
+        mode = key_mode(source_keys, len(results))
+        if mode is None:
+            self.untrack_documents(worker)
+            return
+        self.workers_dict[worker]['doc_keys'] = combine_keys(source_keys, mode)
+        self.workers_dict[worker]['doc_order'] = combine_keys(source_order, mode)
+        self.workers_dict[worker]['doc_delta'] = combine_keys(source_delta, mode)
+        self.workers_dict[worker]['complete'] = all(self.workers_dict[source_name]['complete']
+                                                    for source_name in source_keys)
+        self.cache_documents(worker, source_order, mode)
+
+    def cache_documents(self, worker, source_order: dict = None, mode: str = None) -> None:
+        """
+        计算每个文档的指纹，reader按文件内容哈希，下游按上游对应文档的指纹
+        无法按文档合并的worker的直接上游把本次处理的每个文档分别写入缓存，之后只读取部分文件时从缓存补全
+        """
+        from src.cache import cache_path, save_cache, contains_exception
+        from src.incremental import document_fingerprint, group_documents
+
+        base = self.base_fingerprints.get(worker)
+        if base is None:
+            return
+        if source_order is None:
+            signatures = self.workers_dict[worker]['doc_signatures']
+            doc_fingerprints = {path: document_fingerprint(base, path, signatures[path])
+                                for path in self.workers_dict[worker]['doc_order']}
+        else:
+            source_fingerprints = {name: self.workers_dict[name].get('doc_fingerprints') for name in source_order}
+            if any(fingerprints is None for fingerprints in source_fingerprints.values()):
+                return
+            if mode == 'aligned':
+                doc_fingerprints = {key: document_fingerprint(base, [fingerprints[key] for fingerprints in
+                                                                     source_fingerprints.values()])
+                                    for key in self.workers_dict[worker]['doc_order']}
+            else:
+                doc_fingerprints = {f"{name}/{key}": document_fingerprint(base, name, source_fingerprints[name][key])
+                                    for name, order in source_order.items() for key in order}
+        self.workers_dict[worker]['doc_fingerprints'] = doc_fingerprints
+
+        if worker not in self.document_cached or not self.use_cache(worker):
+            return
+        groups = group_documents(self.workers_dict[worker]['doc_keys'], self.workers_dict[worker]['results'])
+        for key in self.workers_dict[worker]['doc_delta']:
+            documents = groups.get(key, [])
+            if contains_exception(documents) or os.path.exists(cache_path(doc_fingerprints[key])):
+                continue
             try:
-                self.run(key)
+                # 之后的运行中原文可能没有登记，按文档的缓存保存原文
+                save_cache(doc_fingerprints[key], documents, externalize=False)
             except Exception as e:
-                logging.error(f"运行{key}错误：" + str(e))
+                logging.error(f"缓存{worker}的文档{key}错误：" + str(e))
+
+    def untrack_documents(self, worker) -> None:
+        # 只读取了部分文件时，无法合并的结果不完整，不保存
+        if self.partial_input:
+            logging.error(f"{worker}的结果无法按文档对应输入文件，增量运行只能得到部分结果，请关闭INCREMENTAL")
+            raise ValueError(f"{worker}的结果无法按文档对应输入文件")
+        self.workers_dict[worker].pop('doc_keys', None)
+        self.workers_dict[worker].pop('doc_order', None)
+        self.workers_dict[worker]['complete'] = True
+        logging.warning(f"{worker}的结果无法按文档对应输入文件，保存全部结果")
+
+    def finish_incremental(self, manifests, failed) -> None:
+        # 全部成功后才写入清单与按文档计算指纹的基础，失败时保留快照，下次运行重新处理同样的文件
+        from src.incremental import remove_snapshot, save_base_fingerprints
+
+        if not manifests:
+            return
+        if failed:
+            logging.warning(f"{sorted(failed)}运行失败，增量清单未更新")
+            return
+        for manifest in manifests.values():
+            manifest.commit()
+        if self.base_fingerprints:
+            save_base_fingerprints(self.get_save_dir(), self.base_fingerprints)
+        remove_snapshot(self.get_save_dir())
+        logging.info("增量清单已更新")
+
+    def run_all_stream(self, queue_size: int = None) -> dict:
+        """
+        流式运行全部worker，各worker同时运行并通过有界队列逐项传递数据
+        流式模式下只保留需要保存的结果和末端worker的结果
+        :param queue_size: 队列长度，默认读取环境变量STREAM_QUEUE_SIZE
+        :return: workers_dict
+        """
+        from src.stream import run_stream
+
+        if os.getenv('INCREMENTAL') == 'true':
+            logging.warning("流式运行不支持INCREMENTAL，将处理全部文件")
+        if queue_size is None:
+            queue_size = int(os.getenv('STREAM_QUEUE_SIZE', default='64'))
+        run_stream(self, queue_size=max(queue_size, 1))
+        self.wait_saves()
+        self.export_trace()
         logging.info(f"已全部运行完成")
         return self.workers_dict
 
-    @staticmethod
-    def preprocess_results(results) -> list:
-        # 处理整个列表，确保每个元素都被转换
-        processed_results = []
-        for sublist in results:
-            # 创建一个新的子列表以存储处理后的元素
-            new_sublist = []
-            for item in sublist:
-                if isinstance(item, tuple):
-                    # 转换元组中的每一个元素
-                    processed_item = []
-                    for subitem in item:
-                        if isinstance(subitem, Exception):
-                            exception_type = type(subitem).__name__
-                            processed_item.append({str(exception_type): str(subitem)})
-                        else:
-                            processed_item.append(subitem)
-                    new_sublist.append(processed_item)
-                elif isinstance(item, list):
-                    # 同样需要检查列表中的每个元素
-                    processed_list = []
-                    for list_item in item:
-                        if isinstance(list_item, Exception):
-                            exception_type = type(list_item).__name__
-                            processed_list.append({str(exception_type): str(list_item)})
-                        else:
-                            processed_list.append(list_item)
-                    new_sublist.append(processed_list)
-                elif isinstance(item, Exception):
-                    exception_type = type(item).__name__
-                    new_sublist.append({str(exception_type): str(item)})
-                else:
-                    new_sublist.append(item)
-            processed_results.append(new_sublist)
-        return processed_results
+    def run_all(self, max_parallel: int = None) -> dict:
+        """
+        按依赖图调度运行全部worker，依赖已完成的worker并行运行
+        :param max_parallel: 最大并行数，默认读取环境变量MAX_PARALLEL
+        :return: workers_dict
+        """
+        if os.getenv('STREAM_MODE') == 'true':
+            return self.run_all_stream()
+
+        if max_parallel is None:
+            max_parallel = int(os.getenv('MAX_PARALLEL', default='1'))
+        max_parallel = max(max_parallel, 1)
+
+        graph = self.build_dependency_graph()
+        if self.demands is None:
+            self.demands = self.compute_demands()
+        manifests = self.prepare_incremental(graph)
+        order = {worker: index for index, worker in enumerate(graph)}
+        consumers = {worker: [] for worker in graph}
+        for worker, dependencies in graph.items():
+            for dependency in dependencies:
+                consumers[dependency].append(worker)
+
+        remaining = {worker: len(dependencies) for worker, dependencies in graph.items()}
+        unconsumed = {worker: len(consumers[worker]) for worker in graph}
+        release_results = os.getenv('RELEASE_RESULTS', default='true') == 'true'
+        ready = [worker for worker in graph if remaining[worker] == 0]
+        failed = set()
+        running = {}
+
+        def finish(finished_worker):
+            # 更新下游worker的依赖计数，上游失败的worker直接跳过
+            stack = [finished_worker]
+            while stack:
+                current = stack.pop()
+                if release_results:
+                    # 上游结果的最后一个下游已完成时释放上游结果
+                    self.workers_dict[current].pop('data', None)
+                    for dependency in graph[current]:
+                        unconsumed[dependency] -= 1
+                        if unconsumed[dependency] == 0:
+                            self.release(dependency)
+                for consumer in consumers[current]:
+                    remaining[consumer] -= 1
+                    if remaining[consumer] > 0:
+                        continue
+                    failed_sources = [d for d in graph[consumer] if d in failed]
+                    if failed_sources:
+                        logging.error(f"跳过{consumer}：上游{failed_sources}运行失败")
+                        failed.add(consumer)
+                        stack.append(consumer)
+                    else:
+                        ready.append(consumer)
+            ready.sort(key=order.get)
+
+        with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+            while ready or running:
+                while ready and len(running) < max_parallel:
+                    worker = ready.pop(0)
+                    running[executor.submit(self.run, worker)] = worker
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    worker = running.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logging.error(f"运行{worker}错误：" + str(e))
+                        failed.add(worker)
+                    finish(worker)
+
+        self.wait_saves()
+        self.unshare_results()
+        self.finish_incremental(manifests, failed)
+        self.export_trace()
+        logging.info(f"已全部运行完成")
+        return self.workers_dict
 
     def save_result(self, worker) -> None:
-        save_dir = os.getenv('SAVE_DIR')
+        """
+        保存worker的结果，格式由RESULT_STORE决定，开启ASYNC_SAVE时在后台线程写入
+        """
+        from src.store import get_result_store, build_ref_index, register_base_texts
+        from src.trace import get_worker_trace
+
+        save_dir = self.get_save_dir()
         if not os.path.exists(save_dir):
             os.makedirs(save_dir)
 
         results = self.workers_dict[worker]['results']
-        preprocess_results = self.preprocess_results(results)
-        save_path = os.path.join(save_dir, f"{worker}.json")
-        with open(save_path, 'w', encoding='utf-8') as f:
-            json.dump(preprocess_results, f, ensure_ascii=False, indent=4)
-        logging.info(f"{worker}结果已保存至{save_dir}")
+        store_name = os.getenv('RESULT_STORE', default='jsonl')
+        store = get_result_store(store_name)
+        compress = os.getenv('RESULT_COMPRESS', default='none')
+
+        # 已保存的上游结果可以被引用，下游不再重复保存相同的文本
+        # 增量运行时结果与上一次的结果合并，文档位置会变化，不能使用按位置的引用
+        # 切分得到的片段（SpanArray等）只保存已保存原文的引用与范围
+        ref_sources = {}
+        base_refs = None
+        doc_keys = self.workers_dict[worker].get('doc_keys')
+        if store_name == 'jsonl' and self.workers_dict[worker].get('doc_order') is None:
+            for source_name, _, _ in self.get_sources(worker):
+                if self.should_save(source_name) and 'results' in self.workers_dict[source_name]:
+                    ref_sources[source_name] = self.workers_dict[source_name]['results']
+            with self.save_lock:
+                register_base_texts(self.base_refs, worker, results)
+            base_refs = self.base_refs
+
+        def write():
+            with get_worker_trace(worker).span('save', lane=f"{worker}/save"):
+                ref_index = build_ref_index(ref_sources) if ref_sources else None
+                if doc_keys is None:
+                    save_path = store(os.path.join(save_dir, worker), results, compress=compress,
+                                      ref_index=ref_index, base_refs=base_refs)
+                else:
+                    save_path = self.save_merged(worker, store, compress, doc_keys, results)
+            logging.info(f"{worker}结果已保存至{save_path}")
+
+        if os.getenv('ASYNC_SAVE', default='true') == 'true':
+            with self.save_lock:
+                self.save_futures.append((worker, self.save_executor.submit(write)))
+        else:
+            write()
+
+    def save_merged(self, worker, store, compress, doc_keys, results) -> str:
+        """
+        增量运行时将本次结果与上一次保存的结果按文档合并后保存，同时保存每个文档对应的文件
+        """
+        from src.incremental import load_previous, merge_documents, save_keys
+
+        save_dir = self.get_save_dir()
+        old_keys, old_results = load_previous(save_dir, worker)
+        keys, merged = merge_documents(self.workers_dict[worker]['doc_order'], doc_keys, results,
+                                       old_keys, old_results)
+        save_path = store(os.path.join(save_dir, worker), merged, compress=compress)
+        save_keys(save_dir, worker, keys)
+        logging.info(f"{worker}本次处理{len(results)}个文档，合并后共{len(merged)}个文档")
+        return save_path
+
+    def wait_saves(self) -> None:
+        """
+        等待后台保存全部完成
+        """
+        with self.save_lock:
+            save_futures, self.save_futures = self.save_futures, []
+            self.base_refs = {}
+        for worker, future in save_futures:
+            try:
+                future.result()
+            except Exception as e:
+                logging.error(f"保存{worker}结果错误：" + str(e))
+
+    def export_trace(self) -> None:
+        """
+        开启TRACE时将运行记录与汇总表保存到项目保存目录
+        """
+        if self.tracer is None:
+            return
+        try:
+            self.tracer.export(self.get_save_dir())
+        except Exception as e:
+            logging.error("保存运行记录错误：" + str(e))
 
     def save_results(self) -> None:
         save_dir = self.builders_args.get('SAVE_ROOT', DEFAULT_CONFIG_DICT['SAVE_ROOT'])
@@ -245,6 +903,8 @@ class LingData:
             os.makedirs(save_dir)
 
         for key in self.workers_dict:
+            if 'results' not in self.workers_dict[key]:
+                continue
             results = self.workers_dict[key]['results']
             save_path = os.path.join(save_dir, f"{key}.json")
             with open(save_path, 'w', encoding='utf-8') as f:
@@ -264,7 +924,7 @@ class LingData:
 
     def mk_dir(self, save_result: bool = False) -> None:
 
-        save_dir = self.builders_args.get('SAVE_ROOT', DEFAULT_CONFIG_DICT['SAVE_ROOT'])
+        save_dir = self.get_save_root()
         save_args = os.getenv('SAVE_ARGS', default='true').lower() == 'true'
         save_results = os.getenv('SAVE_RESULTS', default='true').lower() == 'true'
 
@@ -274,7 +934,7 @@ class LingData:
             if not os.path.exists(dir_path):
                 os.makedirs(dir_path)
             else:
-                if os.getenv('OVERWRITE') == 'true':
+                if os.getenv('OVERWRITE') == 'true' or os.getenv('INCREMENTAL') == 'true':
                     os.environ['SAVE_DIR'] = dir_path
                 else:
                     logging.warning(f"{dir_path}已存在。请设置OVERWRITE为true以覆盖")
@@ -1,82 +1,589 @@
-import re
-from langdetect import detect
+import bz2
+import codecs
+import gzip
+import io
+import json
+import logging
+import lzma
 import os
-from src.tools import show_log_base
+import posixpath
+import zipfile
+from fnmatch import fnmatch
+from functools import partial
+from html.parser import HTMLParser
 
+from src.shard import map_documents
+from src.tools import show_log_base, TextDocument
+
+
+FILE_SORT_KEYS = {
+    'name': lambda entry: entry[0],
+    'size': lambda entry: (entry[1], entry[0]),
+    'mtime': lambda entry: (entry[2], entry[0]),
+}
+
+
+def matches(path, root, patterns) -> bool:
+    # 模式可以匹配相对于目录的路径或文件名
+    relative_path = os.path.relpath(path, root).replace(os.sep, '/')
+    name = os.path.basename(path)
+    return any(fnmatch(relative_path, pattern) or fnmatch(name, pattern) for pattern in patterns)
+
+
+def scan_files(root):
+    """
+    用os.scandir遍历目录，DirEntry自带的文件信息避免逐个stat
+    :return: (路径, 大小, 修改时间)的生成器
+    """
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    yield entry.path, stat.st_size, stat.st_mtime_ns
+
+
+def make_filepath_list(file_path_list, include=None, exclude=None, min_size=None, max_size=None, sort='name'):
+    """
+    展开文件与目录为文件路径列表
+    :param file_path_list: 文件或目录的列表，按给出的顺序输出
+    :param include: 目录中只保留匹配其中任一glob模式的文件，如["*.txt"]
+    :param exclude: 排除匹配其中任一glob模式的文件
+    :param min_size: 目录中文件的最小字节数
+    :param max_size: 目录中文件的最大字节数
+    :param sort: 目录中文件的顺序：name、size、mtime，none为遍历顺序
+    :return: 文件路径列表
+    """
+    if sort != 'none' and sort not in FILE_SORT_KEYS:
+        raise ValueError(f"Invalid sort type: {sort}")
 
-def make_filepath_list(file_path_list):
-    # 初始化一个列表来存储文件路径
     file_paths = []
     for file_path in file_path_list:
         if os.path.isdir(file_path):
-            # 使用os.walk()遍历目录
-            for root, dirs, files in os.walk(file_path):
-                for file in files:
-                    # 使用os.path.join()拼接完整的文件路径
-                    full_path = os.path.join(root, file)
-                    file_paths.append(full_path)
+            entries = []
+            for entry in scan_files(file_path):
+                if include and not matches(entry[0], file_path, include):
+                    continue
+                if exclude and matches(entry[0], file_path, exclude):
+                    continue
+                if min_size is not None and entry[1] < min_size:
+                    continue
+                if max_size is not None and entry[1] > max_size:
+                    continue
+                entries.append(entry)
+            if sort != 'none':
+                entries.sort(key=FILE_SORT_KEYS[sort])
+            file_paths.extend(entry[0] for entry in entries)
         elif os.path.isfile(file_path):
+            # 直接给出的文件不受过滤条件影响
             file_paths.append(file_path)
     return file_paths
 
 
-def count_words(text, language):
+def get_file_list(worker_dict) -> list:
+    args = worker_dict['args']
+    file_path_list = args['file_path']
+
+    if type(file_path_list) is str:
+        file_path_list = [file_path_list]
+
+    include = args.get('include')
+    exclude = args.get('exclude')
+    file_paths = make_filepath_list(
+        file_path_list,
+        include=[include] if type(include) is str else include,
+        exclude=[exclude] if type(exclude) is str else exclude,
+        min_size=args.get('min_size'),
+        max_size=args.get('max_size'),
+        sort=args.get('sort', 'name'),
+    )
+
+    # 增量运行时只读取新增或改动的文件
+    only_files = worker_dict.get('only_files')
+    if only_files is not None:
+        only_files = set(only_files)
+        file_paths = [file_path for file_path in file_paths if file_path in only_files]
+    return file_paths
+
+
+# str.split()视为空白的全部字符
+WHITESPACE_CODES = [*range(0x09, 0x0e), *range(0x1c, 0x21), 0x85, 0xa0, 0x1680, *range(0x2000, 0x200b),
+                    0x2028, 0x2029, 0x202f, 0x205f, 0x3000]
+
+
+def run_starts(mask, in_run: bool) -> int:
+    # mask中连续为True的段数，in_run表示上一块是否以True结束
+    if len(mask) == 0:
+        return 0
+    return int(mask[0] and not in_run) + int((mask[1:] & ~mask[:-1]).sum())
+
+
+class CorpusStats:
+    """
+    文本统计：字符数、汉字数、假名数、英文单词数、按空白分割的词数、行数与UTF-8字节数
+    按码点数组向量化计算，可以逐块累加，块的边界可以在任意位置
+    """
+    BLOCK_SIZE = 1 << 20
+
+    def __init__(self):
+        self.chars = 0
+        self.cjk = 0
+        self.kana = 0
+        self.latin_words = 0
+        self.words = 0
+        self.newlines = 0
+        self.utf8_bytes = 0
+        self._in_latin = False
+        self._in_word = False
+        self._ends_with_newline = False
+
+    def update(self, text) -> 'CorpusStats':
+        for start in range(0, len(text), self.BLOCK_SIZE):
+            self._update_block(text[start:start + self.BLOCK_SIZE])
+        return self
+
+    def _update_block(self, block) -> None:
+        import numpy as np
+
+        codes = np.frombuffer(block.encode('utf-32-le', errors='surrogatepass'), dtype=np.uint32)
+        lower = codes | 0x20
+        latin = ((lower >= 0x61) & (lower <= 0x7a)) | ((codes >= 0x30) & (codes <= 0x39)) | (codes == 0x5f)
+        word = ~np.isin(codes, WHITESPACE_CODES)
+
+        self.chars += len(codes)
+        self.cjk += int(np.count_nonzero((codes >= 0x4e00) & (codes <= 0x9fff)))
+        self.kana += int(np.count_nonzero((codes >= 0x3040) & (codes <= 0x30ff)))
+        self.newlines += int(np.count_nonzero(codes == 0x0a))
+        self.utf8_bytes += len(codes) + int(np.count_nonzero(codes >= 0x80)) + \
+            int(np.count_nonzero(codes >= 0x800)) + int(np.count_nonzero(codes >= 0x10000))
+        self.latin_words += run_starts(latin, self._in_latin)
+        self.words += run_starts(word, self._in_word)
+
+        self._in_latin = bool(latin[-1])
+        self._in_word = bool(word[-1])
+        self._ends_with_newline = bool(codes[-1] == 0x0a)
+
+    def result(self) -> dict:
+        return {
+            'chars': self.chars,
+            'cjk': self.cjk,
+            'kana': self.kana,
+            'latin_words': self.latin_words,
+            'words': self.words,
+            'lines': self.newlines + int(self.chars > 0 and not self._ends_with_newline),
+            'utf8_bytes': self.utf8_bytes,
+        }
+
+
+def corpus_stats(text) -> dict:
+    return CorpusStats().update(text).result()
+
+
+def words_for_language(stats: dict, language) -> int:
     # 增加对日语的支持
     if language in ['zh-cn', 'zh-tw']:
-        # 中文：计算汉字数量
-        count = sum(1 for char in text if '\u4e00' <= char <= '\u9fff')
+        # 中文：汉字数量
+        return stats['cjk']
     elif language == 'en':
-        # 英文：使用正则表达式匹配英文单词
-        words = re.findall(r'\b\w+\b', text)
-        count = len(words)
+        # 英文：英文单词数量
+        return stats['latin_words']
     elif language == 'ja':
-        # 日语：计算假名、片假名和汉字的数量
-        count = sum(1 for char in text if '\u3040' <= char <= '\u30ff' or '\u4e00' <= char <= '\u9fff')
+        # 日语：假名、片假名和汉字的数量
+        return stats['cjk'] + stats['kana']
     else:
-        # 其他语言：简单按空格分割计算“单词”数
-        words = text.split()
-        count = len(words)
-    return count
+        # 其他语言：按空白分割的“单词”数
+        return stats['words']
+
+
+def count_words(text, language):
+    return words_for_language(corpus_stats(text), language)
+
+
+ENCODING_SAMPLE_SIZE = 1 << 16  # 识别编码读取的字节数
+LANGUAGE_SAMPLE_SIZE = 10000  # 识别语言使用的字符数
+READ_CHUNK_SIZE = 1 << 16  # 流式读取时每次读取的字符数
+
+# 依次尝试的编码，gb18030兼容gbk与gb2312
+CANDIDATE_ENCODINGS = ['utf-8', 'gb18030']
+
+BOM_ENCODINGS = [
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
 
 
-def txt_reader(txt_path):
+def open_zstd(path):
     try:
-        with open(txt_path, 'r', encoding='utf-8') as file:
+        import zstandard
+    except ImportError:
+        raise ImportError("读取.zst文件需要安装zstandard：pip install zstandard")
+    return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True))
+
+
+# 按后缀选择解压方式，解压在读取时逐块进行
+COMPRESSED_OPENERS = {
+    '.gz': gzip.open,
+    '.xz': lzma.open,
+    '.bz2': bz2.open,
+    '.zst': open_zstd,
+}
+
+
+def open_binary(path):
+    opener = COMPRESSED_OPENERS.get(os.path.splitext(path)[1].lower())
+    if opener is None:
+        return open(path, 'rb')
+    return opener(path)
+
+
+def open_text(path, encoding):
+    return io.TextIOWrapper(open_binary(path), encoding=encoding)
+
+
+def detect_encoding(txt_path, candidates=None) -> str:
+    """
+    根据文件开头的BOM与一段样本识别编码，压缩文件按解压后的内容识别
+    :param txt_path: 文件路径
+    :param candidates: 依次尝试的编码，默认为CANDIDATE_ENCODINGS
+    :return: 编码名称
+    """
+    with open_binary(txt_path) as file:
+        sample = file.read(ENCODING_SAMPLE_SIZE)
+    return detect_sample_encoding(sample, txt_path, candidates)
+
+
+def detect_sample_encoding(sample: bytes, name, candidates=None) -> str:
+    for bom, encoding in BOM_ENCODINGS:
+        if sample.startswith(bom):
+            return encoding
+    for encoding in candidates or CANDIDATE_ENCODINGS:
+        try:
+            # 样本末尾可能截断了多字节字符，不作为错误
+            codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+            return encoding
+        except UnicodeDecodeError:
+            continue
+    raise ValueError(f"无法识别{name}的编码，请在args中设置encoding")
+
+
+def detect_language(text) -> str:
+    from langdetect import DetectorFactory, detect
+    from langdetect.lang_detect_exception import LangDetectException
+
+    DetectorFactory.seed = 0  # 固定随机种子，同样的文本结果一致
+    try:
+        return detect(text[:LANGUAGE_SAMPLE_SIZE])
+    except LangDetectException:
+        return 'unknown'
+
+
+def file_meta(txt_path, encoding, language, stats: CorpusStats) -> dict:
+    result = stats.result()
+    return {
+        'path': txt_path,
+        'encoding': encoding,
+        'language': language,
+        'file_bytes': os.path.getsize(txt_path),
+        'word_count': words_for_language(result, language),
+        **result,
+    }
+
+
+def log_stats(meta: dict) -> None:
+    logging.info(f"{meta['path']}：编码{meta['encoding']}，主要语言{meta['language']}，字数{meta['word_count']}")
+
+
+def txt_reader(txt_path, encoding='auto', stats=False):
+    """
+    读取整个文本文件，.gz、.xz、.bz2、.zst文件边读取边解压
+    :param txt_path: 文件路径
+    :param encoding: 文件编码，auto为自动识别
+    :param stats: 是否统计语言与字数
+    :return: (文本, 元数据)，不统计时元数据为None
+    :raises ValueError: 无法识别编码
+    :raises UnicodeDecodeError: 文件内容与编码不符
+    """
+    try:
+        if encoding == 'auto':
+            encoding = detect_encoding(txt_path)
+        with open_text(txt_path, encoding) as file:
             content = file.read()
-            language = detect(content)
-            count = count_words(content, language)
 
-            # show_log = os.getenv('SHOW_LOG', default='true')
-            # if show_log == 'true':
-            #     separator = os.getenv('SEPERATOR', default="⫘") * 50
-            #     print(f"{separator}\n文件主要语言识别为：{language}")
-            #     print(f"文件字数为：{count}\n''\n{separator}")
+        meta = None
+        if stats:
+            meta = file_meta(txt_path, encoding, detect_language(content), CorpusStats().update(content))
+            log_stats(meta)
 
-            return content, count
+        return content, meta
     except Exception as e:
-        print("发生错误：", e)
-        return None
+        # 不跳过读取失败的文件，避免之后的结果悄悄缺少文档
+        logging.error(f"读取{txt_path}错误：" + str(e))
+        raise
+
+
+def get_reader_args(worker_dict):
+    args = worker_dict.get('args') or {}
+    return {
+        'encoding': args.get('encoding', 'auto'),
+        'stats': str(args.get('stats', False)).lower() == 'true',
+    }
+
+
+def get_read_workers(worker_dict) -> int:
+    # worker参数中的read_workers优先，其次为环境变量READ_WORKERS
+    read_workers = worker_dict.get('read_workers')
+    if read_workers is None:
+        read_workers = os.getenv('READ_WORKERS', default='4')
+    return max(int(read_workers), 1)
 
 
 def reader_txt(worker_dict):
     results = []
-    file_path_list = worker_dict['args']['file_path']
+    file_path_list = get_file_list(worker_dict)
 
-    if type(file_path_list) is str:
-        file_path_list = [file_path_list]
+    read = partial(txt_reader, **get_reader_args(worker_dict))
 
-    file_path_list = make_filepath_list(file_path_list)
+    # 每个文件一个分片；不分片时用线程并发读取
+    for content, meta in map_documents(worker_dict, read, file_path_list, threads=get_read_workers(worker_dict)):
+        # 开启stats时，统计结果作为元数据随文本一起保存
+        results.append(content if meta is None else TextDocument(content, meta))
 
-    for file_path in file_path_list:
-        results.append(txt_reader(file_path)[0])
+    show_log_base(worker_dict, results[0][0:100], worker_dict['name'])
+
+    return results
+
+
+def iter_txt_chunks(txt_path, encoding='auto', stats=False, chunk_size=READ_CHUNK_SIZE):
+    """
+    分块读取文本文件，内存占用与文件大小无关
+    :param txt_path: 文件路径
+    :param encoding: 文件编码，auto为自动识别
+    :param stats: 是否统计语言与字数（语言由第一块识别，字数逐块累加）
+    :param chunk_size: 每块的字符数
+    :return: 文本块的生成器，块的边界与行无关
+    """
+    if encoding == 'auto':
+        encoding = detect_encoding(txt_path)
+    language = None
+    stats_counter = CorpusStats()
+    with open_text(txt_path, encoding) as file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                break
+            if stats:
+                if language is None:
+                    language = detect_language(chunk)
+                stats_counter.update(chunk)
+            yield chunk
+    if stats:
+        log_stats(file_meta(txt_path, encoding, language, stats_counter))
+
+
+def reader_txt_stream(worker_dict):
+    reader_args = get_reader_args(worker_dict)
+
+    for file_path in get_file_list(worker_dict):
+        yield iter_txt_chunks(file_path, **reader_args)
+
+
+def get_field(record, field):
+    # field可以用.访问嵌套字段，如meta.text
+    for key in field.split('.'):
+        if not isinstance(record, dict):
+            return None
+        record = record.get(key)
+    return record
+
+
+def iter_jsonl_texts(jsonl_path, field='text'):
+    """
+    逐行读取JSONL文件（可以是压缩文件），输出每条记录中指定字段的文本
+    :param jsonl_path: 文件路径
+    :param field: 文本字段名
+    :return: 文本的生成器，缺少该字段的记录跳过
+    """
+    skipped = 0
+    with open_text(jsonl_path, 'utf-8-sig') as file:
+        for line in file:
+            if not line.strip():
+                continue
+            text = get_field(json.loads(line), field)
+            if text is None:
+                skipped += 1
+                continue
+            yield text if isinstance(text, str) else json.dumps(text, ensure_ascii=False)
+    if skipped:
+        logging.warning(f"{jsonl_path}中有{skipped}条记录没有字段{field}，已跳过")
+
+
+def read_jsonl_texts(jsonl_path, field='text') -> list:
+    return list(iter_jsonl_texts(jsonl_path, field))
+
+
+def get_jsonl_field(worker_dict):
+    args = worker_dict.get('args') or {}
+    return args.get('field', 'text')
+
+
+def reader_jsonl(worker_dict):
+    # 每条记录是一个文档
+    results = []
+    read = partial(read_jsonl_texts, field=get_jsonl_field(worker_dict))
+
+    file_path_list = get_file_list(worker_dict)
+
+    for file_path, texts in zip(file_path_list, map_documents(worker_dict, read, file_path_list,
+                                                              threads=get_read_workers(worker_dict))):
+        if worker_dict.get('only_files') is not None:
+            # 增量运行时记录每条记录所属的文件，用于按文件合并结果
+            texts = [TextDocument(text, {'path': file_path}) for text in texts]
+        results.extend(texts)
+
+    show_log_base(worker_dict, results[0][0:100], worker_dict['name'])
+
+    return results
+
+
+def reader_jsonl_stream(worker_dict):
+    field = get_jsonl_field(worker_dict)
+
+    for file_path in get_file_list(worker_dict):
+        for text in iter_jsonl_texts(file_path, field):
+            yield iter([text])
+
+
+class HTMLText(HTMLParser):
+    """
+    提取(X)HTML中的正文，块级元素之间换行
+    """
+    BLOCK_TAGS = {'p', 'div', 'br', 'li', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'section', 'blockquote'}
+    SKIP_TAGS = {'head', 'script', 'style'}
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP_TAGS:
+            self.skip += 1
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP_TAGS:
+            self.skip = max(self.skip - 1, 0)
+        elif tag in self.BLOCK_TAGS:
+            self.parts.append('\n')
+
+    def handle_data(self, data):
+        if not self.skip:
+            self.parts.append(data)
+
+    def text(self) -> str:
+        lines = (line.strip() for line in ''.join(self.parts).split('\n'))
+        return '\n'.join(line for line in lines if line)
+
+
+def html_to_text(html) -> str:
+    parser = HTMLText()
+    parser.feed(html)
+    parser.close()
+    return parser.text()
+
+
+HTML_SUFFIXES = ('.html', '.htm', '.xhtml')
+ARCHIVE_TEXT_SUFFIXES = ('.txt',) + HTML_SUFFIXES
+
+
+def epub_spine(archive: zipfile.ZipFile) -> list | None:
+    """
+    按EPUB的spine顺序列出章节文件，不是EPUB时返回None
+    """
+    import xml.etree.ElementTree as ElementTree
+
+    if 'META-INF/container.xml' not in archive.namelist():
+        return None
+    container = ElementTree.fromstring(archive.read('META-INF/container.xml'))
+    rootfile = container.find('.//{*}rootfile')
+    if rootfile is None:
+        return None
+    opf_path = rootfile.get('full-path')
+    opf = ElementTree.fromstring(archive.read(opf_path))
+    manifest = {item.get('id'): item.get('href') for item in opf.iterfind('.//{*}manifest/{*}item')}
+    opf_dir = posixpath.dirname(opf_path)
+    return [posixpath.normpath(posixpath.join(opf_dir, manifest[itemref.get('idref')]))
+            for itemref in opf.iterfind('.//{*}spine/{*}itemref') if itemref.get('idref') in manifest]
+
+
+def iter_archive_texts(archive_path, encoding='auto'):
+    """
+    逐个章节读取EPUB或zip压缩包，一次只解压一个章节
+    EPUB按spine顺序，zip按文件名顺序读取其中的txt与html文件
+    :param archive_path: 压缩包路径
+    :param encoding: txt章节的编码，auto为自动识别；html章节按utf-8读取
+    :return: 章节文本的生成器，章节之间以换行分隔
+    """
+    with zipfile.ZipFile(archive_path) as archive:
+        names = epub_spine(archive)
+        if names is None:
+            names = sorted(name for name in archive.namelist() if name.lower().endswith(ARCHIVE_TEXT_SUFFIXES))
+        for index, name in enumerate(names):
+            with archive.open(name) as member:
+                raw = member.read()
+            if name.lower().endswith(HTML_SUFFIXES):
+                text = html_to_text(raw.decode('utf-8', errors='replace'))
+            else:
+                member_encoding = encoding
+                if member_encoding == 'auto':
+                    member_encoding = detect_sample_encoding(raw[:ENCODING_SAMPLE_SIZE], f"{archive_path}:{name}")
+                text = raw.decode(member_encoding)
+            yield text if index == 0 else '\n' + text
+
+
+def read_archive_text(archive_path, encoding='auto') -> str:
+    return ''.join(iter_archive_texts(archive_path, encoding))
+
+
+def reader_archive(worker_dict):
+    # 每个压缩包是一个文档
+    encoding = get_reader_args(worker_dict)['encoding']
+    read = partial(read_archive_text, encoding=encoding)
+    results = map_documents(worker_dict, read, get_file_list(worker_dict), threads=get_read_workers(worker_dict))
 
     show_log_base(worker_dict, results[0][0:100], worker_dict['name'])
 
     return results
 
 
-READER = {"reader_txt": reader_txt}
+def reader_archive_stream(worker_dict):
+    encoding = get_reader_args(worker_dict)['encoding']
+
+    for file_path in get_file_list(worker_dict):
+        yield iter_archive_texts(file_path, encoding)
+
+
+READER = {
+    "reader_txt": reader_txt,
+    "reader_jsonl": reader_jsonl,
+    "reader_archive": reader_archive,
+}
+
+READER_STREAM = {
+    "reader_txt": reader_txt_stream,
+    "reader_jsonl": reader_jsonl_stream,
+    "reader_archive": reader_archive_stream,
+}
 
 
 def get_reader(reader_name):
     return READER[reader_name]
+
+
+def get_reader_stream(reader_name):
+    return READER_STREAM[reader_name]
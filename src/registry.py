@@ -0,0 +1,115 @@
+# Registry.py
+# 处理器类型到模块的映射。模块在该类型的worker实际运行时才导入，
+# 只校验配置或不使用某类处理器时，不会导入langdetect、openai等依赖。
+import importlib
+import logging
+import os
+import subprocess
+import sys
+import threading
+
+# 类型前缀: (模块, 批处理查找函数, 流式查找函数)
+PROCESSOR_MODULES = {
+    'reader': ('src.reader', 'get_reader', 'get_reader_stream'),
+    'spliter': ('src.spliter', 'get_spliter', 'get_spliter_stream'),
+    'llm': ('src.llm', 'get_llm_processor', 'get_llm_stream_processor'),
+    'dataset': ('src.dataset', 'get_dataset_builder', 'get_dataset_stream_builder'),
+    'custom': ('src.custom', 'get_custom_processor', 'get_custom_stream_processor'),
+    'transformer': ('src.transformer', 'get_transformer', 'get_transformer_stream'),
+}
+
+# 类型前缀: 模块中注册的全部类型，与各模块的处理器字典保持一致，读取参数时不导入模块即可校验类型
+# 自定义处理器由用户在custom.py中注册，为None时运行时才校验
+PROCESSOR_TYPES = {
+    'reader': ('reader_txt', 'reader_jsonl', 'reader_archive'),
+    'spliter': ('spliter_chapter', 'spliter_len', 'spliter_distribution'),
+    'llm': ('llm_001',),
+    'dataset': ('dataset_sharegpt',),
+    'custom': None,
+    'transformer': ('transformer_id', 'transformer_spliter_chapter_spliter', 'transformer_llm_001_dataset'),
+}
+
+
+def get_processor_module(processor_type) -> tuple:
+    prefix = processor_type.split('_')[0]
+    if prefix not in PROCESSOR_MODULES:
+        raise KeyError(f"未注册{processor_type}")
+    if PROCESSOR_TYPES[prefix] is not None and processor_type not in PROCESSOR_TYPES[prefix]:
+        raise KeyError(f"未注册{processor_type}，{prefix}类型有{list(PROCESSOR_TYPES[prefix])}")
+    return PROCESSOR_MODULES[prefix]
+
+
+def resolve_processor(processor_type, stream=False) -> callable:
+    """
+    导入处理器所在模块并查找处理器
+    :param processor_type: 处理器类型，如spliter_len
+    :param stream: 是否查找流式处理器
+    :return: 处理器函数，未注册时抛出KeyError
+    """
+    module_name, getter, stream_getter = get_processor_module(processor_type)
+    module = importlib.import_module(module_name)
+    return getattr(module, stream_getter if stream else getter)(processor_type)
+
+
+class LazyProcessor:
+    """
+    延迟导入的处理器，第一次调用时才导入模块
+    """
+
+    def __init__(self, processor_type):
+        get_processor_module(processor_type)  # 类型未注册时立即报错
+        self.processor_type = processor_type
+        self._processor = None
+        self._lock = threading.Lock()
+
+    def resolve(self) -> callable:
+        if self._processor is None:
+            with self._lock:
+                if self._processor is None:
+                    try:
+                        self._processor = resolve_processor(self.processor_type)
+                    except Exception as e:
+                        logging.error(f"读取{self.processor_type}错误：" + str(e))
+                        raise
+        return self._processor
+
+    def __call__(self, worker_dict):
+        return self.resolve()(worker_dict)
+
+    def __repr__(self):
+        return f"LazyProcessor({self.processor_type!r})"
+
+    def __reduce__(self):
+        return LazyProcessor, (self.processor_type,)
+
+
+def measure_import_time(processor_types=None) -> dict:
+    """
+    在独立的解释器中测量每类处理器模块的导入耗时（秒），不受当前进程已导入模块的影响
+    :param processor_types: 类型前缀列表，默认为全部
+    :return: 字典，键为类型前缀，值为导入耗时
+    """
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = ("import importlib, sys, time\n"
+            "t = time.perf_counter()\n"
+            "importlib.import_module(sys.argv[1])\n"
+            "print(time.perf_counter() - t)")
+    timings = {}
+    for prefix in processor_types or PROCESSOR_MODULES:
+        if prefix not in PROCESSOR_MODULES:
+            raise KeyError(f"未注册{prefix}")
+        module_name = PROCESSOR_MODULES[prefix][0]
+        completed = subprocess.run([sys.executable, '-c', code, module_name], cwd=project_root,
+                                   capture_output=True, text=True)
+        if completed.returncode != 0:
+            logging.error(f"导入{module_name}错误：" + completed.stderr.strip().splitlines()[-1])
+            timings[prefix] = None
+        else:
+            timings[prefix] = float(completed.stdout.strip())
+    return timings
+
+
+if __name__ == '__main__':
+    # python -m src.registry [类型前缀...]
+    for name, seconds in measure_import_time(sys.argv[1:]).items():
+        print(f"{name:<12} {'导入失败' if seconds is None else f'{seconds * 1000:.1f} ms'}")
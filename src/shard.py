@@ -0,0 +1,116 @@
+# Shard.py
+# 按文档分片，在进程池中并行运行CPU密集的处理（读取、切分章节、按长度切分等），结果按输入顺序合并。
+# 进程池使用spawn方式启动，避免在多线程调度中fork；同样大小的进程池在多个worker之间复用。
+import atexit
+import multiprocessing
+import os
+import pickle
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from src.tools import warm_tokenizers, document_texts, externalized_texts, share_texts, unshare_texts
+from src.trace import TokenCount
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_shard_workers(worker_dict) -> int:
+    """
+    worker的分片进程数，worker参数中的shard_workers优先，其次为环境变量SHARD_WORKERS，1为不分片，0为CPU核数
+    """
+    shard_workers = worker_dict.get('shard_workers')
+    if shard_workers is None:
+        shard_workers = os.getenv('SHARD_WORKERS', default='1')
+    shard_workers = int(shard_workers)
+    if shard_workers <= 0:
+        return os.cpu_count() or 1
+    return shard_workers
+
+
+def get_pool(max_workers: int, warmup: tuple = ()) -> ProcessPoolExecutor:
+    """
+    :param max_workers: 进程数
+    :param warmup: 子进程启动时预先加载的tokenizer名称
+    """
+    key = (max_workers, warmup)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = ProcessPoolExecutor(max_workers=max_workers,
+                                              mp_context=multiprocessing.get_context('spawn'),
+                                              initializer=warm_tokenizers if warmup else None,
+                                              initargs=warmup)
+        return _pools[key]
+
+
+@atexit.register
+def shutdown_pools() -> None:
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.shutdown()
+
+
+def _run_shared(func, counted, document):
+    # 在子进程中运行，结果中引用输入原文的片段只传回原文的键，token数随结果一起返回
+    counter = TokenCount() if counted else None
+    result = func(document, trace=counter) if counted else func(document)
+    with externalized_texts(document_texts(document)):
+        data = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+    return data, counter.tokens if counted else 0
+
+
+def map_documents(worker_dict, func, documents, trace=None, threads: int = 1, warmup: tuple = ()) -> list:
+    """
+    对每个文档运行func，开启分片时在进程池中运行，结果顺序与输入一致
+    :param worker_dict: worker参数，用于读取shard_workers
+    :param func: 单个文档的处理函数，必须可以被pickle（模块级函数或其partial）
+    :param documents: 文档列表，ResultView会按列表传给子进程
+    :param trace: 不为None时以trace参数传给func，用于统计token数
+    :param threads: 不分片时的线程数，适合读取文件等以IO为主的处理
+    :param warmup: func使用的tokenizer名称，分片时在子进程启动时加载
+    :return: 结果列表
+    """
+    documents = list(documents)
+    shard_workers = get_shard_workers(worker_dict)
+    if shard_workers <= 1 or len(documents) <= 1:
+        if trace is not None:
+            func = partial(func, trace=trace)
+        if threads > 1 and len(documents) > 1:
+            with ThreadPoolExecutor(max_workers=min(threads, len(documents))) as executor:
+                return list(executor.map(func, documents))
+        return [func(document) for document in documents]
+
+    return list(map_ordered(func, documents, shard_workers, trace=trace, warmup=warmup))
+
+
+def map_ordered(func, items, workers: int, trace=None, warmup: tuple = (), chunksize: int = 1):
+    """
+    对每项运行func，workers大于1时在进程池中运行，按输入顺序逐个产出结果
+    :param func: 单项的处理函数，workers大于1时必须可以被pickle
+    :param items: 可迭代对象，使用进程池时全部提交
+    :param workers: 进程数，不大于1时在当前进程中逐项运行
+    :param trace: 不为None时以trace参数传给func，用于统计token数
+    :param warmup: func使用的tokenizer名称，子进程启动时加载
+    :param chunksize: 每次传给子进程的项数，项很多且很小时可以减少通信
+    :return: 结果的生成器
+    """
+    if workers <= 1:
+        if trace is not None:
+            func = partial(func, trace=trace)
+        yield from map(func, items)
+        return
+
+    # 传回的片段重新指向主进程中的原文，保存时仍可以引用已保存的原文
+    items = list(items)
+    keys = share_texts(text for item in items for text in document_texts(item))
+    try:
+        pool = get_pool(workers, tuple(warmup))
+        for data, tokens in pool.map(partial(_run_shared, func, trace is not None), items, chunksize=chunksize):
+            if trace is not None:
+                trace.add_tokens(tokens)
+            yield pickle.loads(data)
+    finally:
+        unshare_texts(keys)
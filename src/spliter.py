@@ -1,195 +1,702 @@
+import hashlib
+import json
+import logging
+import math
 import re
+import statistics
+import zlib
+from bisect import bisect_left, bisect_right
+from functools import partial
+from itertools import accumulate, chain, islice, repeat
 
-import numpy as np
-import tiktoken
 import os
-from src.tools import show_log_base
+from src.tools import show_log_base, check_tokenizer, ChapterList, SpanArray, DEFAULT_TOKENIZER
+from src.shard import get_shard_workers, map_documents, map_ordered
+from src.trace import get_worker_trace, NULL_TRACE
+
+
+# 标题前的空白与冒号不影响是否匹配，不写入pattern，在全文上查找时避免对每段空白反复回溯
+DEFAULT_CHAPTER_PATTERN = r'(第?[0-9一二三四五六七八九十百千零壹两仨贰叁肆伍陆柒捌玖拾佰仟万]+)[:：、\-\s]*章[:：、\-\s]'
+
+
+def iter_lines(pieces):
+    """
+    将任意切分的文本片段重新按行输出
+    :param pieces: 文本片段的可迭代对象
+    :return: 逐行的生成器（不含换行符）
+    """
+    rest = ''
+    for piece in pieces:
+        lines = (rest + piece).split('\n')
+        rest = lines.pop()
+        yield from lines
+    if rest:
+        yield rest
+
+
+def iter_chapters(
+        lines,
+        pattern: str = None,
+):
+    """
+    Extract chapters line by line, yielding each chapter as soon as the next chapter title is found
+    :param lines: Iterable of text lines
+    :param pattern: Regular expression pattern to match chapter titles
+    :return: Generator of tuples containing chapter title and content
+    """
+    if pattern is None:
+        pattern = DEFAULT_CHAPTER_PATTERN
+
+    chapter_pattern = re.compile(pattern)
+
+    def raw_chapters():
+        current_chapter_title = None
+        chapter_contents = []
+        preface_contents = []
+
+        for line in lines:
+            line = line.strip()
+            if not line:
+                continue  # Skip empty lines
+            if chapter_pattern.search(line):
+                if current_chapter_title is not None:
+                    yield current_chapter_title, '\n'.join(chapter_contents)
+                elif preface_contents:
+                    # Lines before the first chapter form the preface
+                    yield "Preface", '\n'.join(preface_contents)
+                current_chapter_title = line  # Update the current chapter title
+                chapter_contents = []  # Reset the contents for the new chapter
+            elif current_chapter_title is not None:
+                chapter_contents.append(line)  # Append line to current chapter contents
+            else:
+                preface_contents.append(line)
+
+        if current_chapter_title is not None:
+            yield current_chapter_title, '\n'.join(chapter_contents)
+        elif preface_contents:
+            yield "Preface", '\n'.join(preface_contents)
+
+    chapters = raw_chapters()
+    first = next(chapters, None)
+    if first is None:
+        return
+    second = next(chapters, None)
+    if second is None:
+        # Only one block of text: treat it as the first chapter with an empty preface
+        yield 'Preface', ''
+        yield 'Chapter 1', first[1]
+        return
+    yield first
+    yield second
+    yield from chapters
+
+
+CHAPTER_INDEX_VERSION = 3  # 索引格式或标题识别规则改变时递增，已保存的索引随之失效
+
+
+def trim_span(text, start, end) -> tuple:
+    # 去除范围两端的空白，使span_text与逐行去除空白的结果相同
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+
+# 不含行首行尾锚点、单词边界与前后查找的pattern，在去除空白的行中匹配时在原文中也一定能找到，可以在全文上查找
+SEARCHABLE_PATTERN = re.compile(r'^(?:[^\\^$(]|\\[^AZbB]|\((?!\?[=!<]))*$').match
+
+
+def search_titles(raw_text, chapter_pattern):
+    """
+    在全文上查找候选标题：匹配中第一个非空白字符所在的行，整行去除空白后再次匹配以确认
+    :return: 生成器，每项为(标题, 行起始位置, 行结束位置)
+    """
+    pos = 0
+    while True:
+        match = chapter_pattern.search(raw_text, pos)
+        if match is None:
+            return
+        matched = match.group()
+        first = match.start() + len(matched) - len(matched.lstrip())
+        if first >= match.end():
+            first = match.start()
+        line_start = raw_text.rfind('\n', 0, first) + 1
+        line_end = raw_text.find('\n', first)
+        if line_end == -1:
+            line_end = len(raw_text)
+        title = raw_text[line_start:line_end].strip()
+        if title and chapter_pattern.search(title):
+            yield title, line_start, line_end
+        pos = line_end + 1
+
+
+def scan_titles(raw_text, chapter_pattern):
+    """
+    逐行去除空白后匹配，与iter_chapters相同，用于含锚点等的pattern（如^第.*章$）
+    :return: 生成器，每项为(标题, 行起始位置, 行结束位置)
+    """
+    line_start = 0
+    while line_start <= len(raw_text):
+        line_end = raw_text.find('\n', line_start)
+        if line_end == -1:
+            line_end = len(raw_text)
+        title = raw_text[line_start:line_end].strip()
+        if title and chapter_pattern.search(title):
+            yield title, line_start, line_end
+        line_start = line_end + 1
+
+
+def index_chapters(
+        raw_text: str,
+        pattern: str = None,
+        limit: int = None,
+):
+    """
+    在全文上查找章节标题，生成章节索引，结果与iter_chapters逐行识别相同
+    :param raw_text: Raw text to extract chapters from
+    :param pattern: Regular expression pattern to match chapter titles
+    :param limit: 只需要前limit项时，找到足够的标题后停止查找（None for all）
+    :return: 列表，每项为(标题, 正文起始位置, 正文结束位置)
+    """
+    if pattern is None:
+        pattern = DEFAULT_CHAPTER_PATTERN
+
+    chapter_pattern = re.compile(pattern)
+    find = search_titles if SEARCHABLE_PATTERN(pattern) else scan_titles
+    titles = []
+    for title in find(raw_text, chapter_pattern):
+        titles.append(title)
+        if limit is not None and len(titles) > limit:
+            # 前limit项的正文结束位置都已确定（序言也计为一项）
+            break
+
+    index = []
+    preface_end = titles[0][1] if titles else len(raw_text)
+    if raw_text[:preface_end].strip():
+        # Lines before the first chapter form the preface
+        index.append(("Preface", *trim_span(raw_text, 0, preface_end)))
+    for i, (title, _, line_end) in enumerate(titles):
+        body_end = titles[i + 1][1] if i + 1 < len(titles) else len(raw_text)
+        index.append((title, *trim_span(raw_text, line_end, body_end)))
+
+    if len(index) == 1:
+        # Only one block of text: treat it as the first chapter with an empty preface
+        index = [("Preface", 0, 0), ("Chapter 1", index[0][1], index[0][2])]
+    return index[:limit]
+
+
+def chapter_index_path(raw_text: str, pattern: str = None) -> str:
+    from src.cache import cache_dir
+
+    key = hashlib.sha256(f"{CHAPTER_INDEX_VERSION}\0{pattern}\0".encode('utf-8'))
+    key.update(raw_text.encode('utf-8'))
+    key = key.hexdigest()
+    return os.path.join(cache_dir(), 'chapters', key[:2], f"{key}.json")
+
+
+def load_chapter_index(
+        raw_text: str,
+        pattern: str = None,
+):
+    """
+    读取保存的章节索引，没有时识别章节并保存，再次运行时跳过识别
+    """
+    path = chapter_index_path(raw_text, pattern)
+    if os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                index = [tuple(entry) for entry in json.load(f)]
+            os.utime(path)  # 记录最近一次使用，见clear_cache
+            return index
+        except Exception as e:
+            logging.warning(f"读取章节索引{path}错误：" + str(e))
+
+    index = index_chapters(raw_text, pattern)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(index, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+    except Exception as e:
+        logging.warning(f"保存章节索引{path}错误：" + str(e))
+    return index
 
 
 def extract_chapters(
         raw_text: str,
         pattern: str = None,
+        limit: int = None,
+        persist: bool = False,
 ):
     """
     Extract chapters from a novel text using a regular expression pattern to match chapter titles
     :param raw_text: Raw text to extract chapters from
     :param pattern: Regular expression pattern to match chapter titles
-    :return: List of tuples containing chapter title and content
+    :param limit: Stop after this many chapters (None for all)
+    :param persist: 是否保存章节索引，相同的原文与pattern再次运行时直接读取
+    :return: ChapterList，每项为章节标题与正文的元组
     """
-    if pattern is None:
-        pattern = r'[\s:：]*(第?[0-9一二三四五六七八九十百千零壹两仨贰叁肆伍陆柒捌玖拾佰仟万]+)[:：、\-\s]*章[:：、\-\s]'
+    # 不保存索引时找到limit章后即停止查找
+    index = load_chapter_index(raw_text, pattern) if persist else index_chapters(raw_text, pattern, limit)
+    return ChapterList(raw_text, index[:limit])
 
-    chapters = []
-    chapter_contents = []
-    current_chapter_title = None
-    first_chapter_found = False  # Flag to check if the first chapter has been identified
 
-    chapter_pattern = re.compile(pattern)
+# 分段函数：超长的行在分隔符处切开，句子分隔符优先
+SENTENCE_SEPARATORS = ['\n', '.', '。']
+WHOLE_SEPARATORS = ['\n', '.', '，', '、', ';', ',', '；',
+                    '：', '！', '？', '(', ')', '”', '“',
+                    '’', '‘', '[', ']', '{', '}', '<', '>',
+                    '/', '\\', '|', '-', '=', '+', '*', '%',
+                    '$', '#', '@', '&', '^', '_', '`', '~',
+                    '·', '…']
+
+
+def find_cut(s, lo, hi) -> int | None:
+    """
+    在s[lo:hi]中查找最靠后的分隔符
+    :return: 分隔符之后的位置，没有找到时返回None
+    """
+    for separators in (SENTENCE_SEPARATORS, WHOLE_SEPARATORS):
+        sep_pos = max(s.rfind(sep, lo, hi) for sep in separators)
+        if sep_pos >= lo:
+            return sep_pos + 1
+    return None
+
 
-    for line in raw_text.split('\n'):
-        line = line.strip()
-        if not line:
-            continue  # Skip empty lines
-        match = chapter_pattern.search(line)
-        if match:
-            if current_chapter_title is not None:
-                chapters.append((current_chapter_title, '\n'.join(chapter_contents)))
-            if not first_chapter_found:
-                first_chapter_found = True  # Mark that the first chapter is found
-            current_chapter_title = line  # Update the current chapter title
-            chapter_contents = []  # Reset the contents for the new chapter
-        elif first_chapter_found:
-            chapter_contents.append(line)  # Append line to current chapter contents
+def divide_long_line(line, limit, token_len):
+    """
+    将超长的行切分为每段不超过limit个token：整行只编码一次，按token的字符区间依次确定每段的结束位置，
+    在预算的后半段中找最靠后的分隔符切开，没有分隔符时在预算边界的token处切开
+    :param line: 超长的行
+    :param limit: 每段的最大token数
+    :param token_len: get_token_len返回的TokenLen
+    :return: (分段后的列表, 每段的token数)
+    """
+    limit = max(limit, 1)
+    offsets = token_len.offsets(line)
+    starts = [start for start, _ in offsets]
+    ends = [end for _, end in offsets]
+
+    pieces = []
+    piece_lens = []
+    pos = 0  # 当前段的起始字符
+    token = 0  # 当前段的第一个token
+    while len(offsets) - token > limit:
+        hi = ends[token + limit - 1]
+        if token + limit < len(offsets) and pos < starts[token + limit] < hi:
+            # 与预算外的token共用的字符（如被拆开的多字节字符）留给下一段
+            hi = starts[token + limit]
+        lo = ends[token + limit // 2 - 1] if limit > 1 else pos
+        cut = find_cut(line, lo, hi) or hi
+        # 跨越切点的token（如被拆开的多字节字符）同时计入两段
+        pieces.append(line[pos:cut])
+        piece_lens.append(bisect_left(starts, cut, lo=token) - token)
+        pos, token = cut, bisect_right(ends, cut, lo=token)
+
+    if pos < len(line):
+        pieces.append(line[pos:])
+        piece_lens.append(len(offsets) - token)
+    return pieces, piece_lens
+
+
+def divide_lines(lines, lengths, max_token_lens, token_len, starts=None) -> tuple:
+    """
+    切分章节中的超长行，其余行直接使用批量编码得到的token数
+    :param lines: 章节的行
+    :param lengths: 每行的token数
+    :param max_token_lens: 每行对应的最大token数
+    :param token_len: get_token_len返回的TokenLen，只用于超长的行
+    :param starts: 每行在原文中的起始位置，为None时不计算分段的位置
+    :return: (分段后的行, 每行的token数, 每行在原文中的起始位置或None)
+    """
+    pieces = []
+    piece_lens = []
+    piece_starts = None if starts is None else []
+    for i, (line, line_len, max_token_len) in enumerate(zip(lines, lengths, max_token_lens)):
+        if line_len <= max_token_len - 5:
+            divided, divided_lens = [line], [line_len]
         else:
-            # If no chapter has been found yet, store lines as part of the preface
-            if chapters and chapters[0][0] == "Preface":
-                chapters[0][1].append(line)
-            else:
-                chapters.insert(0, ("Preface", [line]))
+            divided, divided_lens = divide_long_line(line, max_token_len - 15, token_len)
+        pieces.extend(divided)
+        piece_lens.extend(divided_lens)
+        if starts is not None:
+            # 分段依次拼接后与原行相同
+            piece_starts.extend(accumulate((len(piece) for piece in divided[:-1]), initial=starts[i]))
+    return pieces, piece_lens, piece_starts
 
-    if current_chapter_title is not None:
-        chapters.append((current_chapter_title, '\n'.join(chapter_contents)))
 
-    if chapters and chapters[0][0] == "Preface":
-        chapters[0] = (chapters[0][0], '\n'.join(chapters[0][1]))
+def span_base(text) -> str | None:
+    """
+    text为各项只有一段、不接换行符的SpanArray（如transformer得到的各章正文）时返回其原文，
+    此时按原文位置切分，结果同样为SpanArray；否则返回None，按文本切分
+    """
+    if isinstance(text, SpanArray) and not text.line_end and \
+            all(end - start == 1 for start, end in zip(text.bounds, text.bounds[1:])):
+        return text.text
+    return None
+
+
+def span_lines(text, start, end) -> tuple:
+    """
+    原文[start, end)范围内的各行及其在原文中的起始位置，与span_text(text, start, end).split('\\n')相同
+    """
+    lines = []
+    starts = []
+    pos = start
+    first = True
+    while True:
+        line_end = text.find('\n', pos, end)
+        last = line_end == -1
+        if last:
+            line_end = end
+        line = text[pos:line_end]
+        left_stripped = line if first else line.lstrip()
+        stripped = left_stripped if last else left_stripped.rstrip()
+        if stripped:
+            lines.append(stripped)
+            starts.append(pos + len(line) - len(left_stripped))
+        if last:
+            break
+        pos = line_end + 1
+        first = False
+    if not lines:
+        return [''], [start]
+    return lines, starts
+
+
+def iter_chapter_lines(text, start: int = 0):
+    """
+    逐章输出(行, 各行在原文中的起始位置)，text不是正文片段时起始位置为None
+    """
+    base = span_base(text)
+    if base is None:
+        for chapter in islice(text, start, None):
+            yield chapter.split('\n'), None
+    else:
+        for index in range(start, len(text)):
+            yield span_lines(base, text.starts[index], text.ends[index])
+
+
+def line_lengths(lines, token_len, trace=None) -> list:
+    # 一章的全部行在一次encode_batch中编码
+    lengths = token_len.batch(lines)
+    (trace or NULL_TRACE).add_tokens(sum(lengths))
+    return lengths
+
+
+def make_chunk(lines, starts, start, end):
+    """
+    由第start到第end行（不含）组成的块
+    :return: starts为None时返回文本；否则返回原文中的范围列表，同一行切开的分段属于不同的范围
+    """
+    if starts is None:
+        return '\n'.join(lines[start:end]) + '\n'
+    segments = []
+    for i in range(start, end):
+        line_end = starts[i] + len(lines[i])
+        if segments and segments[-1][1] < starts[i]:
+            segments[-1][1] = line_end
+        else:
+            segments.append([starts[i], line_end])
+    return segments
 
-    if len(chapters) == 1:
-        chapters.append(('Chapter 1', chapters[0][1]))
-        chapters[0] = ('Preface', '')
 
-    return chapters
+def greedy_breaks(offsets, max_token_len) -> list:
+    """
+    依次装满每块，通过累计长度二分查找每块的结束位置
+    :param offsets: 每行（含1个换行符）长度的累计和，首项为0
+    :return: 每块的结束行号
+    """
+    breaks = []
+    start = 0
+    while start < len(offsets) - 1:
+        # 块[start, end)的长度为offsets[end] - offsets[start] - 1，最后一行的换行符不计入
+        start = max(bisect_right(offsets, offsets[start] + max_token_len + 1) - 1, start + 1)
+        breaks.append(start)
+    return breaks
 
 
-# 分段函数
-def divide_str(s, sep=None):
-    if sep is None:
-        sep = ['\n', '.', '。']
-    mid_len = len(s) // 2  # 中心点位置
-    best_sep_pos = len(s) + 1  # 最接近中心点的分隔符位置
-    best_sep = None  # 最接近中心点的分隔符
-    for curr_sep in sep:
-        sep_pos = s.rfind(curr_sep, 0, mid_len)  # 从中心点往左找分隔符
-        if sep_pos > 0 and abs(sep_pos - mid_len) < abs(best_sep_pos -
-                                                        mid_len):
-            best_sep_pos = sep_pos
-            best_sep = curr_sep
-    if not best_sep:  # 没有找到分隔符
-        return s, ''
-    return s[:best_sep_pos + 1], s[best_sep_pos + 1:]
+def balanced_breaks(offsets, max_token_len) -> list:
+    """
+    在行边界上动态规划选择切点，使各块长度与平均长度的平方差之和最小，避免贪心装填留下很短的末块
+    平均长度按贪心装填的块数（不超过max_token_len时的最少块数）计算
+    :param offsets: 每行（含1个换行符）长度的累计和，首项为0
+    :return: 每块的结束行号
+    """
+    n = len(offsets) - 1
+    if n == 0:
+        return []
+    target = offsets[n] / len(greedy_breaks(offsets, max_token_len))
+    cost = [0.0] + [float('inf')] * n
+    previous = [0] * (n + 1)
+    for end in range(1, n + 1):
+        # 可以作为块起点的最早行，单行超长时只能单独成块
+        first = min(bisect_left(offsets, offsets[end] - max_token_len - 1), end - 1)
+        for start in range(first, end):
+            chunk_cost = cost[start] + (offsets[end] - offsets[start] - target) ** 2
+            if chunk_cost < cost[end]:
+                cost[end] = chunk_cost
+                previous[end] = start
+    breaks = []
+    end = n
+    while end > 0:
+        breaks.append(end)
+        end = previous[end]
+    return breaks[::-1]
+
+
+LINE_PACKINGS = {
+    "greedy": greedy_breaks,
+    "balanced": balanced_breaks,
+}
 
 
-def strong_divide(s):
-    left, right = divide_str(s)
+def get_line_packing(packing):
+    if packing not in LINE_PACKINGS:
+        raise ValueError(f"Invalid packing type: {packing}")
+    return LINE_PACKINGS[packing]
 
-    if right != '':
-        return left, right
 
-    whole_sep = ['\n', '.', '，', '、', ';', ',', '；',
-                 '：', '！', '？', '(', ')', '”', '“',
-                 '’', '‘', '[', ']', '{', '}', '<', '>',
-                 '/', '\\', '|', '-', '=', '+', '*', '%',
-                 '$', '#', '@', '&', '^', '_', '`', '~',
-                 '·', '…']
-    left, right = divide_str(s, sep=whole_sep)
+def pack_lines(lines, lengths, max_token_len, packing='greedy', starts=None):
+    """
+    按最大token数将行装入块，每行计1个换行符的长度，只使用已知的token数，不再重复编码
+    :param packing: greedy依次装满每块，balanced使各块长度尽量接近
+    :param starts: 每行在原文中的起始位置，不为None时块以原文中的范围表示
+    :return: (块, 块的token数)的生成器
+    """
+    offsets = list(accumulate((length + 1 for length in lengths), initial=0))
+    start = 0
+    for end in get_line_packing(packing)(offsets, max_token_len):
+        yield make_chunk(lines, starts, start, end), offsets[end] - offsets[start]
+        start = end
 
-    if right != '':
-        return left, right
 
-    mid_len = len(s) // 2
-    return s[:mid_len], s[mid_len:]
+def merge_short_chunks(chunks, min_len):
+    """
+    将长度小于min_len的块并入前一个块，逐块输出
+    :param chunks: (块, 块的token数)的可迭代对象，块为文本或原文中的范围列表
+    :param min_len: 最小token数
+    :return: 合并后的块的生成器
+    """
+    pending = None
+    for chunk, chunk_len in chunks:
+        if pending is not None and chunk_len < min_len:
+            pending += chunk
+        else:
+            if pending is not None:
+                yield pending
+            pending = chunk
+    if pending is not None:
+        yield pending
 
 
-def split_chunk(
+def chapter_chunksize(text, workers) -> int:
+    # 每个子进程大约分到4批章节
+    if workers <= 1 or not hasattr(text, '__len__'):
+        return 1
+    return max(len(text) // (workers * 4), 1)
+
+
+def pack_chapter(chapter, max_token_len, tokenizer, packing='greedy', trace=None) -> list:
+    """
+    切分一章，各章互不影响，可以在子进程中运行
+    :param chapter: iter_chapter_lines输出的(行, 各行在原文中的起始位置)
+    :return: (块, 块的token数)的列表，尚未合并过短的块
+    """
+    from src.tools import get_token_len
+    token_len = get_token_len(tokenizer)
+
+    lines, starts = chapter
+    lengths = line_lengths(lines, token_len, trace)
+    lines, lengths, starts = divide_lines(lines, lengths, repeat(max_token_len), token_len, starts)
+
+    for line_len in lengths:
+        if line_len > max_token_len:
+            print('warning line_len = ', line_len)
+
+    return list(pack_lines(lines, lengths, max_token_len, packing, starts))
+
+
+def iter_chunks(
         text,
         max_token_len: int = 1500,
         add_preface: bool = True,
         merge_min: int = 50,
-        tokenizer: str = "qwen",
+        tokenizer: str = DEFAULT_TOKENIZER,
+        packing: str = "greedy",
+        trace=None,
+        workers: int = 1,
 ):
-    from src.tools import TokenLen
-    tokenizer_len = TokenLen(encoding=tokenizer)
-
+    """
+    按最大token数将章节切分为块，逐块输出
+    :param text: 章节的可迭代对象，或各章正文的SpanArray
+    :param max_token_len: 每块的最大token数
+    :param add_preface: 是否保留第一章（序言）
+    :param merge_min: 小于该token数的块并入前一块
+    :param tokenizer: tokenizer名称
+    :param packing: 装填方式，见LINE_PACKINGS
+    :param trace: get_worker_trace返回的记录，用于统计token数
+    :param workers: 大于1时各章在进程池中并行切分，按章节顺序合并
+    :return: 块的生成器，text为SpanArray时块为原文中的范围列表
+    """
     start = 1
     if add_preface:
         start = 0
 
-    chunk_text = []
+    pack = partial(pack_chapter, max_token_len=max_token_len, tokenizer=tokenizer, packing=packing)
+    chapters = map_ordered(pack, iter_chapter_lines(text, start), workers, trace=trace, warmup=(tokenizer,),
+                           chunksize=chapter_chunksize(text, workers))
+    yield from merge_short_chunks(chain.from_iterable(chapters), merge_min)
 
-    for chapter in text[start:]:
 
-        # chapter = chapter[1]
+def to_spans(text, chunks):
+    # 按原文位置切分得到的块保存为SpanArray，访问时才生成文本
+    base = span_base(text)
+    if base is None:
+        return chunks
+    return SpanArray.from_segments(base, chunks, line_end=True)
 
-        split_text = chapter.split('\n')
 
-        curr_len = 0
-        curr_chunk = ''
+def split_chunk(
+        text,
+        max_token_len: int = 1500,
+        add_preface: bool = True,
+        merge_min: int = 50,
+        tokenizer: str = DEFAULT_TOKENIZER,
+        packing: str = "greedy",
+        limit: int = None,
+        trace=None,
+        workers: int = 1,
+):
+    chunks = list(islice(iter_chunks(
+        text,
+        max_token_len=max_token_len,
+        add_preface=add_preface,
+        merge_min=merge_min,
+        tokenizer=tokenizer,
+        packing=packing,
+        trace=trace,
+        workers=workers,
+    ), limit))
+    return to_spans(text, chunks)
 
-        tmp = []
 
-        for line in split_text:
-            line_len = tokenizer_len(line)
+def draw_uniform(rng, arg1, arg2, size):
+    return rng.uniform(arg1, arg2, size)
 
-            if line_len <= max_token_len - 5:
-                tmp.append(line)
-            else:
-                # print('divide line with length = ', line_len)
-                path = [line]
-                tmp_res = []
 
-                while path:
-                    my_str = path.pop()
-                    left, right = strong_divide(my_str)
+def draw_normal(rng, arg1, arg2, size):
+    return rng.normal(arg1, arg2, size)
 
-                    len_left = tokenizer_len(left)
-                    len_right = tokenizer_len(right)
 
-                    if len_left > max_token_len - 15:
-                        path.append(left)
-                    else:
-                        tmp_res.append(left)
+def draw_lognormal(rng, arg1, arg2, size):
+    # arg1、arg2为对数的均值与标准差
+    return rng.lognormal(arg1, arg2, size)
 
-                    if len_right > max_token_len - 15:
-                        path.append(right)
-                    else:
-                        tmp_res.append(right)
 
-                for line in tmp_res:
-                    tmp.append(line)
+def draw_empirical(rng, arg1, arg2, size):
+    # arg1为参考数据的token数样本，按其经验分布有放回地抽取
+    return rng.choice(arg1, size)
 
-        split_text = tmp
 
-        for line in split_text:
-            line_len = tokenizer_len(line)
+# 分布名称: 一次抽取size个最大token数的函数
+DISTRIBUTIONS = {
+    'uniform': draw_uniform,
+    'normal': draw_normal,
+    'lognormal': draw_lognormal,
+    'empirical': draw_empirical,
+}
 
-            if line_len > max_token_len:
-                print('warning line_len = ', line_len)
 
-            if curr_len + line_len <= max_token_len:
-                curr_chunk += line
-                curr_chunk += '\n'
-                curr_len += line_len
-                curr_len += 1
-            else:
-                chunk_text.append(curr_chunk)
-                curr_chunk = line
-                curr_len = line_len
-
-        if curr_chunk:
-            chunk_text.append(curr_chunk)
-
-    def merge_short_texts(text_list, min_len):
-        i = 0
-        while i < len(text_list):
-            if i > 0 and tokenizer_len(text_list[i]) < min_len:
-                text_list[i - 1] += text_list[i]
-                text_list.pop(i)
-            else:
-                i += 1
-        return text_list
+def get_distribution(distribution):
+    if distribution not in DISTRIBUTIONS:
+        raise ValueError(f"Invalid distribution type: {distribution}")
+    return DISTRIBUTIONS[distribution]
+
+
+def chapter_rng(seed, index, lines):
+    """
+    每章单独的随机数生成器，只由种子、章节序号与章节内容决定，
+    与是否并行切分、在哪个进程中切分无关；seed为None时不可复现
+    """
+    import numpy as np
+    if seed is None:
+        return np.random.default_rng()
+    content = 0
+    for line in lines:
+        content = zlib.crc32(line.encode('utf-8'), content)
+    return np.random.default_rng([seed, index, content])
+
+
+def draw_budgets(rng, distribution, dist_arg1, dist_arg2, size) -> list:
+    # 一次抽取size个最大token数，确保不小于100
+    import numpy as np
+    values = get_distribution(distribution)(rng, dist_arg1, dist_arg2, size)
+    return np.maximum(np.asarray(values).astype(np.int64), 100).tolist()
+
+
+def pack_chapter_dist(chapter, dist_arg1, dist_arg2, distribution, tokenizer, seed=0, trace=None) -> list:
+    """
+    按随机分布的最大token数切分一章，可以在子进程中运行
+    :param chapter: (章节序号, iter_chapter_lines输出的(行, 各行在原文中的起始位置))
+    :return: (块, 块的token数)的列表，尚未合并过短的块
+    """
+    from src.tools import get_token_len
+    token_len = get_token_len(tokenizer)
+
+    index, (lines, starts) = chapter
+    rng = chapter_rng(seed, index, lines)
+    lengths = line_lengths(lines, token_len, trace)
+    max_token_lens = draw_budgets(rng, distribution, dist_arg1, dist_arg2, len(lines))
+    lines, lengths, starts = divide_lines(lines, lengths, max_token_lens, token_len, starts)
+
+    # 每行的最大长度不同，逐行累加已知的token数
+    budgets = draw_budgets(rng, distribution, dist_arg1, dist_arg2, len(lengths))
+    chunks = []
+    chunk_start = 0
+    curr_len = 0
+    for i, line_len in enumerate(lengths):
+        if curr_len + line_len > budgets[i]:
+            chunks.append((make_chunk(lines, starts, chunk_start, i) if i > chunk_start else
+                           ('' if starts is None else []), curr_len))
+            chunk_start = i
+            curr_len = 0
+        curr_len += line_len + 1
+
+    if chunk_start < len(lines):
+        chunks.append((make_chunk(lines, starts, chunk_start, len(lines)), curr_len))
+    return chunks
+
+
+def iter_chunks_dist(
+        text,
+        dist_arg1=100,
+        dist_arg2=300,
+        add_preface=True,
+        merge_min: int = 50,
+        distribution='uniform',
+        tokenizer: str = DEFAULT_TOKENIZER,
+        trace=None,
+        workers: int = 1,
+        seed: int = 0,
+):
+    """
+    按随机分布的最大token数将章节切分为块，逐块输出
+    :param distribution: 分布类型，见DISTRIBUTIONS
+    :param workers: 大于1时各章在进程池中并行切分，按章节顺序合并
+    :param seed: 随机种子，相同的种子与输入得到相同的结果，为None时不可复现
+    """
+    get_distribution(distribution)  # 在提交到子进程前检查分布类型
 
-    chunk_text = merge_short_texts(chunk_text, merge_min)
+    start = 0 if add_preface else 1
 
-    return chunk_text
+    pack = partial(pack_chapter_dist, dist_arg1=dist_arg1, dist_arg2=dist_arg2, distribution=distribution,
+                   tokenizer=tokenizer, seed=seed)
+    chapters = map_ordered(pack, enumerate(iter_chapter_lines(text, start), start), workers, trace=trace,
+                           warmup=(tokenizer,), chunksize=chapter_chunksize(text, workers))
+    yield from merge_short_chunks(chain.from_iterable(chapters), merge_min)
 
 
 def split_chunk_dist(
@@ -199,91 +706,138 @@ def split_chunk_dist(
         add_preface=True,
         merge_min: int = 50,
         distribution='uniform',
-        tokenizer: str = "qwen",
+        tokenizer: str = DEFAULT_TOKENIZER,
+        limit: int = None,
+        trace=None,
+        workers: int = 1,
+        seed: int = 0,
 ):
-    # from src.tools import tokenizer_len
-    from src.tools import TokenLen
-    tokenizer_len = TokenLen(encoding=tokenizer)
-
-    if distribution == 'normal':
-        dist_func = np.random.normal
-    elif distribution == 'uniform':
-        dist_func = np.random.uniform
+    chunks = list(islice(iter_chunks_dist(
+        text,
+        dist_arg1=dist_arg1,
+        dist_arg2=dist_arg2,
+        add_preface=add_preface,
+        merge_min=merge_min,
+        distribution=distribution,
+        tokenizer=tokenizer,
+        trace=trace,
+        workers=workers,
+        seed=seed,
+    ), limit))
+    return to_spans(text, chunks)
+
+
+def get_chapter_pattern(worker_dict):
+    args = worker_dict.get('args')
+    if args is not None:
+        return args.get('pattern', None)
+    return None
+
+
+def get_len_args(worker_dict):
+    args = worker_dict.get('args')
+    if args is not None:
+        max_token_len = worker_dict['args'].get('max_token_len', 1500)
+        add_preface = worker_dict['args'].get('preface', False)
+        min_len = worker_dict['args'].get('min_len', 50)
+        tokenizer = worker_dict['args'].get('tokenizer', DEFAULT_TOKENIZER)
+        packing = worker_dict['args'].get('packing', 'greedy')
+        get_line_packing(packing)  # 运行前检查装填方式
+        check_tokenizer(tokenizer)  # 运行前检查tokenizer
     else:
-        raise ValueError(f"Invalid distribution type: {distribution}")
+        max_token_len = 1500
+        add_preface = False
+        min_len = 50
+        tokenizer = DEFAULT_TOKENIZER
+        packing = 'greedy'
 
-    start = 0 if add_preface else 1
-    chunk_text = []
-
-    for chapter in text[start:]:
-        split_text = chapter.split('\n')
-        curr_len = 0
-        curr_chunk = ''
-        tmp = []
-
-        for line in split_text:
-            line_len = tokenizer_len(line)
-            # 动态确定本次的最大长度
-            max_token_len = int(dist_func(dist_arg1, dist_arg2))
-            # 确保max_token_len不小于一定值，比如500
-            max_token_len = max(max_token_len, 100)
-
-            if line_len <= max_token_len - 5:
-                tmp.append(line)
-            else:
-                path = [line]
-                tmp_res = []
+    return {
+        'max_token_len': max_token_len,
+        'add_preface': add_preface,
+        'merge_min': min_len,
+        'tokenizer': tokenizer,
+        'packing': packing,
+    }
 
-                while path:
-                    my_str = path.pop()
-                    left, right = strong_divide(my_str)
 
-                    len_left = tokenizer_len(left)
-                    len_right = tokenizer_len(right)
+def get_empirical_lengths(args) -> list:
+    """
+    empirical分布的样本：args中的lengths（token数列表），或lengths_path指向的json文件（token数列表），
+    例如参考数据集中每条回复的token数
+    """
+    lengths = args.get('lengths')
+    if lengths is None and args.get('lengths_path') is not None:
+        with open(args['lengths_path'], 'r', encoding='utf-8') as f:
+            lengths = json.load(f)
+    if not lengths:
+        raise ValueError("No lengths provided for empirical distribution")
+    return [int(length) for length in lengths]
 
-                    if len_left > max_token_len - 15:
-                        path.append(left)
-                    else:
-                        tmp_res.append(left)
 
-                    if len_right > max_token_len - 15:
-                        path.append(right)
-                    else:
-                        tmp_res.append(right)
+def get_distribution_args(worker_dict):
+    args = worker_dict.get('args')
+    if args is not None:
+        max_token_range = worker_dict['args'].get('max_token_range', [100, 500])
+        add_preface = worker_dict['args'].get('preface', False)
+        distribution = worker_dict['args'].get('distribution', 'uniform')
+        min_len = worker_dict['args'].get('min_len', 50)
+        tokenizer = worker_dict['args'].get('tokenizer', DEFAULT_TOKENIZER)
+        check_tokenizer(tokenizer)  # 运行前检查tokenizer
+        seed = worker_dict['args'].get('seed', 0)
 
-                tmp.extend(tmp_res)
+        if distribution == 'normal':
+            dist_arg1 = int(statistics.mean(max_token_range))
+            dist_arg2 = int(statistics.pstdev(max_token_range))
 
-        split_text = tmp
+        elif distribution == 'uniform':
+            dist_arg1 = int(max_token_range[0])
+            dist_arg2 = int(max_token_range[1])
 
-        for line in split_text:
-            line_len = tokenizer_len(line)
-            max_token_len = int(dist_func(dist_arg1, dist_arg2))
-            max_token_len = max(max_token_len, 100)
+        elif distribution == 'lognormal':
+            # 与normal相同，由范围两端的对数确定均值与标准差
+            log_range = [math.log(value) for value in max_token_range]
+            dist_arg1 = statistics.mean(log_range)
+            dist_arg2 = statistics.pstdev(log_range)
 
-            if curr_len + line_len <= max_token_len:
-                curr_chunk += line + '\n'
-                curr_len += line_len + 1
-            else:
-                chunk_text.append(curr_chunk)
-                curr_chunk = line + '\n'
-                curr_len = line_len + 1
-
-        if curr_chunk:
-            chunk_text.append(curr_chunk)
-
-    def merge_short_texts(text_list, min_len):
-        i = 0
-        while i < len(text_list):
-            if i > 0 and tokenizer_len(text_list[i]) < min_len:
-                text_list[i - 1] += text_list[i]
-                text_list.pop(i)
-            else:
-                i += 1
-        return text_list
+        elif distribution == 'empirical':
+            dist_arg1 = get_empirical_lengths(worker_dict['args'])
+            dist_arg2 = None
 
-    chunk_text = merge_short_texts(chunk_text, merge_min)
+        else:
+            raise ValueError(f"Invalid distribution type: {distribution}")
+
+    else:
+        dist_arg1 = 100
+        dist_arg2 = 500
+        add_preface = False
+        distribution = 'uniform'
+        min_len = 50
+        tokenizer = DEFAULT_TOKENIZER
+        seed = 0
+
+    return {
+        'dist_arg1': dist_arg1,
+        'dist_arg2': dist_arg2,
+        'add_preface': add_preface,
+        'distribution': distribution,
+        'merge_min': min_len,
+        'tokenizer': tokenizer,
+        'seed': seed,
+    }
 
-    return chunk_text
+
+def get_chapter_workers(worker_dict, documents) -> int:
+    """
+    按章节并行切分的进程数，worker参数中的workers，默认为1
+    按文档分片时各文档已在子进程中并行，不再按章节并行
+    """
+    args = worker_dict.get('args') or {}
+    workers = args.get('workers')
+    if workers is None:
+        workers = 1
+    if len(documents) > 1 and get_shard_workers(worker_dict) > 1:
+        return 1
+    return int(workers)
 
 
 def spliter_chapter(worker_dict):
@@ -293,19 +847,19 @@ def spliter_chapter(worker_dict):
     if source_list is None:
         raise ValueError("No source provided for spliter_chapter")
 
-    args = worker_dict.get('args')
-    if args is not None:
-        pattern = args.get('pattern', None)
-    else:
-        pattern = None
+    pattern = get_chapter_pattern(worker_dict)
+
+    # 使用结果缓存时同时保存章节索引，worker参数中的cache优先
+    persist = os.getenv('CACHE', default='true') == 'true'
+    if worker_dict.get('cache') is not None:
+        persist = str(worker_dict.get('cache')).lower() == 'true'
+    extract = partial(extract_chapters, pattern=pattern, limit=worker_dict.get('limit'), persist=persist)
 
     for source in source_list:
         if source not in worker_dict['data']:
             raise ValueError(f"Source {source} not found in data")
         else:
-            for data in worker_dict['data'][source]:
-                chapters = extract_chapters(data, pattern)
-                results.append(chapters)
+            results.extend(map_documents(worker_dict, extract, worker_dict['data'][source]))
 
     show_log_base(worker_dict, results[0][0], worker_dict['name'])
 
@@ -319,30 +873,19 @@ def spliter_len(worker_dict):
     if source_list is None:
         raise ValueError("No source provided for spliter_len")
 
-    args = worker_dict.get('args')
-    if args is not None:
-        max_token_len = worker_dict['args'].get('max_token_len', 1500)
-        add_preface = worker_dict['args'].get('preface', False)
-        min_len = worker_dict['args'].get('min_len', 50)
-        tokenizer = worker_dict['args'].get('tokenizer', 'qwen')
-    else:
-        max_token_len = 1500
-        add_preface = False
-        min_len = 50
-        tokenizer = 'qwen'
+    len_args = get_len_args(worker_dict)
+    trace = get_worker_trace(worker_dict.get('name'))
+
+    warmup = (len_args['tokenizer'],)
 
     for source in source_list:
         if source not in worker_dict['data']:
             raise ValueError(f"Source {source} not found in data")
         else:
-            for data in worker_dict['data'][source]:
-                results.append(split_chunk(
-                    text=data,
-                    max_token_len=max_token_len,
-                    add_preface=add_preface,
-                    min_len=min_len,
-                    tokenizer=tokenizer
-                ))
+            documents = worker_dict['data'][source]
+            split = partial(split_chunk, limit=worker_dict.get('limit'),
+                            workers=get_chapter_workers(worker_dict, documents), **len_args)
+            results.extend(map_documents(worker_dict, split, documents, trace=trace, warmup=warmup))
 
     show_log_base(worker_dict, results[0][0], worker_dict['name'])
 
@@ -356,59 +899,80 @@ def spliter_distribution(worker_dict):
     if source_list is None:
         raise ValueError("No source provided for spliter_len")
 
-    args = worker_dict.get('args')
-    if args is not None:
-        max_token_range = worker_dict['args'].get('max_token_range', [100, 500])
-        add_preface = worker_dict['args'].get('preface', False)
-        distribution = worker_dict['args'].get('distribution', 'uniform')
-        min_len = worker_dict['args'].get('min_len', 50)
-        tokenizer = worker_dict['args'].get('tokenizer', 'qwen')
-
-        if distribution == 'normal':
-            dist_arg1 = int(np.mean(max_token_range))
-            dist_arg2 = int(np.std(max_token_range))
+    distribution_args = get_distribution_args(worker_dict)
+    trace = get_worker_trace(worker_dict.get('name'))
 
-        elif distribution == 'uniform':
-            dist_arg1 = int(max_token_range[0])
-            dist_arg2 = int(max_token_range[1])
-
-        else:
-            raise ValueError(f"Invalid distribution type: {distribution}")
-
-    else:
-        dist_arg1 = 100
-        dist_arg2 = 500
-        add_preface = False
-        distribution = 'uniform'
-        min_len = 50
-        tokenizer = 'qwen'
+    warmup = (distribution_args['tokenizer'],)
 
     for source in source_list:
         if source not in worker_dict['data']:
             raise ValueError(f"Source {source} not found in data")
         else:
-            for data in worker_dict['data'][source]:
-                results.append(split_chunk_dist(
-                    text=data,
-                    dist_arg1=dist_arg1,
-                    dist_arg2=dist_arg2,
-                    add_preface=add_preface,
-                    distribution=distribution,
-                    merge_min=min_len,
-                    tokenizer=tokenizer
-                ))
+            documents = worker_dict['data'][source]
+            split = partial(split_chunk_dist, limit=worker_dict.get('limit'),
+                            workers=get_chapter_workers(worker_dict, documents), **distribution_args)
+            results.extend(map_documents(worker_dict, split, documents, trace=trace, warmup=warmup))
 
     show_log_base(worker_dict, results[0][0], worker_dict['name'])
 
     return results
 
 
+# 流式处理器：worker_dict['data'][source]中的每个文档是逐项产出的迭代器，返回逐文档的生成器
+def spliter_chapter_stream(worker_dict):
+    source_list = worker_dict.get('source')
+    if source_list is None:
+        raise ValueError("No source provided for spliter_chapter")
+
+    pattern = get_chapter_pattern(worker_dict)
+
+    for source in source_list:
+        for data in worker_dict['data'][source]:
+            yield iter_chapters(iter_lines(data), pattern)
+
+
+def spliter_len_stream(worker_dict):
+    source_list = worker_dict.get('source')
+    if source_list is None:
+        raise ValueError("No source provided for spliter_len")
+
+    len_args = get_len_args(worker_dict)
+    trace = get_worker_trace(worker_dict.get('name'))
+
+    for source in source_list:
+        for data in worker_dict['data'][source]:
+            yield iter_chunks(text=data, trace=trace, **len_args)
+
+
+def spliter_distribution_stream(worker_dict):
+    source_list = worker_dict.get('source')
+    if source_list is None:
+        raise ValueError("No source provided for spliter_len")
+
+    distribution_args = get_distribution_args(worker_dict)
+    trace = get_worker_trace(worker_dict.get('name'))
+
+    for source in source_list:
+        for data in worker_dict['data'][source]:
+            yield iter_chunks_dist(text=data, trace=trace, **distribution_args)
+
+
 SPLITER_DICT = {
     "spliter_chapter": spliter_chapter,
     "spliter_len": spliter_len,
     "spliter_distribution": spliter_distribution,
 }
 
+SPLITER_STREAM_DICT = {
+    "spliter_chapter": spliter_chapter_stream,
+    "spliter_len": spliter_len_stream,
+    "spliter_distribution": spliter_distribution_stream,
+}
+
 
 def get_spliter(spliter_name):
     return SPLITER_DICT[spliter_name]
+
+
+def get_spliter_stream(spliter_name):
+    return SPLITER_STREAM_DICT[spliter_name]
@@ -0,0 +1,283 @@
+# Store.py
+# 结果的保存与读取。json为旧格式（整体缩进保存）；jsonl为紧凑格式，每行一条记录，
+# 与上游结果完全相同的文本只保存引用，SpanArray等片段只保存原文的引用与范围，读取时通过mmap按需解码。
+import gzip
+import json
+import mmap
+import os
+import re
+from array import array
+from collections.abc import Mapping, Sequence
+
+from src.tools import TextDocument, SPAN_KEY, span_text
+
+RESULTS_FORMAT = "ling-results"
+REF_KEY = "$ref"
+REF_MIN_LEN = 32  # 短文本直接保存，引用反而更长
+
+
+def encode_default(obj):
+    # 异常保存为 {异常类型: 异常信息}
+    if isinstance(obj, Exception):
+        return {type(obj).__name__: str(obj)}
+    if isinstance(obj, Mapping):
+        return dict(obj)
+    if isinstance(obj, Sequence) and not isinstance(obj, (str, bytes)):
+        return list(obj)
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def build_ref_index(sources: dict, min_len: int = REF_MIN_LEN) -> dict:
+    """
+    为上游结果中的文本建立索引，用于在下游记录中以引用代替重复文本
+    :param sources: 字典，键为上游worker名称，值为其结果
+    :param min_len: 参与引用的最短文本长度
+    :return: 字典，键为文本，值为引用[worker, 文档, 条目, 字段]
+    """
+    index = {}
+    for name, results in sources.items():
+        for d, doc in enumerate(results):
+            if isinstance(doc, str):
+                if len(doc) >= min_len:
+                    index.setdefault(doc, [name, d])
+                continue
+            for i, item in enumerate(doc):
+                if isinstance(item, str):
+                    if len(item) >= min_len:
+                        index.setdefault(item, [name, d, i])
+                elif isinstance(item, (list, tuple)):
+                    for f, field in enumerate(item):
+                        if isinstance(field, str) and len(field) >= min_len:
+                            index.setdefault(field, [name, d, i, f])
+    return index
+
+
+def register_base_texts(base_refs: dict, name: str, results) -> None:
+    """
+    记录已保存的文本文档，之后保存的片段（SpanArray、ChapterList）可以引用它们作为原文
+    键为文本对象的id，同时记录长度与哈希，避免对象释放后id被复用时引用错误的文本
+    :param base_refs: 字典，键为id，值为(长度, 哈希, 引用[worker, 文档])
+    """
+    for d, doc in enumerate(results):
+        if isinstance(doc, str) and len(doc) >= REF_MIN_LEN:
+            base_refs[id(doc)] = (len(doc), hash(doc), [name, d])
+
+
+def find_base_ref(base_refs: dict, text) -> list | None:
+    entry = base_refs.get(id(text)) if base_refs else None
+    if entry is None or entry[0] != len(text) or entry[1] != hash(text):
+        return None
+    return entry[2]
+
+
+def encode_document(doc, ref_index: dict = None, base_refs: dict = None):
+    # 原文已保存的片段只保存引用与范围
+    if hasattr(doc, 'encode_spans'):
+        ref = find_base_ref(base_refs, doc.text)
+        if ref is not None:
+            return doc.encode_spans(ref)
+    return (encode_record(record, ref_index) for record in ([doc] if isinstance(doc, str) else doc))
+
+
+def encode_record(record, ref_index: dict = None):
+    if not ref_index:
+        return record
+    if isinstance(record, str):
+        ref = ref_index.get(record)
+        return record if ref is None else {REF_KEY: ref}
+    if isinstance(record, (list, tuple)):
+        encoded = []
+        for field in record:
+            ref = ref_index.get(field) if isinstance(field, str) else None
+            encoded.append(field if ref is None else {REF_KEY: ref})
+        return encoded
+    return record
+
+
+def save_results_json(path: str, results, **kwargs) -> str:
+    path += '.json'
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=4, default=encode_default)
+    return path
+
+
+def save_results_jsonl(path: str, results, compress: str = None, ref_index: dict = None,
+                       base_refs: dict = None) -> str:
+    """
+    按行保存结果：第一行记录每个文档的条目数（文本文档为-1），之后每行一条记录
+    :param path: 不含后缀的保存路径
+    :param results: 结果
+    :param compress: 压缩方式，None或gzip
+    :param ref_index: build_ref_index生成的引用索引
+    :param base_refs: register_base_texts记录的已保存文本
+    :return: 实际保存路径
+    """
+    path += '.jsonl'
+    if compress == 'gzip':
+        path += '.gz'
+        opener = gzip.open
+    elif compress in (None, 'none'):
+        opener = open
+    else:
+        raise ValueError(f"Invalid compress type: {compress}")
+
+    header = {
+        "format": RESULTS_FORMAT,
+        "docs": [-1 if isinstance(doc, str) else len(doc) for doc in results],
+    }
+    meta = [getattr(doc, 'meta', None) for doc in results]
+    if any(meta):
+        # 文档的元数据（如reader的文件统计）保存在文件头
+        header["meta"] = meta
+    tmp_path = f"{path}.tmp"
+    with opener(tmp_path, 'wt', encoding='utf-8') as f:
+        f.write(json.dumps(header) + '\n')
+        for doc in results:
+            for record in encode_document(doc, ref_index, base_refs):
+                f.write(json.dumps(record, ensure_ascii=False, default=encode_default) + '\n')
+    os.replace(tmp_path, path)
+    return path
+
+
+RESULT_STORES = {
+    "json": save_results_json,
+    "jsonl": save_results_jsonl,
+}
+
+
+def get_result_store(store_name):
+    return RESULT_STORES[store_name]
+
+
+def find_results_path(save_dir: str, worker: str) -> str | None:
+    for suffix in ('.jsonl', '.jsonl.gz', '.json'):
+        path = os.path.join(save_dir, worker + suffix)
+        if os.path.exists(path):
+            return path
+    return None
+
+
+class RefResolver:
+    """
+    解析记录中的引用，按需打开同一目录下的上游结果
+    """
+
+    def __init__(self, save_dir: str):
+        self.save_dir = save_dir
+        self.opened = {}
+        self.base_texts = {}
+
+    def __call__(self, value):
+        if isinstance(value, dict) and REF_KEY in value and len(value) == 1:
+            return self.resolve(value[REF_KEY])
+        if isinstance(value, dict) and SPAN_KEY in value and len(value) == 1:
+            return self.resolve_span(*value[SPAN_KEY])
+        if isinstance(value, list):
+            return [self(field) for field in value]
+        return value
+
+    def resolve(self, ref):
+        name = ref[0]
+        if name not in self.opened:
+            path = find_results_path(self.save_dir, name)
+            if path is None:
+                raise FileNotFoundError(f"引用的结果{name}不存在于{self.save_dir}")
+            self.opened[name] = load_results(path, resolver=self)
+        value = self.opened[name][ref[1]]
+        for index in ref[2:]:
+            value = value[index]
+        return value
+
+    def resolve_span(self, ref, segments, line_end):
+        # 同一原文被许多片段引用，只解码一次
+        key = tuple(ref)
+        if key not in self.base_texts:
+            self.base_texts[key] = self.resolve(ref)
+        text = self.base_texts[key]
+        separator = '\n' if line_end else ''
+        return ''.join(span_text(text, start, end) + separator for start, end in segments)
+
+
+def with_meta(text, meta: list, index: int):
+    if meta and meta[index]:
+        return TextDocument(text, meta[index])
+    return text
+
+
+class LazyResults(Sequence):
+    """
+    以mmap方式打开的jsonl结果，按文档、按条目在访问时解码
+    """
+
+    def __init__(self, path: str, resolver: RefResolver = None):
+        self.path = path
+        self.resolver = resolver if resolver is not None else RefResolver(os.path.dirname(path))
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # 每一行结束后的位置，第0行为文件头
+        self._offsets = array('q', (m.end() for m in re.finditer(b'\n', self._mm)))
+        header = json.loads(self._mm[:self._offsets[0]])
+        if header.get('format') != RESULTS_FORMAT:
+            raise ValueError(f"{path}不是结果文件")
+        self._docs = header['docs']
+        self.meta = header.get('meta')
+        self._starts = []
+        line = 1
+        for n in self._docs:
+            self._starts.append(line)
+            line += 1 if n == -1 else n
+
+    def record(self, line: int):
+        raw = self._mm[self._offsets[line - 1]:self._offsets[line] - 1]
+        return self.resolver(json.loads(raw))
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(len(self))[index]]
+        n = self._docs[index]
+        if n == -1:
+            return with_meta(self.record(self._starts[index]), self.meta, index)
+        return LazyDocument(self, self._starts[index], n)
+
+    def close(self) -> None:
+        self._mm.close()
+
+
+class LazyDocument(Sequence):
+
+    def __init__(self, results: LazyResults, start: int, length: int):
+        self._results = results
+        self._start = start
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(self._length)[index]]
+        return self._results.record(self._start + range(self._length)[index])
+
+
+def load_results(path: str, resolver: RefResolver = None):
+    """
+    读取保存的结果：jsonl返回按需解码的LazyResults，压缩文件和旧的json格式一次性读入
+    """
+    if path.endswith('.jsonl'):
+        return LazyResults(path, resolver)
+    if path.endswith('.jsonl.gz'):
+        resolver = resolver if resolver is not None else RefResolver(os.path.dirname(path))
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            header = json.loads(f.readline())
+            results = []
+            for index, n in enumerate(header['docs']):
+                if n == -1:
+                    results.append(with_meta(resolver(json.loads(f.readline())), header.get('meta'), index))
+                else:
+                    results.append([resolver(json.loads(f.readline())) for _ in range(n)])
+            return results
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
@@ -0,0 +1,228 @@
+import logging
+import os
+import threading
+from queue import Queue, Full
+
+from src.tools import show_log_base
+from src.trace import get_worker_trace
+
+# 队列消息类型
+ITEM = 0
+DOC_END = 1
+STREAM_END = 2
+ERROR = 3
+
+
+class StreamError(Exception):
+    pass
+
+
+class StreamEdge:
+    """
+    两个worker之间的有界队列，下游退出后上游写入的数据直接丢弃
+    非文本的切片在上游写入时过滤，下游不需要的数据不会进入队列
+    """
+
+    def __init__(self, maxsize: int, start: int = None, end: int = None, text: bool = False):
+        self.queue = Queue(maxsize=maxsize)
+        self.closed = False
+        self.text = text
+        self.items = 0  # 下游已读取的条目数，文本按文档计数
+        self.start = None if text else start
+        self.end = None if text else end
+
+    def put(self, message) -> None:
+        while not self.closed:
+            try:
+                self.queue.put(message, timeout=0.1)
+                return
+            except Full:
+                continue
+
+    def put_item(self, index: int, item) -> None:
+        if self.start is not None and index < self.start:
+            return
+        if self.end is not None and index >= self.end:
+            return
+        self.put((ITEM, item))
+
+    def done(self, index: int) -> bool:
+        # 当前文档中下游需要的部分是否已全部写入
+        return self.closed or (self.end is not None and index + 1 >= self.end)
+
+    def close(self) -> None:
+        self.closed = True
+
+    def documents(self, source_name):
+        """
+        按文档读取队列，每个文档是逐项产出的生成器；文档未读完时自动跳过剩余部分
+        """
+        while True:
+            kind, value = self.queue.get()
+            if kind == STREAM_END:
+                return
+            if kind == ERROR:
+                raise StreamError(f"上游{source_name}运行失败：{value}")
+            document = self._document(kind, value, source_name)
+            if self.text:
+                self.items += 1
+            yield document
+            for _ in document:
+                pass
+
+    def _document(self, kind, value, source_name):
+        while kind == ITEM:
+            if not self.text:
+                self.items += 1
+            yield value
+            kind, value = self.queue.get()
+        if kind == ERROR:
+            raise StreamError(f"上游{source_name}运行失败：{value}")
+
+
+def is_text_stream(processor_type) -> bool:
+    # reader的每个文档是文本片段，汇总时拼接为字符串
+    return processor_type.split('_')[0] == 'reader'
+
+
+def slice_text_documents(documents, start, end):
+    for document in documents:
+        yield [''.join(document)[start:end]]
+
+
+def get_stream_processor(processor_type):
+    """
+    查找流式处理器，未注册时返回None
+    """
+    from src.registry import resolve_processor
+
+    try:
+        return resolve_processor(processor_type, stream=True)
+    except KeyError:
+        return None
+
+
+def batch_documents(worker_dict, processor, text_sources):
+    """
+    没有流式实现的处理器：读完全部输入后按批处理运行，再逐文档输出
+    """
+    data = {}
+    for source_name, documents in worker_dict['data'].items():
+        if source_name in text_sources:
+            data[source_name] = [''.join(document) for document in documents]
+        else:
+            data[source_name] = [list(document) for document in documents]
+    results = processor({**worker_dict, 'data': data})
+    for result in results:
+        yield [result] if isinstance(result, str) else result
+
+
+def run_stream(ling_data, queue_size: int = 64) -> None:
+    """
+    流式运行全部worker：每个worker一个线程，worker之间通过有界队列逐项传递数据
+    :param ling_data: LingData实例
+    :param queue_size: 每条边的队列长度
+    """
+    graph = ling_data.build_dependency_graph()
+    workers_dict = ling_data.workers_dict
+
+    sources = {worker: ling_data.get_sources(worker) for worker in graph
+               if workers_dict[worker]['processor'] != 'no_run'}
+    inputs = {worker: [] for worker in graph}
+    outputs = {worker: [] for worker in graph}
+    for worker, worker_sources in sources.items():
+        for source_name, start, end in worker_sources:
+            edge = StreamEdge(queue_size, start, end, is_text_stream(workers_dict[source_name]['type']))
+            inputs[worker].append((source_name, start, end, edge))
+            outputs[source_name].append(edge)
+
+    def run_worker(worker):
+        worker_type = workers_dict[worker]['type']
+        text_output = is_text_stream(worker_type)
+        error = None
+        trace = get_worker_trace(worker)
+        try:
+            with trace.run():
+                data = {}
+                source_edges = {}
+                text_sources = set()
+                for source_name, start, end, edge in inputs[worker]:
+                    if source_name in source_edges:
+                        # 同一个source出现多次时与批处理一致，以最后一次为准
+                        source_edges[source_name].close()
+                        text_sources.discard(source_name)
+                    text = is_text_stream(workers_dict[source_name]['type'])
+                    documents = edge.documents(source_name)
+                    if text:
+                        if start is not None or end is not None:
+                            documents = slice_text_documents(documents, start, end)
+                        text_sources.add(source_name)
+                    source_edges[source_name] = edge
+                    data[source_name] = documents
+
+                workers_dict[worker]['source'] = list(data)
+                workers_dict[worker]['data'] = data
+                workers_dict[worker]['name'] = worker
+                worker_dict = dict(workers_dict[worker])
+
+                stream_processor = get_stream_processor(worker_type)
+                if stream_processor is None:
+                    logging.info(f"{worker}没有流式实现，按批处理运行")
+                    documents = batch_documents(worker_dict, workers_dict[worker]['processor'], text_sources)
+                else:
+                    documents = stream_processor(worker_dict)
+
+                collect = ling_data.should_save(worker) or not outputs[worker]
+                results = []
+                preview_shown = False
+                items_out = 0
+                for document in documents:
+                    collected = []
+                    if text_output:
+                        items_out += 1
+                    for index, item in enumerate(document):
+                        if not text_output:
+                            items_out += 1
+                        for edge in outputs[worker]:
+                            edge.put_item(index, item)
+                        if collect:
+                            collected.append(item)
+                        if not preview_shown:
+                            show_log_base(workers_dict[worker], item, worker)
+                            preview_shown = True
+                        if not collect and all(edge.done(index) for edge in outputs[worker]):
+                            # 下游都只需要文档的前一部分，提前结束当前文档，关闭后不再读取上游的该文档
+                            if hasattr(document, 'close'):
+                                document.close()
+                            break
+                    for edge in outputs[worker]:
+                        edge.put((DOC_END, None))
+                    if collect:
+                        results.append(''.join(collected) if text_output else collected)
+                trace.add_items(items_in=sum(edge.items for _, _, _, edge in inputs[worker]), items_out=items_out)
+
+                if collect:
+                    workers_dict[worker]['results'] = results
+                if os.getenv('SHOW_LOG') == 'true':
+                    logging.info(f"{worker}运行完成")
+        except Exception as e:
+            error = e
+            logging.error(f"运行{worker}错误：" + str(e))
+        finally:
+            for edge in outputs[worker]:
+                edge.put((STREAM_END, None) if error is None else (ERROR, error))
+            for _, _, _, edge in inputs[worker]:
+                edge.close()
+
+        if error is None and ling_data.should_save(worker):
+            try:
+                ling_data.save_result(worker)
+            except Exception as e:
+                logging.error(f"保存{worker}结果错误：" + str(e))
+
+    threads = [threading.Thread(target=run_worker, args=(worker,), name=worker)
+               for worker in graph if workers_dict[worker]['processor'] != 'no_run']
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
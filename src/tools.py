@@ -1,4 +1,13 @@
+import hashlib
 import os
+import threading
+from array import array
+from collections import OrderedDict
+from collections.abc import Sequence
+from contextlib import contextmanager
+from types import MappingProxyType
+
+SPAN_KEY = "$span"  # 保存结果时片段的引用，见src.store
 
 
 def show_log_base(worker_dict, show_result, proc_name):
@@ -10,24 +19,599 @@ def show_log_base(worker_dict, show_result, proc_name):
         print(f"{separator}\n{proc_name}预览结果：\n{show_result}\n{separator}")
 
 
-class TokenLen:
-    def __init__(self, encoding="qwen"):
+class ResultView(Sequence):
+    """
+    上游结果的只读视图，切片返回新的视图而不复制数据，嵌套的列表同样以视图返回
+    """
+    __slots__ = ('_base', '_range')
+
+    def __init__(self, base, index_range: range = None):
+        if isinstance(base, ResultView):
+            if index_range is None:
+                index_range = base._range
+            else:
+                index_range = base._range[index_range.start:index_range.stop:index_range.step]
+            base = base._base
+        self._base = base
+        self._range = range(len(base)) if index_range is None else index_range
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return ResultView(self._base, self._range[index])
+        return freeze(self._base[self._range[index]])
+
+    def __len__(self):
+        return len(self._range)
+
+    def __iter__(self):
+        base = self._base
+        for index in self._range:
+            yield freeze(base[index])
+
+    def __eq__(self, other):
+        if isinstance(other, (list, tuple, ResultView)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        return f"ResultView({materialize(self)!r})"
+
+    def __reduce__(self):
+        # 序列化时按列表保存，避免把整个底层结果一起序列化
+        return list, (materialize(self),)
+
+
+class TextDocument(str):
+    """
+    带元数据的文本，如reader的文件统计；切片或拼接后得到普通字符串
+    """
+
+    def __new__(cls, text, meta: dict = None):
+        document = super().__new__(cls, text)
+        document.meta = meta or {}
+        return document
+
+    def __reduce__(self):
+        return TextDocument, (str(self), self.meta)
+
+
+def span_text(text, start: int, end: int) -> str:
+    """
+    原文[start, end)范围内的文本：范围内各行去除首尾空白、跳过空行后以换行符连接，范围两端的空白保留
+    """
+    segment = text[start:end]
+    if '\n' not in segment:
+        return segment
+    lines = segment.split('\n')
+    lines = [lines[0].rstrip(), *(line.strip() for line in lines[1:-1]), lines[-1].lstrip()]
+    return '\n'.join(line for line in lines if line)
+
+
+SHARED_TEXT_MIN_LEN = 256  # 更短的原文直接随片段序列化，键本身约50字节
+
+_shared_texts = {}  # 键: [原文, 引用数]
+_shared_lock = threading.Lock()
+_pickle_context = threading.local()
+
+
+def text_key(text) -> str:
+    # 按内容计算，主进程与子进程、本次与下次运行中相同的原文得到相同的键
+    return hashlib.blake2b(text.encode('utf-8', errors='surrogatepass'), digest_size=16).hexdigest()
+
+
+def document_texts(document) -> list:
+    """
+    文档中可以被片段引用的原文：文本文档本身，或SpanArray、ChapterList的原文
+    """
+    text = document if isinstance(document, str) else getattr(document, 'text', None)
+    if isinstance(text, str) and len(text) >= SHARED_TEXT_MIN_LEN:
+        return [text]
+    return []
+
+
+def share_texts(texts) -> list:
+    """
+    登记原文，之后反序列化的片段重新指向这些原文，不再各自持有一份
+    :return: 键列表，不再需要时传给unshare_texts
+    """
+    keys = []
+    for text in texts:
+        key = text_key(text)
+        with _shared_lock:
+            entry = _shared_texts.setdefault(key, [text, 0])
+            entry[1] += 1
+        keys.append(key)
+    return keys
+
+
+def unshare_texts(keys) -> None:
+    with _shared_lock:
+        for key in keys:
+            entry = _shared_texts.get(key)
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] <= 0:
+                    del _shared_texts[key]
+
+
+def shared_text(key) -> str:
+    with _shared_lock:
+        entry = _shared_texts.get(key)
+    if entry is None:
+        raise KeyError(f"片段引用的原文{key}未登记")
+    return entry[0]
+
+
+class TextKey:
+    """
+    序列化时代替原文的键，反序列化时通过shared_text找回原文
+    """
+    __slots__ = ('key',)
+
+    def __init__(self, key: str):
+        self.key = key
+
+    def __reduce__(self):
+        return TextKey, (self.key,)
+
+
+@contextmanager
+def externalized_texts(texts=None):
+    """
+    在此范围内序列化的片段只保存原文的键
+    :param texts: 原文列表，默认为全部已登记的原文
+    """
+    if texts is None:
+        with _shared_lock:
+            keys = {id(text): TextKey(key) for key, (text, _) in _shared_texts.items()}
+    else:
+        keys = {id(text): TextKey(text_key(text)) for text in texts}
+    previous = getattr(_pickle_context, 'keys', None)
+    _pickle_context.keys = keys
+    try:
+        yield
+    finally:
+        _pickle_context.keys = previous
+
+
+def pickled_text(text):
+    keys = getattr(_pickle_context, 'keys', None)
+    return keys.get(id(text), text) if keys else text
+
+
+def bound_text(text) -> str:
+    return shared_text(text.key) if isinstance(text, TextKey) else text
+
+
+def restore_spans(text, starts, ends, bounds, line_end):
+    return SpanArray(bound_text(text), starts, ends, bounds, line_end)
+
+
+def restore_chapters(text, index):
+    return ChapterList(bound_text(text), index)
+
+
+class SpanArray(Sequence):
+    """
+    同一原文上的一组文本片段，只保存原文与各片段的字符位置，访问某一项时才生成文本（见span_text）
+    每项由一段或多段范围组成，如合并后的块；line_end为True时每段之后接一个换行符
+    """
+    __slots__ = ('text', 'starts', 'ends', 'bounds', 'line_end')
+
+    def __init__(self, text: str, starts: array, ends: array, bounds: array, line_end: bool = False):
+        self.text = text
+        self.starts = starts
+        self.ends = ends
+        self.bounds = bounds  # 第i项的范围为第bounds[i]到bounds[i + 1]段
+        self.line_end = line_end
+
+    @classmethod
+    def from_segments(cls, text: str, items, line_end: bool = False):
+        """
+        :param text: 原文
+        :param items: 每项的范围列表[[起始, 结束], ...]
+        :param line_end: 每段之后是否接换行符
+        """
+        starts, ends, bounds = array('q'), array('q'), array('q', [0])
+        for segments in items:
+            for start, end in segments:
+                starts.append(start)
+                ends.append(end)
+            bounds.append(len(starts))
+        return cls(text, starts, ends, bounds, line_end)
+
+    def segments(self, index: int) -> list:
+        index = range(len(self))[index]
+        return [[self.starts[j], self.ends[j]] for j in range(self.bounds[index], self.bounds[index + 1])]
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return SpanArray.from_segments(self.text, (self.segments(i) for i in range(len(self))[index]),
+                                           self.line_end)
+        separator = '\n' if self.line_end else ''
+        return ''.join(span_text(self.text, start, end) + separator for start, end in self.segments(index))
+
+    def __len__(self):
+        return len(self.bounds) - 1
+
+    def __eq__(self, other):
+        if isinstance(other, Sequence) and not isinstance(other, str):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        return f"SpanArray({list(self)!r})"
+
+    def __reduce__(self):
+        # 同一次序列化中共用原文的片段列表只保存一份原文；原文已登记时只保存键，见externalized_texts
+        return restore_spans, (pickled_text(self.text), self.starts, self.ends, self.bounds, self.line_end)
+
+    def encode_spans(self, ref) -> list:
+        """
+        保存时以原文的引用与范围代替文本
+        :param ref: 原文在已保存结果中的引用[worker, 文档]
+        """
+        return [{SPAN_KEY: [ref, self.segments(i), self.line_end]} for i in range(len(self))]
+
+
+class ChapterList(Sequence):
+    """
+    章节列表，只保存原文与章节索引，访问某一章时才生成(标题, 正文)
+    """
+    __slots__ = ('text', 'index')
+
+    def __init__(self, text: str, index: list):
+        self.text = text
+        self.index = index  # 每章的(标题, 正文起始位置, 正文结束位置)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return ChapterList(self.text, self.index[i])
+        title, start, end = self.index[i]
+        return title, span_text(self.text, start, end)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __eq__(self, other):
+        if isinstance(other, Sequence) and not isinstance(other, str):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        return f"ChapterList({list(self)!r})"
+
+    def __reduce__(self):
+        # 原文只保存一份，章节正文在读取后按需生成；原文已登记时只保存键
+        return restore_chapters, (pickled_text(self.text), self.index)
+
+    def bodies(self) -> SpanArray:
+        # 各章正文，不复制文本
+        return SpanArray.from_segments(self.text, ([[start, end]] for _, start, end in self.index))
+
+    def encode_spans(self, ref) -> list:
+        return [[title, {SPAN_KEY: [ref, [[start, end]], False]}] for title, start, end in self.index]
+
+
+def freeze(value):
+    if isinstance(value, list):
+        return ResultView(value)
+    if isinstance(value, dict):
+        return MappingProxyType(value)
+    return value
+
+
+def result_view(result, start: int = None, end: int = None):
+    """
+    生成上游单个结果的只读切片，字符串直接切片，列表返回视图
+    :param result: 上游结果中的一个元素
+    :param start: 起始位置
+    :param end: 结束位置
+    :return: 切片后的只读数据
+    """
+    if isinstance(result, (list, ResultView)):
+        return ResultView(result)[start:end]
+    if start is None and end is None:
+        return result
+    return result[start:end]
+
+
+def materialize(value):
+    """
+    将视图递归转换为普通列表，用于需要持有结果的处理器
+    """
+    if isinstance(value, ResultView):
+        return [materialize(item) for item in value]
+    if isinstance(value, MappingProxyType):
+        return dict(value)
+    return value
+
+
+class HFTokenizer:
+    """
+    HuggingFace tokenizers的json文件
+    """
+
+    def __init__(self, path):
         from tokenizers import Tokenizer
+        project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        path = os.path.join(project_root, path)
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"tokenizer文件不存在：{path}，"
+                                    f"可用的tokenizer：{', '.join(available_tokenizers())}")
+        self.tokenizer = Tokenizer.from_file(path)
+
+    def encode_len(self, text) -> int:
+        return len(self.tokenizer.encode(text).ids)
+
+    def batch_len(self, texts) -> list:
+        # encode_batch_fast（tokenizers 0.20+）不计算偏移，只需要长度时更快
+        encode_batch = getattr(self.tokenizer, 'encode_batch_fast', self.tokenizer.encode_batch)
+        return [len(encoding.ids) for encoding in encode_batch(texts)]
+
+    def offsets(self, text) -> list:
+        encoding = self.tokenizer.encode(text)
+        return [offset for offset, special in zip(encoding.offsets, encoding.special_tokens_mask) if not special]
+
+
+class TiktokenTokenizer:
+    """
+    tiktoken的编码，如cl100k_base，编码文件按tiktoken的方式下载或从TIKTOKEN_CACHE_DIR读取
+    """
+
+    def __init__(self, encoding):
+        import tiktoken
+        self.encoding = tiktoken.get_encoding(encoding)
+
+    def encode_len(self, text) -> int:
+        return len(self.encoding.encode_ordinary(text))
+
+    def batch_len(self, texts) -> list:
+        return [len(tokens) for tokens in self.encoding.encode_ordinary_batch(texts)]
+
+    def offsets(self, text) -> list:
+        tokens = self.encoding.encode_ordinary(text)
+        _, starts = self.encoding.decode_with_offsets(tokens)
+        # 多字节字符被拆成多个token时，这些token都覆盖该字符
+        ends = [min(max(start + 1, next_start), len(text)) for start, next_start in zip(starts, starts[1:])]
+        if starts:
+            ends.append(len(text))
+        return list(zip(starts, ends))
+
+
+class ApproxTokenizer:
+    """
+    按字符数估计token数，不编码，只用于粗略的预算
+    非ASCII字符（中文、全角标点、emoji等）每个计cjk_tokens_per_char个token，其余字符每ascii_chars_per_token个计1个token
+    权重换算为整数单位累加，encode_len与offsets使用同样的权重，结果完全一致
+    """
+    cacheable = False  # 计算比查缓存更快
+    units_per_token = 1000000
+
+    def __init__(self, cjk_tokens_per_char: float = 1.0, ascii_chars_per_token: float = 4.0):
+        self.cjk_tokens_per_char = cjk_tokens_per_char
+        self.ascii_chars_per_token = ascii_chars_per_token
+        self.wide_units = max(round(cjk_tokens_per_char * self.units_per_token), 1)
+        self.ascii_units = max(round(self.units_per_token / ascii_chars_per_token), 1)
+
+    def encode_len(self, text) -> int:
+        n_ascii = len(text.encode('ascii', errors='ignore'))
+        units = (len(text) - n_ascii) * self.wide_units + n_ascii * self.ascii_units
+        return -(-units // self.units_per_token)
+
+    def batch_len(self, texts) -> list:
+        return [self.encode_len(text) for text in texts]
+
+    def offsets(self, text) -> list:
+        # 第k个token为累计权重[k, k+1)所在的字符，跨越边界的字符同时属于相邻的token，
+        # 因此任意前缀text[:p]的encode_len等于起始位置小于p的token数
+        unit = self.units_per_token
+        starts, ends = [], []
+        total = 0
+        for i, char in enumerate(text):
+            next_total = total + (self.ascii_units if char < '\x80' else self.wide_units)
+            starts.extend([i] * (-(-next_total // unit) - -(-total // unit)))
+            ends.extend([i + 1] * (next_total // unit - total // unit))
+            total = next_total
+        if len(ends) < len(starts):
+            ends.append(len(text))
+        return list(zip(starts, ends))
+
+
+TOKENIZER_BACKENDS = {
+    "hf": HFTokenizer,
+    "tiktoken": TiktokenTokenizer,
+    "approx": ApproxTokenizer,
+}
+
+# 名称: (后端, 参数)，hf的path为相对项目根目录的tokenizers json文件
+TOKENIZERS = {
+    "qwen": ("hf", {"path": "data/source/tokenizer/tokenizer_qwen.json"}),
+    "gpt": ("hf", {"path": "data/source/tokenizer/tokenizer_gpt.json"}),
+    "gpt4o": ("hf", {"path": "data/source/tokenizer/tokenizer_gpt4o.json"}),
+    "claude": ("hf", {"path": "data/source/tokenizer/tokenizer_claude.json"}),
+    "cl100k": ("tiktoken", {"encoding": "cl100k_base"}),
+    "o200k": ("tiktoken", {"encoding": "o200k_base"}),
+    # 系数按claude在data/source/qiongming.txt上拟合，总token数误差约1%
+    "approx": ("approx", {"cjk_tokens_per_char": 1.29, "ascii_chars_per_token": 4.28}),
+    # 可拓展
+}
+DEFAULT_TOKENIZER = "approx"  # 不需要额外文件，没有指定tokenizer时总能加载
+TOKEN_LEN_CACHE_SIZE = 65536  # 每种tokenizer缓存的文本数
+TOKEN_LEN_CACHE_MAX_CHARS = 2048  # 更长的文本很少重复，不缓存
+
+_tokenizers = {}
+_token_lens = {}
+_tokenizers_lock = threading.Lock()
+
+
+def get_tokenizer_spec(encoding) -> tuple:
+    if encoding not in TOKENIZERS:
+        raise ValueError(f"未注册tokenizer：{encoding}")
+    return TOKENIZERS[encoding]
+
+
+def check_tokenizer(encoding) -> None:
+    """
+    运行前检查tokenizer已注册，hf的tokenizer文件存在
+    """
+    backend, args = get_tokenizer_spec(encoding)
+    if backend == 'hf':
+        project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        if not os.path.exists(os.path.join(project_root, args['path'])):
+            raise ValueError(f"tokenizer {encoding}的文件{args['path']}不存在，"
+                             f"可用的tokenizer：{', '.join(available_tokenizers())}")
+
+
+def available_tokenizers() -> list:
+    # hf以外的后端不需要项目中的文件，是否可用在加载时才知道
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    return [name for name, (backend, args) in TOKENIZERS.items()
+            if backend != 'hf' or os.path.exists(os.path.join(project_root, args['path']))]
+
+
+def get_tokenizer(encoding=DEFAULT_TOKENIZER):
+    """
+    进程内共享的tokenizer，每种只加载一次，可以在多个线程中同时使用
+    :param encoding: tokenizer名称，见TOKENIZERS
+    :return: TOKENIZER_BACKENDS中的后端，提供encode_len、batch_len与offsets
+    """
+    tokenizer = _tokenizers.get(encoding)
+    if tokenizer is None:
+        with _tokenizers_lock:
+            tokenizer = _tokenizers.get(encoding)
+            if tokenizer is None:
+                backend, args = get_tokenizer_spec(encoding)
+                tokenizer = TOKENIZER_BACKENDS[backend](**args)
+                _tokenizers[encoding] = tokenizer
+    return tokenizer
+
+
+class TokenLen:
+    """
+    计算文本的token数，较短的文本（如重复的行）结果保存在有上限的LRU缓存中，可以在多个线程中同时使用
+    """
+
+    def __init__(self, encoding=DEFAULT_TOKENIZER, cache_size: int = None):
         self.encoding = encoding
-        self.project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-        tokenizer_path_dict = {
-            "qwen": "data/source/tokenizer/tokenizer_qwen.json",
-            "gpt": "data/source/tokenizer/tokenizer_gpt.json",
-            "gpt4o": "data/source/tokenizer/tokenizer_gpt4o.json",
-            "claude": "data/source/tokenizer/tokenizer_claude.json",
-            # 可拓展
-        }
-        tokenizer_path = os.path.join(self.project_root, tokenizer_path_dict.get(self.encoding))
-        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer = get_tokenizer(encoding)
+        if cache_size is None:
+            cache_size = TOKEN_LEN_CACHE_SIZE if getattr(self.tokenizer, 'cacheable', True) else 0
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+
+    def encode_len(self, text):
+        return self.tokenizer.encode_len(text)
+
+    def lookup(self, texts) -> list:
+        # 未缓存的文本返回None
+        with self.lock:
+            lengths = [self.cache.get(text) for text in texts]
+            for text, length in zip(texts, lengths):
+                if length is not None:
+                    self.cache.move_to_end(text)
+            return lengths
+
+    def store(self, texts, lengths) -> None:
+        with self.lock:
+            for text, length in zip(texts, lengths):
+                if len(text) <= TOKEN_LEN_CACHE_MAX_CHARS:
+                    self.cache[text] = length
+                    self.cache.move_to_end(text)
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
 
     def __call__(self, text):
-        t = self.tokenizer.encode(text)
-        return len(t.ids)
+        if not self.cache_size:
+            return self.tokenizer.encode_len(text)
+        length = self.lookup([text])[0]
+        if length is None:
+            length = self.encode_len(text)
+            self.store([text], [length])
+        return length
+
+    def offsets(self, text) -> list:
+        """
+        编码一次文本，返回每个token在文本中的字符区间(起始, 结束)，不含特殊token
+        """
+        return self.tokenizer.offsets(text)
+
+    def batch(self, texts) -> list:
+        """
+        批量计算token数，未缓存的文本在一次encode_batch中编码
+        :param texts: 文本列表
+        :return: token数列表，顺序与输入一致
+        """
+        if not self.cache_size:
+            return self.tokenizer.batch_len(texts)
+        lengths = self.lookup(texts)
+        missing = [i for i, length in enumerate(lengths) if length is None]
+        if missing:
+            for i, length in zip(missing, self.tokenizer.batch_len([texts[i] for i in missing])):
+                lengths[i] = length
+            self.store([texts[i] for i in missing], [lengths[i] for i in missing])
+        return lengths
+
+
+def get_token_len(encoding=DEFAULT_TOKENIZER) -> TokenLen:
+    # 每种tokenizer只加载一次，多个worker与线程共用同一个TokenLen及其缓存
+    token_len = _token_lens.get(encoding)
+    if token_len is None:
+        get_tokenizer(encoding)  # 先在锁外加载，TokenLen中再次获取时不会重入锁
+        with _tokenizers_lock:
+            token_len = _token_lens.get(encoding)
+            if token_len is None:
+                token_len = TokenLen(encoding=encoding)
+                _token_lens[encoding] = token_len
+    return token_len
+
+
+def benchmark_tokenizers(encodings=None, path: str = "data/source/qiongming.txt", rounds: int = 3) -> list:
+    """
+    在语料的各行上比较tokenizer批量计数的吞吐量，不使用缓存，取多轮中最快的一次
+    :param encodings: tokenizer名称列表，默认为全部可用的tokenizer，加载失败的跳过
+    :param path: 语料文件，相对项目根目录
+    :return: 每种tokenizer的统计，error为总token数相对第一种的偏差
+    """
+    import logging
+    import time
+
+    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with open(os.path.join(project_root, path), 'r', encoding='utf-8') as f:
+        lines = [line for line in f.read().split('\n') if line.strip()]
+    n_chars = sum(len(line) for line in lines)
+
+    stats = []
+    for encoding in encodings or available_tokenizers():
+        try:
+            token_len = TokenLen(encoding, cache_size=0)
+        except Exception as e:
+            logging.error(f"加载tokenizer {encoding}错误：" + str(e))
+            continue
+        seconds = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            tokens = sum(token_len.batch(lines))
+            elapsed = time.perf_counter() - start
+            seconds = elapsed if seconds is None else min(seconds, elapsed)
+        stats.append({
+            "tokenizer": encoding,
+            "tokens": tokens,
+            "seconds": seconds,
+            "lines_per_s": len(lines) / seconds,
+            "mchars_per_s": n_chars / seconds / 1e6,
+            "error": None if not stats else tokens / stats[0]["tokens"] - 1,
+        })
+    return stats
+
+
+def warm_tokenizers(*encodings) -> None:
+    """
+    预先加载tokenizer，用作分片进程池的initializer，子进程处理第一个文档时不再加载
+    """
+    for encoding in encodings:
+        get_token_len(encoding)
 
 
 def draw_len(lengths, title='Distribution of Element Lengths', xlabel='Length of Elements', ylabel='Frequency'):
@@ -41,3 +625,13 @@ def draw_len(lengths, title='Distribution of Element Lengths', xlabel='Length of
 
     # 显示图表
     plt.show()
+
+
+if __name__ == '__main__':
+    # python -m src.tools [tokenizer...]
+    import sys
+
+    for stat in benchmark_tokenizers(sys.argv[1:]):
+        error = "-" if stat["error"] is None else f"{stat['error'] * 100:+.1f}%"
+        print(f"{stat['tokenizer']:<10} {stat['tokens']:>10} tokens  {stat['seconds'] * 1000:8.1f} ms  "
+              f"{stat['lines_per_s']:>12,.0f} lines/s  {stat['mchars_per_s']:6.2f} M chars/s  {error}")
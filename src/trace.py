@@ -0,0 +1,252 @@
+# Trace.py
+# 记录每个worker的运行情况：耗时、CPU时间、内存峰值增量、输入输出条目数、token数与LLM请求延迟。
+# CPU时间只统计运行worker的线程，内存峰值按整个进程统计，二者都是近似值，见SUMMARY_NOTES。
+# 结果导出为Chrome trace（可用chrome://tracing或Perfetto打开）与汇总表，保存在项目保存目录中。
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+try:
+    import resource
+except ImportError:  # Windows没有resource模块，不记录内存
+    resource = None
+
+TRACE_FILE = "trace.json"
+SUMMARY_FILE = "trace_summary.txt"
+
+# 汇总表中近似统计的说明
+SUMMARY_NOTES = [
+    "thread_cpu_s：运行worker的线程的CPU时间，不含LLM请求线程与分片子进程，近似值",
+    "process_rss_peak_delta_mb：运行期间整个进程内存峰值的增量，并行运行的其他worker也计入其中，近似值",
+]
+
+
+def trace_enabled() -> bool:
+    return os.getenv('TRACE', default='false') == 'true'
+
+
+def max_rss_kb() -> int | None:
+    # 整个进程的内存峰值，macOS上ru_maxrss的单位是字节
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss // 1024 if sys.platform == 'darwin' else max_rss
+
+
+def count_items(results) -> int:
+    # 文本文档计为1条
+    if results is None:
+        return 0
+    return sum(1 if isinstance(doc, str) else len(doc) for doc in results)
+
+
+def percentile(values: list, q: float) -> float | None:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+class WorkerTrace:
+    """
+    单个worker的统计，可以在多个线程中同时记录
+    """
+
+    def __init__(self, name, tracer):
+        self.name = name
+        self.tracer = tracer
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.rss_delta_kb = None
+        self.items_in = 0
+        self.items_out = 0
+        self.tokens = 0
+        self.llm_latencies = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, lane=None):
+        """
+        记录一段耗时，显示在Chrome trace中该worker的时间线上
+        :param name: 阶段名称，如process、load_cache
+        :param lane: 时间线名称，默认为worker名称
+        """
+        start = time.perf_counter_ns()
+        try:
+            yield
+        finally:
+            self.tracer.add_event(lane or self.name, name, start, time.perf_counter_ns())
+
+    @contextmanager
+    def run(self):
+        # 记录worker整体的墙钟时间、本线程CPU时间与进程内存峰值的增量（并行运行时包含其他worker）
+        wall, cpu, rss = time.perf_counter(), time.thread_time(), max_rss_kb()
+        try:
+            with self.span('run'):
+                yield self
+        finally:
+            with self.lock:
+                self.wall += time.perf_counter() - wall
+                self.cpu += time.thread_time() - cpu
+                if rss is not None:
+                    self.rss_delta_kb = (self.rss_delta_kb or 0) + max_rss_kb() - rss
+
+    def add_items(self, items_in: int = 0, items_out: int = 0) -> None:
+        with self.lock:
+            self.items_in += items_in
+            self.items_out += items_out
+
+    def add_tokens(self, tokens: int) -> None:
+        with self.lock:
+            self.tokens += tokens
+
+    @contextmanager
+    def llm_request(self):
+        # LLM请求并发执行，每个线程单独一条时间线
+        start = time.perf_counter()
+        try:
+            with self.span('llm_request', lane=f"{self.name}/{threading.current_thread().name}"):
+                yield
+        finally:
+            with self.lock:
+                self.llm_latencies.append(time.perf_counter() - start)
+
+    def summary(self) -> dict:
+        with self.lock:
+            latencies = list(self.llm_latencies)
+            return {
+                "worker": self.name,
+                "wall_s": round(self.wall, 3),
+                "thread_cpu_s": round(self.cpu, 3),
+                "process_rss_peak_delta_mb": None if self.rss_delta_kb is None else round(self.rss_delta_kb / 1024, 1),
+                "items_in": self.items_in,
+                "items_out": self.items_out,
+                "tokens": self.tokens,
+                "llm_requests": len(latencies),
+                "llm_p50_ms": None if not latencies else round(percentile(latencies, 0.5) * 1000, 1),
+                "llm_p95_ms": None if not latencies else round(percentile(latencies, 0.95) * 1000, 1),
+                "llm_max_ms": None if not latencies else round(max(latencies) * 1000, 1),
+            }
+
+
+class NullTrace:
+    """
+    未开启TRACE时使用，所有记录都不做任何事
+    """
+
+    def span(self, name, lane=None):
+        return nullcontext()
+
+    def run(self):
+        return nullcontext(self)
+
+    def add_items(self, items_in: int = 0, items_out: int = 0) -> None:
+        pass
+
+    def add_tokens(self, tokens: int) -> None:
+        pass
+
+    def llm_request(self):
+        return nullcontext()
+
+
+NULL_TRACE = NullTrace()
+
+
+class TokenCount:
+    """
+    只统计token数，用于分片的子进程中，结果返回后再计入worker的记录
+    """
+
+    def __init__(self):
+        self.tokens = 0
+
+    def add_tokens(self, tokens: int) -> None:
+        self.tokens += tokens
+
+
+class Tracer:
+
+    def __init__(self):
+        self.start_ns = time.perf_counter_ns()
+        self.events = []
+        self.lanes = {}
+        self.workers = {}
+        self.lock = threading.Lock()
+
+    def worker(self, name) -> WorkerTrace:
+        with self.lock:
+            if name not in self.workers:
+                self.workers[name] = WorkerTrace(name, self)
+            return self.workers[name]
+
+    def add_event(self, lane, name, start_ns, end_ns) -> None:
+        with self.lock:
+            if lane not in self.lanes:
+                self.lanes[lane] = len(self.lanes) + 1
+            self.events.append((self.lanes[lane], name, start_ns, end_ns))
+
+    def chrome_trace(self) -> dict:
+        pid = os.getpid()
+        with self.lock:
+            events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": lane}}
+                      for lane, tid in self.lanes.items()]
+            for tid, name, start_ns, end_ns in self.events:
+                events.append({
+                    "name": name,
+                    "ph": "X",
+                    "pid": pid,
+                    "tid": tid,
+                    "ts": (start_ns - self.start_ns) / 1000,
+                    "dur": (end_ns - start_ns) / 1000,
+                })
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def summaries(self) -> list:
+        with self.lock:
+            workers = list(self.workers.values())
+        return [worker.summary() for worker in workers]
+
+    def summary_table(self) -> str:
+        summaries = self.summaries()
+        if not summaries:
+            return ""
+        columns = list(summaries[0].keys())
+        rows = [["-" if row[column] is None else str(row[column]) for column in columns] for row in summaries]
+        widths = [max(len(column), *(len(row[i]) for row in rows)) for i, column in enumerate(columns)]
+        lines = ["  ".join(column.ljust(width) for column, width in zip(columns, widths))]
+        lines += ["  ".join(value.ljust(width) for value, width in zip(row, widths)) for row in rows]
+        return "\n".join(lines + [""] + SUMMARY_NOTES)
+
+    def export(self, save_dir) -> None:
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        trace_path = os.path.join(save_dir, TRACE_FILE)
+        with open(trace_path, 'w', encoding='utf-8') as f:
+            json.dump(self.chrome_trace(), f)
+        summary_table = self.summary_table()
+        with open(os.path.join(save_dir, SUMMARY_FILE), 'w', encoding='utf-8') as f:
+            f.write(summary_table + "\n")
+        logging.info(f"运行记录已保存至{trace_path}\n{summary_table}")
+
+
+_tracer = None
+
+
+def start_trace() -> Tracer | None:
+    """
+    开启TRACE时创建新的记录，之后的get_worker_trace都记录到其中
+    """
+    global _tracer
+    _tracer = Tracer() if trace_enabled() else None
+    return _tracer
+
+
+def get_worker_trace(name) -> WorkerTrace | NullTrace:
+    if _tracer is None or name is None:
+        return NULL_TRACE
+    return _tracer.worker(name)
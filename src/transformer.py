@@ -1,3 +1,21 @@
+from functools import partial
+
+from src.shard import map_documents
+from src.tools import materialize, ChapterList
+
+
+# 单个文档的处理函数，定义在模块级以便分片时传给子进程
+def take_items(data, limit=None):
+    return materialize(data[:limit])
+
+
+def second_items(data, limit=None):
+    if isinstance(data, ChapterList):
+        # 章节正文以原文中的范围传给下游，不复制文本
+        return data[:limit].bodies()
+    return [item[1] for item in data[:limit]]
+
+
 def transformer_id(worker_dict):
     source_list = worker_dict.get('source')
     results = []
@@ -5,12 +23,13 @@ def transformer_id(worker_dict):
     if source_list is None:
         raise ValueError("No source provided for transformer_id")
 
+    take = partial(take_items, limit=worker_dict.get('limit'))
+
     for source in source_list:
         if source not in worker_dict['data']:
             raise ValueError(f"Source {source} not found in data")
         else:
-            for data in worker_dict['data'][source]:
-                results.append(data)
+            results.extend(map_documents(worker_dict, take, worker_dict['data'][source]))
 
     return results
 
@@ -22,12 +41,13 @@ def transformer_chapter_len(worker_dict):
     if source_list is None:
         raise ValueError("No source provided for transformer_chapter_len")
 
+    take = partial(second_items, limit=worker_dict.get('limit'))
+
     for source in source_list:
         if source not in worker_dict['data']:
             raise ValueError(f"Source {source} not found in data")
         else:
-            for data in worker_dict['data'][source]:
-                results.append([item[1] for item in data])
+            results.extend(map_documents(worker_dict, take, worker_dict['data'][source]))
 
     return results
 
@@ -39,16 +59,38 @@ def transformer_llm_001_dataset(worker_dict):
     if source_list is None:
         raise ValueError("No source provided for transformer_llm_001_dataset")
 
+    take = partial(second_items, limit=worker_dict.get('limit'))
+
     for source in source_list:
         if source not in worker_dict['data']:
             raise ValueError(f"Source {source} not found in data")
         else:
-            for data in worker_dict['data'][source]:
-                results.append([item[1] for item in data])
+            results.extend(map_documents(worker_dict, take, worker_dict['data'][source]))
 
     return results
 
 
+def transformer_id_stream(worker_dict):
+    source_list = worker_dict.get('source')
+    if source_list is None:
+        raise ValueError("No source provided for transformer_id")
+
+    for source in source_list:
+        for data in worker_dict['data'][source]:
+            yield data
+
+
+def transformer_second_item_stream(worker_dict):
+    # transformer_spliter_chapter_spliter与transformer_llm_001_dataset都取每项的第二个元素
+    source_list = worker_dict.get('source')
+    if source_list is None:
+        raise ValueError(f"No source provided for {worker_dict.get('type')}")
+
+    for source in source_list:
+        for data in worker_dict['data'][source]:
+            yield (item[1] for item in data)
+
+
 TRANSFORMER_DICT = {
     "transformer_id": transformer_id,
     "transformer_spliter_chapter_spliter": transformer_chapter_len,
@@ -56,5 +98,16 @@ TRANSFORMER_DICT = {
 }
 
 
+TRANSFORMER_STREAM_DICT = {
+    "transformer_id": transformer_id_stream,
+    "transformer_spliter_chapter_spliter": transformer_second_item_stream,
+    "transformer_llm_001_dataset": transformer_second_item_stream
+}
+
+
 def get_transformer(processor):
     return TRANSFORMER_DICT[processor]
+
+
+def get_transformer_stream(processor):
+    return TRANSFORMER_STREAM_DICT[processor]
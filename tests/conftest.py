@@ -0,0 +1,22 @@
+import os
+import sys
+
+import pytest
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from helpers import start_llm_server, write_novels  # noqa: E402
+
+
+@pytest.fixture
+def llm_server():
+    server, base_url = start_llm_server()
+    yield base_url
+    server.shutdown()
+
+
+@pytest.fixture
+def novel_dir(tmp_path):
+    return write_novels(tmp_path / "novels", 2)
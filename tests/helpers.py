@@ -0,0 +1,138 @@
+import json
+import os
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+class EchoHandler(BaseHTTPRequestHandler):
+    """
+    兼容OpenAI chat.completions的测试服务，回复为用户输入的最后30个字符
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        content = "SUM:" + body['messages'][1]['content'][-30:]
+        out = json.dumps({
+            "id": "test", "object": "chat.completion", "created": 0, "model": body['model'],
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_llm_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), EchoHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+
+def novel_text(seed: int, chapters: int = 6, lines: int = 12) -> str:
+    parts = ["序言：这是第%d本测试小说。" % seed]
+    for c in range(1, chapters + 1):
+        parts.append(f"第{c}章 标题{seed}-{c}")
+        for i in range(lines):
+            parts.append(f"　　第{seed}本第{c}章第{i}行，" + "山风吹过石阶，灯火摇晃。" * (1 + (i + c + seed) % 5))
+        parts.append("")
+    return "\n".join(parts)
+
+
+def write_novels(directory, count: int, start: int = 0) -> str:
+    os.makedirs(directory, exist_ok=True)
+    for seed in range(start, start + count):
+        with open(os.path.join(directory, f"novel{seed}.txt"), 'w', encoding='utf-8') as f:
+            f.write(novel_text(seed))
+    return str(directory)
+
+
+def story_config(tmp_path, file_path, base_url, project="test", output_path=None, llm_workers=4, **environ):
+    """
+    reader → 章节 → 正文 → 按长度切分 → llm → sharegpt数据集的完整流程
+    """
+    return {
+        "environ": {"type": "environ_set", "args": {
+            "PROJECT_NAME": project,
+            "SAVE_ROOT": str(tmp_path / "saves"),
+            "LLM_API_BASE": base_url,
+            "LLM_API_KEY": "0",
+            "SHOW_LOG": False,
+            "OVERWRITE": True,
+            "CACHE": False,
+            **environ,
+        }},
+        "reader1": {"type": "reader_txt", "args": {"file_path": file_path}},
+        "spliter1": {"type": "spliter_chapter", "source": "reader1"},
+        "transformer1": {"type": "transformer_spliter_chapter_spliter", "source": "spliter1"},
+        "spliter2": {"type": "spliter_len", "source": "transformer1",
+                     "args": {"max_token_len": 120, "preface": False, "tokenizer": "claude"}},
+        "llm1": {"type": "llm_001", "source": "spliter2",
+                 "args": {"model": "test", "instruction": "概括", "sys_prompt": "s", "source_tag": "文本：",
+                          "output_tag": "梗概：", "workers": llm_workers}},
+        "transformer2": {"type": "transformer_llm_001_dataset", "source": "llm1"},
+        "dataset1": {"type": "dataset_sharegpt", "source": ["spliter2", "transformer2"],
+                     "args": {"conversations": [
+                         {"from": "human", "source": "transformer2", "instruction": "根据梗概写故事",
+                          "source_tag": "梗概：", "output_tag": "故事："},
+                         {"from": "gpt", "source": "spliter2"}],
+                         "system": "You are a story writer."},
+                     "output_path": output_path or str(tmp_path / f"{project}.json")},
+    }
+
+
+def split_config(tmp_path, file_path, project="split", **environ):
+    """
+    reader → 章节 → 正文 → 按长度切分，不需要llm
+    """
+    return {
+        "environ": {"type": "environ_set", "args": {
+            "PROJECT_NAME": project,
+            "SAVE_ROOT": str(tmp_path / "saves"),
+            "SHOW_LOG": False,
+            "OVERWRITE": True,
+            **environ,
+        }},
+        "reader1": {"type": "reader_txt", "args": {"file_path": file_path}},
+        "spliter1": {"type": "spliter_chapter", "source": "reader1"},
+        "transformer1": {"type": "transformer_spliter_chapter_spliter", "source": "spliter1"},
+        "spliter2": {"type": "spliter_len", "source": "transformer1",
+                     "args": {"max_token_len": 120, "preface": False, "tokenizer": "claude"}},
+    }
+
+
+def run_config(tmp_path, config, timeout: float = 120):
+    """
+    写入配置并运行，超时视为死锁
+    :return: LingData实例
+    """
+    from src.processing_core import LingData
+
+    path = tmp_path / f"{config['environ']['args']['PROJECT_NAME']}_args.json"
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False)
+    ling_data = LingData(str(path))
+    thread = threading.Thread(target=ling_data.run_all, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "运行超时"
+    return ling_data
+
+
+def load_json(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def materialize(value):
+    # 结果中的SpanArray、ChapterList、LazyResults等统一转为列表与字符串
+    if isinstance(value, str):
+        return str(value)
+    if isinstance(value, (list, tuple)) or hasattr(value, '__len__') and hasattr(value, '__getitem__'):
+        return [materialize(item) for item in value]
+    return value
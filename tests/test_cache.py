@@ -0,0 +1,101 @@
+import logging
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from helpers import split_config, run_config
+import src.cache as cache
+from src.spliter import spliter_len
+
+
+@pytest.fixture
+def package_copy(tmp_path, monkeypatch):
+    package_dir = tmp_path / "src"
+    shutil.copytree(cache.PACKAGE_DIR, package_dir, ignore=shutil.ignore_patterns('__pycache__'))
+    monkeypatch.setattr(cache, 'PACKAGE_DIR', str(package_dir))
+    monkeypatch.setattr(cache, 'CODE_HASHES', {})
+    return package_dir
+
+
+def test_code_version_covers_package(package_copy, monkeypatch):
+    before = cache.package_version()
+    with open(package_copy / "tools.py", 'a', encoding='utf-8') as f:
+        f.write("\n# changed\n")
+    monkeypatch.setattr(cache, 'CODE_HASHES', {})
+    assert cache.package_version() != before
+
+
+def test_code_version_of_src_processor():
+    assert cache.code_version(spliter_len) == cache.package_version()
+
+
+def test_fingerprint_includes_llm_endpoint(monkeypatch):
+    llm = {'type': 'llm_001', 'args': {'model': 'test'}}
+    spliter = {'type': 'spliter_len', 'args': {'max_token_len': 100}}
+    monkeypatch.setenv('LLM_API_BASE', 'http://a/v1')
+    monkeypatch.setenv('LLM_API_KEY', 'key-a')
+    before = [cache.fingerprint(config, [], spliter_len, '1') for config in (llm, spliter)]
+    monkeypatch.setenv('LLM_API_BASE', 'http://b/v1')
+    assert cache.fingerprint(llm, [], spliter_len, '1') != before[0]
+    assert cache.fingerprint(spliter, [], spliter_len, '1') == before[1]
+    monkeypatch.setenv('LLM_API_BASE', 'http://a/v1')
+    monkeypatch.setenv('LLM_API_KEY', 'key-b')
+    assert cache.fingerprint(llm, [], spliter_len, '1') != before[0]
+
+
+def test_fingerprint_ignores_runtime_keys():
+    config = {'type': 'spliter_len', 'args': {'max_token_len': 100}}
+    base = cache.fingerprint(config, [], spliter_len, '1')
+    assert cache.fingerprint({**config, 'show_log': True, 'timeout': 5}, [], spliter_len, '1') == base
+    assert cache.fingerprint({**config, 'args': {'max_token_len': 100, 'workers': 8}}, [], spliter_len, '1') == base
+    assert cache.fingerprint({**config, 'args': {'max_token_len': 101}}, [], spliter_len, '1') != base
+
+
+def test_cache_dir_uses_save_root_from_args(tmp_path, novel_dir):
+    # 环境变量中的SAVE_ROOT被转为小写，缓存仍写入参数文件中的目录
+    config = split_config(tmp_path, novel_dir, CACHE=True)
+    config['environ']['args']['SAVE_ROOT'] = str(tmp_path / "Saves")
+    run_config(tmp_path, config)
+    assert os.listdir(tmp_path / "Saves" / ".cache")
+    assert not os.path.exists(str(tmp_path / "Saves").lower())
+
+
+def test_cache_hits_and_misses(tmp_path, novel_dir, caplog):
+    caplog.set_level(logging.INFO)
+    config = split_config(tmp_path, novel_dir, CACHE=True)
+    run_config(tmp_path, config)
+    caplog.clear()
+    run_config(tmp_path, config)
+    assert {"reader1命中缓存，跳过运行", "spliter2命中缓存，跳过运行"} <= set(caplog.messages)
+
+    caplog.clear()
+    config['spliter2']['args']['max_token_len'] = 200
+    run_config(tmp_path, config)
+    assert "spliter1命中缓存，跳过运行" in caplog.messages
+    assert "spliter2命中缓存，跳过运行" not in caplog.messages
+
+
+def test_fingerprint_ignores_keep():
+    config = {'type': 'spliter_len', 'args': {'max_token_len': 100}}
+    assert cache.fingerprint({**config, 'keep': True}, [], spliter_len, '1') == \
+           cache.fingerprint(config, [], spliter_len, '1')
+
+
+def test_clear_cache(tmp_path, novel_dir):
+    run_config(tmp_path, split_config(tmp_path, novel_dir, CACHE=True))
+    cache_root = tmp_path / "saves" / ".cache"
+    paths = [os.path.join(root, file) for root, _, files in os.walk(cache_root) for file in files]
+    assert paths
+    old = paths[0]
+    os.utime(old, (0, 0))
+    assert cache.clear_cache(str(cache_root), max_age_days=1)[0] == 1
+    assert not os.path.exists(old) and all(os.path.exists(path) for path in paths[1:])
+
+    completed = subprocess.run([sys.executable, '-m', 'src.cache', 'clear', str(cache_root)],
+                               cwd=os.path.dirname(cache.PACKAGE_DIR), capture_output=True, text=True)
+    assert completed.returncode == 0, completed.stderr
+    assert f"删除{len(paths) - 1}个文件" in completed.stdout
+    assert os.listdir(cache_root) == []
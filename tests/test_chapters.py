@@ -0,0 +1,36 @@
+import pytest
+
+from helpers import novel_text
+from src.spliter import index_chapters, extract_chapters, iter_chapters
+
+
+@pytest.mark.parametrize("text", [
+    novel_text(0),
+    novel_text(1).split("\n", 1)[1],  # 没有序言
+    "只有一段正文\n没有章节标题",
+])
+def test_index_chapters_limit_matches_full_index(text):
+    full = index_chapters(text)
+    for limit in range(len(full) + 2):
+        assert index_chapters(text, limit=limit) == full[:limit]
+        assert list(extract_chapters(text, limit=limit)) == list(extract_chapters(text))[:limit]
+
+
+def stream_chapters(text, pattern):
+    return [(title, body) for title, body in iter_chapters(text.split('\n'), pattern)]
+
+
+@pytest.mark.parametrize("pattern", [r'^第[0-9]+章 标题', r'^第\d+章 \S+$', r'标题[0-9-]+$', None])
+@pytest.mark.parametrize("layout", ["indented", "trailing", "crlf"])
+def test_index_chapters_matches_stripped_lines(pattern, layout):
+    lines = novel_text(3, chapters=4, lines=3).split('\n')
+    if layout == "indented":
+        lines = ["　　" + line for line in lines]
+    elif layout == "trailing":
+        lines = [line + "  " for line in lines]
+    else:
+        lines = [line + "\r" for line in lines]
+    text = '\n'.join(lines)
+    chapters = list(extract_chapters(text, pattern))
+    assert len(chapters) == 5
+    assert chapters == stream_chapters(text, pattern)
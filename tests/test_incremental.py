@@ -0,0 +1,58 @@
+import logging
+import os
+
+from helpers import story_config, split_config, run_config, load_json, materialize, write_novels
+from src.store import find_results_path, load_results
+
+
+def saved(tmp_path, project, worker):
+    return materialize(load_results(find_results_path(str(tmp_path / "saves" / project), worker)))
+
+
+def test_incremental_merges_documents(tmp_path, novel_dir):
+    config = split_config(tmp_path, novel_dir, project="incremental", CACHE=False, INCREMENTAL=True)
+    run_config(tmp_path, config)
+    write_novels(novel_dir, 1, start=2)
+    ling_data = run_config(tmp_path, config)
+    assert ling_data.partial_input
+
+    run_config(tmp_path, split_config(tmp_path, novel_dir, project="full", CACHE=False))
+    for worker in ("reader1", "spliter1", "spliter2"):
+        assert saved(tmp_path, "incremental", worker) == saved(tmp_path, "full", worker)
+    assert not os.path.exists(tmp_path / "saves" / "incremental" / ".incremental" / "previous")
+
+
+def test_incremental_dataset_keeps_history(tmp_path, novel_dir, llm_server, caplog):
+    # 数据集把全部文档合并为一项，上游只处理新增的文件，未改动的文档从按文档的缓存读取
+    caplog.set_level(logging.INFO)
+    config = story_config(tmp_path, novel_dir, llm_server, project="incremental", CACHE=True, INCREMENTAL=True)
+    run_config(tmp_path, config)
+    write_novels(novel_dir, 1, start=2)
+    caplog.clear()
+    ling_data = run_config(tmp_path, config)
+    assert ling_data.partial_input
+    assert "reader1共3个文件，新增或改动1个" in caplog.messages
+    assert not any("读取全部文件" in message for message in caplog.messages)
+    assert "llm1本次处理1个文档，合并后共3个文档" in caplog.messages
+
+    run_config(tmp_path, story_config(tmp_path, novel_dir, llm_server, project="full"))
+    full = load_json(tmp_path / "full.json")
+    assert load_json(tmp_path / "incremental.json") == full
+    assert saved(tmp_path, "incremental", "dataset1") == saved(tmp_path, "full", "dataset1")
+
+
+def test_incremental_dataset_reads_all_when_config_changes(tmp_path, novel_dir, llm_server, caplog):
+    caplog.set_level(logging.INFO)
+    config = story_config(tmp_path, novel_dir, llm_server, project="incremental", CACHE=True, INCREMENTAL=True)
+    run_config(tmp_path, config)
+    write_novels(novel_dir, 1, start=2)
+    config['spliter2']['args']['max_token_len'] += 100
+    caplog.clear()
+    ling_data = run_config(tmp_path, config)
+    assert not ling_data.partial_input
+    assert any("本次读取全部文件" in message for message in caplog.messages)
+
+    full_config = story_config(tmp_path, novel_dir, llm_server, project="full")
+    full_config['spliter2']['args']['max_token_len'] += 100
+    run_config(tmp_path, full_config)
+    assert load_json(tmp_path / "incremental.json") == load_json(tmp_path / "full.json")
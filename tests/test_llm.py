@@ -0,0 +1,20 @@
+from src.llm import use_client, llm_base, close_clients
+
+
+def test_bigger_pool_closes_replaced_client(llm_server):
+    with use_client(llm_server, "key", 2) as small:
+        with use_client(llm_server, "key", 4) as big:
+            assert big is not small
+            # 仍有请求在使用时不关闭
+            assert not small.is_closed()
+        assert not small.is_closed()
+    assert small.is_closed()
+
+    with use_client(llm_server, "key", 3) as client:
+        assert client is big
+    with use_client(llm_server, "key", 8) as bigger:
+        # 没有请求在使用的客户端替换时直接关闭
+        assert big.is_closed() and not bigger.is_closed()
+    assert llm_base("你好", model="test", base_url=llm_server, api_key="key", pool_size=8) == "SUM:你好"
+    close_clients()
+    assert bigger.is_closed()
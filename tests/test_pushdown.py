@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+from helpers import split_config, run_config, materialize
+
+
+def sliced_config(tmp_path, novel_dir, pushdown):
+    config = split_config(tmp_path, novel_dir, project=f"pushdown_{pushdown}", CACHE=False, SAVE_RESULTS=False,
+                          SLICE_PUSHDOWN=pushdown)
+    config['transformer1']['source'] = "spliter1[0:3]"
+    config['chunks'] = {"type": "transformer_id", "source": "spliter2[1:4]", "keep": True}
+    config['titles'] = {"type": "transformer_id", "source": "spliter1[2:4]"}
+    config['head'] = {"type": "transformer_id", "source": "chunks[0:2]"}
+    return config
+
+
+def test_compute_demands(tmp_path, novel_dir):
+    from src.processing_core import LingData
+
+    config = sliced_config(tmp_path, novel_dir, True)
+    config['tail'] = {"type": "transformer_id", "source": "spliter2"}
+    config['tail_head'] = {"type": "transformer_id", "source": "tail[0:6]"}
+    path = tmp_path / "demands_args.json"
+    path.write_text(json.dumps(config), encoding='utf-8')
+    demands = LingData(str(path)).compute_demands()
+    # 多个下游取最大的结束位置；逐项对应的下游没有切片时继续向下查找
+    assert demands['spliter1'] == 4
+    assert demands['spliter2'] == 6
+    assert demands['chunks'] == 2
+    assert demands['tail'] == 6
+    assert demands['transformer1'] is None and demands['reader1'] is None
+
+
+def test_sliced_run_matches_unsliced(tmp_path, novel_dir):
+    pushed = run_config(tmp_path, sliced_config(tmp_path, novel_dir, True))
+    full = run_config(tmp_path, sliced_config(tmp_path, novel_dir, False))
+    assert pushed.workers_dict['spliter2']['limit'] == 4
+    assert full.workers_dict['spliter2'].get('limit') is None
+    for worker in ("titles", "head"):
+        assert materialize(pushed.workers_dict[worker]['results']) == \
+               materialize(full.workers_dict[worker]['results'])
+    assert all(len(document) == 2 for document in pushed.workers_dict['head']['results'])
+    # 中间结果只计算下游需要的前几项，是完整结果的前缀
+    for pushed_document, full_document in zip(pushed.workers_dict['chunks']['results'],
+                                              full.workers_dict['chunks']['results']):
+        assert len(pushed_document) == 2 and len(full_document) == 3
+        assert materialize(pushed_document) == materialize(full_document)[:2]
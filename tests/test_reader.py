@@ -0,0 +1,105 @@
+import json
+import logging
+import zipfile
+
+import pytest
+
+from helpers import split_config, run_config
+from src.reader import (txt_reader, iter_txt_chunks, reader_jsonl, reader_archive, read_archive_text,
+                        get_reader_stream)
+
+
+def test_txt_reader_raises_on_decode_error(tmp_path):
+    path = tmp_path / "novel.txt"
+    path.write_text("第1章 开始\n山风吹过石阶。\n", encoding='utf-8')
+    with pytest.raises(UnicodeDecodeError):
+        txt_reader(str(path), encoding='ascii')
+
+    path.write_bytes(b"\x80\xff" * 10)
+    with pytest.raises(ValueError, match="无法识别"):
+        txt_reader(str(path))
+
+
+def test_unreadable_file_fails_reader(tmp_path, novel_dir, caplog):
+    caplog.set_level(logging.INFO)
+    with open(f"{novel_dir}/broken.txt", 'wb') as f:
+        f.write(b"\x80\xff" * 10)
+    ling_data = run_config(tmp_path, split_config(tmp_path, novel_dir, CACHE=False))
+    assert any(message.startswith("运行reader1错误") for message in caplog.messages)
+    assert "跳过spliter1：上游['reader1']运行失败" in caplog.messages
+    assert 'results' not in ling_data.workers_dict['spliter2']
+
+
+TEXT = "第1章 开始\n山风吹过石阶。\n" * 50 + "第2章 归来\n江水向东流去。\n" * 50
+
+
+def write_compressed(path, data: bytes):
+    import bz2
+    import gzip
+    import lzma
+
+    openers = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
+    if path.suffix == '.zst':
+        zstandard = pytest.importorskip("zstandard")
+        path.write_bytes(zstandard.ZstdCompressor().compress(data))
+    else:
+        with openers[path.suffix](path, 'wb') as f:
+            f.write(data)
+
+
+@pytest.mark.parametrize("suffix", [".gz", ".bz2", ".xz", ".zst"])
+@pytest.mark.parametrize("encoding", ["utf-8", "gb18030"])
+def test_compressed_txt_matches_plain(tmp_path, suffix, encoding):
+    path = tmp_path / f"novel.txt{suffix}"
+    write_compressed(path, TEXT.encode(encoding))
+    content, meta = txt_reader(str(path), stats=True)
+    assert content == TEXT
+    assert meta['encoding'] == encoding
+    assert ''.join(iter_txt_chunks(str(path), chunk_size=100)) == TEXT
+
+
+def test_reader_jsonl_reads_records(tmp_path):
+    records = [{"text": "第一条"}, {"meta": {"text": "嵌套"}}, {"title": "没有正文"}, {"text": {"a": 1}}]
+    path = tmp_path / "records.jsonl.gz"
+    write_compressed(path, "\n".join(json.dumps(r, ensure_ascii=False) for r in records).encode('utf-8') + b"\n\n")
+    worker_dict = {'name': 'reader1', 'show_log': False, 'args': {'file_path': str(path)}}
+    assert reader_jsonl(worker_dict) == ["第一条", '{"a": 1}']
+    worker_dict['args']['field'] = 'meta.text'
+    assert reader_jsonl(worker_dict) == ["嵌套"]
+    assert [list(document) for document in get_reader_stream('reader_jsonl')(worker_dict)] == [["嵌套"]]
+
+
+def write_epub(path):
+    container = ('<?xml version="1.0"?><container xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+                 '<rootfiles><rootfile full-path="OEBPS/content.opf"/></rootfiles></container>')
+    opf = ('<?xml version="1.0"?><package xmlns="http://www.idpf.org/2007/opf"><manifest>'
+           '<item id="a" href="text/z_first.xhtml"/><item id="b" href="text/a_second.xhtml"/>'
+           '<item id="css" href="style.css"/></manifest><spine><itemref idref="a"/><itemref idref="b"/>'
+           '</spine></package>')
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('mimetype', 'application/epub+zip')
+        archive.writestr('META-INF/container.xml', container)
+        archive.writestr('OEBPS/content.opf', opf)
+        archive.writestr('OEBPS/style.css', 'p {}')
+        archive.writestr('OEBPS/text/z_first.xhtml', '<html><head><title>封面</title><style>p {}</style></head>'
+                                                    '<body><h1>第1章</h1><p>山风 吹过</p><p>石阶</p></body></html>')
+        archive.writestr('OEBPS/text/a_second.xhtml', '<html><body><h1>第2章</h1><script>x()</script>'
+                                                     '<div>江水<br/>东流</div></body></html>')
+
+
+def test_reader_archive_follows_epub_spine(tmp_path):
+    path = tmp_path / "book.epub"
+    write_epub(path)
+    worker_dict = {'name': 'reader1', 'show_log': False, 'args': {'file_path': str(path)}}
+    expected = "第1章\n山风 吹过\n石阶\n第2章\n江水\n东流"
+    assert reader_archive(worker_dict) == [expected]
+    assert [''.join(chunks) for chunks in get_reader_stream('reader_archive')(worker_dict)] == [expected]
+
+
+def test_reader_archive_reads_zip_by_name(tmp_path):
+    path = tmp_path / "book.zip"
+    with zipfile.ZipFile(path, 'w') as archive:
+        archive.writestr('b.txt', "第二章".encode('gb18030'))
+        archive.writestr('a.html', "<p>第一章</p>")
+        archive.writestr('cover.jpg', b"\xff\xd8")
+    assert read_archive_text(str(path)) == "第一章\n第二章"
@@ -0,0 +1,57 @@
+import importlib
+import os
+import subprocess
+import sys
+
+import pytest
+
+from src.registry import PROCESSOR_MODULES, PROCESSOR_TYPES
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize("prefix", sorted(PROCESSOR_MODULES))
+def test_processor_types_match_modules(prefix):
+    module_name, getter, stream_getter = PROCESSOR_MODULES[prefix]
+    if PROCESSOR_TYPES[prefix] is None:
+        return
+    module = importlib.import_module(module_name)
+    for processor_type in PROCESSOR_TYPES[prefix]:
+        assert callable(getattr(module, getter)(processor_type))
+    # 模块中注册的类型都在静态列表中
+    registered = [value for value in vars(module).values() if isinstance(value, dict) and
+                  value and all(isinstance(key, str) and key.startswith(prefix + '_') for key in value)]
+    assert registered
+    for types in registered:
+        assert set(types) <= set(PROCESSOR_TYPES[prefix])
+
+
+def test_unknown_type_fails_at_load_without_import():
+    # 在独立的解释器中检查，不受其他测试已导入模块的影响
+    code = ("import sys\n"
+            "from src.registry import LazyProcessor\n"
+            "try:\n"
+            "    LazyProcessor('spliter_novel')\n"
+            "except KeyError:\n"
+            "    pass\n"
+            "else:\n"
+            "    sys.exit('spliter_novel未报错')\n"
+            "LazyProcessor('spliter_len')\n"
+            "assert 'src.spliter' not in sys.modules\n")
+    subprocess.run([sys.executable, '-c', code], cwd=PROJECT_ROOT, check=True)
+
+
+def test_measure_import_time():
+    from src.registry import measure_import_time
+
+    timings = measure_import_time(['transformer', 'custom'])
+    assert set(timings) == {'transformer', 'custom'}
+    assert all(seconds is not None and seconds >= 0 for seconds in timings.values())
+    with pytest.raises(KeyError):
+        measure_import_time(['spliter_len'])
+
+
+def test_registry_main_runs():
+    completed = subprocess.run([sys.executable, '-m', 'src.registry', 'transformer'], cwd=PROJECT_ROOT,
+                               capture_output=True, text=True, check=True)
+    assert completed.stdout.startswith('transformer')
@@ -0,0 +1,47 @@
+import os
+
+import pytest
+
+from helpers import split_config, run_config, materialize
+
+INTERMEDIATE = ("reader1", "spliter1", "transformer1")
+
+
+def run_split(tmp_path, novel_dir, project, **environ):
+    return run_config(tmp_path, split_config(tmp_path, novel_dir, project=project, SAVE_RESULTS=False, **environ))
+
+
+def intermediate_results(ling_data):
+    return {worker: materialize(ling_data.get_results(worker)) for worker in INTERMEDIATE}
+
+
+@pytest.fixture
+def expected(tmp_path, novel_dir):
+    return intermediate_results(run_split(tmp_path, novel_dir, "kept", CACHE=False, RELEASE_RESULTS=False))
+
+
+def test_released_results_need_keep_or_spill(tmp_path, novel_dir):
+    config = split_config(tmp_path, novel_dir, CACHE=False, SAVE_RESULTS=False)
+    config['spliter1']['keep'] = True
+    ling_data = run_config(tmp_path, config)
+    assert ling_data.workers_dict['reader1'].get('released')
+    assert 'results' in ling_data.workers_dict['spliter1'] and 'results' in ling_data.workers_dict['spliter2']
+    with pytest.raises(ValueError, match="已释放"):
+        ling_data.get_results('transformer1')
+
+
+def test_spilled_results_read_back(tmp_path, novel_dir, expected):
+    ling_data = run_split(tmp_path, novel_dir, "spill", CACHE=False, SPILL_RESULTS=True)
+    for worker in INTERMEDIATE:
+        assert 'results' not in ling_data.workers_dict[worker]
+        assert os.path.exists(ling_data.spill_path(worker))
+    # 运行完成后原文已取消登记，片段仍指向重新读取的reader原文
+    assert intermediate_results(ling_data) == expected
+
+
+def test_cached_results_read_back(tmp_path, novel_dir, expected):
+    for _ in range(2):
+        ling_data = run_split(tmp_path, novel_dir, "cached", CACHE=True, SPILL_RESULTS=True)
+        # 已有缓存的结果不再写出
+        assert not any(os.path.exists(ling_data.spill_path(worker)) for worker in INTERMEDIATE)
+        assert intermediate_results(ling_data) == expected
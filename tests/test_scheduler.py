@@ -0,0 +1,93 @@
+import logging
+import threading
+
+import pytest
+
+from helpers import run_config
+import src.custom as custom
+
+
+def dag_config(tmp_path, max_parallel):
+    # a → b、c → d → e，b与c互不依赖
+    return {
+        "environ": {"type": "environ_set", "args": {
+            "PROJECT_NAME": "dag", "SAVE_ROOT": str(tmp_path / "saves"), "SHOW_LOG": False, "CACHE": False,
+            "SAVE_RESULTS": False, "MAX_PARALLEL": max_parallel,
+        }},
+        "a": {"type": "custom_source"},
+        "c": {"type": "custom_step", "source": "a", "keep": True},
+        "b": {"type": "custom_step", "source": "a"},
+        "d": {"type": "custom_join", "source": ["b", "c"]},
+        "e": {"type": "custom_step", "source": "d"},
+    }
+
+
+class Recorder:
+    def __init__(self, barrier=None, fail=()):
+        self.lock = threading.Lock()
+        self.order = []
+        self.active = 0
+        self.max_active = 0
+        self.barrier = barrier
+        self.fail = fail
+
+    def wrap(self, func):
+        def processor(worker_dict):
+            with self.lock:
+                self.order.append(worker_dict['name'])
+                self.active += 1
+                self.max_active = max(self.max_active, self.active)
+            try:
+                if worker_dict['name'] in self.fail:
+                    raise RuntimeError(f"{worker_dict['name']}失败")
+                if self.barrier is not None and worker_dict['name'] in ('b', 'c'):
+                    # b与c同时运行时才能通过
+                    self.barrier.wait()
+                return func(worker_dict)
+            finally:
+                with self.lock:
+                    self.active -= 1
+        return processor
+
+
+def register(monkeypatch, recorder):
+    def step(worker_dict):
+        return [f"{worker_dict['name']}({item})" for source in worker_dict['source']
+                for item in worker_dict['data'][source]]
+
+    monkeypatch.setitem(custom.CUSTOM_PROCESSOR_DICT, "custom_source", recorder.wrap(lambda worker_dict: ["x"]))
+    monkeypatch.setitem(custom.CUSTOM_PROCESSOR_DICT, "custom_step", recorder.wrap(step))
+    monkeypatch.setitem(custom.CUSTOM_PROCESSOR_DICT, "custom_join", recorder.wrap(step))
+
+
+def test_serial_runs_in_file_order(tmp_path, monkeypatch):
+    recorder = Recorder()
+    register(monkeypatch, recorder)
+    ling_data = run_config(tmp_path, dag_config(tmp_path, 1))
+    # 依赖满足的worker按参数文件中的顺序运行
+    assert recorder.order == ["a", "c", "b", "d", "e"]
+    assert recorder.max_active == 1
+    assert ling_data.workers_dict['e']['results'] == ["e(d(b(x)))", "e(d(c(x)))"]
+
+
+def test_parallel_runs_independent_workers(tmp_path, monkeypatch):
+    recorder = Recorder(barrier=threading.Barrier(2, timeout=10))
+    register(monkeypatch, recorder)
+    ling_data = run_config(tmp_path, dag_config(tmp_path, 2))
+    assert recorder.max_active == 2
+    assert recorder.order[0] == "a" and recorder.order[3:] == ["d", "e"]
+    assert ling_data.workers_dict['e']['results'] == ["e(d(b(x)))", "e(d(c(x)))"]
+
+
+@pytest.mark.parametrize("max_parallel", [1, 2])
+def test_failed_worker_skips_downstream(tmp_path, monkeypatch, caplog, max_parallel):
+    caplog.set_level(logging.INFO)
+    recorder = Recorder(fail=("b",))
+    register(monkeypatch, recorder)
+    ling_data = run_config(tmp_path, dag_config(tmp_path, max_parallel))
+    assert sorted(recorder.order) == ["a", "b", "c"]
+    assert "运行b错误：b失败" in caplog.messages
+    assert "跳过d：上游['b']运行失败" in caplog.messages
+    assert "跳过e：上游['d']运行失败" in caplog.messages
+    assert ling_data.workers_dict['c']['results'] == ["c(x)"]
+    assert 'results' not in ling_data.workers_dict['e']
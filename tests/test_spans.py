@@ -0,0 +1,70 @@
+import os
+import pickle
+
+import pytest
+
+from helpers import split_config, run_config, materialize
+from src.tools import SpanArray, ChapterList, externalized_texts, share_texts, unshare_texts
+
+
+def cache_files(tmp_path):
+    cache_root = tmp_path / "saves" / ".cache"
+    return [os.path.join(root, file) for root, _, files in os.walk(cache_root) for file in files if file.endswith('.pkl')]
+
+
+def test_span_pickle_uses_shared_text():
+    text = "第1章 开始\n" + "山风吹过石阶。\n" * 100
+    spans = SpanArray.from_segments(text, [[(0, 6)], [(7, 14), (15, 22)]], line_end=True)
+    chapters = ChapterList(text, [("第1章 开始", 0, len(text))])
+    keys = share_texts([text])
+    try:
+        with externalized_texts():
+            data = pickle.dumps([spans, chapters])
+        assert len(data) < len(text)
+        loaded_spans, loaded_chapters = pickle.loads(data)
+        assert loaded_spans.text is text and loaded_chapters.text is text
+        assert list(loaded_spans) == list(spans) and list(loaded_chapters) == list(chapters)
+    finally:
+        unshare_texts(keys)
+
+
+def test_span_pickle_without_shared_text_fails():
+    text = "山风吹过石阶。" * 100
+    keys = share_texts([text])
+    with externalized_texts():
+        data = pickle.dumps(SpanArray.from_segments(text, [[(0, 7)]]))
+    unshare_texts(keys)
+    with pytest.raises(KeyError):
+        pickle.loads(data)
+
+
+def test_cache_entries_keep_text_keys(tmp_path, novel_dir):
+    config = split_config(tmp_path, novel_dir, CACHE=True)
+    for worker in ("reader1", "spliter2"):
+        config[worker]['keep'] = True
+    first = run_config(tmp_path, config)
+    text_size = sum(len(doc) for doc in first.workers_dict['reader1']['results'])
+    expected = materialize(first.workers_dict['spliter2']['results'])
+
+    # 缓存中的片段只保存原文的键，不再各自保存一份原文
+    sizes = sorted(os.path.getsize(path) for path in cache_files(tmp_path))
+    assert len(sizes) == 4
+    # 只有reader的缓存保存原文
+    assert sum(sizes[:-1]) < text_size < sizes[-1]
+
+    # 命中缓存时片段重新指向reader的原文
+    second = run_config(tmp_path, config)
+    readers = second.workers_dict['reader1']['results']
+    for doc, spans in zip(readers, second.workers_dict['spliter2']['results']):
+        assert spans.text is doc
+    assert materialize(second.workers_dict['spliter2']['results']) == expected
+
+
+def test_shard_matches_serial(tmp_path, novel_dir):
+    run_config(tmp_path, split_config(tmp_path, novel_dir, project="serial", CACHE=False))
+    run_config(tmp_path, split_config(tmp_path, novel_dir, project="shard", CACHE=False, SHARD_WORKERS=2))
+    for worker in ("spliter1", "spliter2"):
+        with open(tmp_path / "saves" / "serial" / f"{worker}.jsonl", 'rb') as f:
+            serial = f.read()
+        with open(tmp_path / "saves" / "shard" / f"{worker}.jsonl", 'rb') as f:
+            assert f.read() == serial
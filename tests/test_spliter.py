@@ -0,0 +1,128 @@
+import random
+from functools import partial
+from itertools import accumulate
+
+import pytest
+
+from helpers import novel_text
+from src.spliter import (greedy_breaks, balanced_breaks, pack_lines, extract_chapters, iter_chapter_lines,
+                         pack_chapter_dist, split_chunk_dist, get_distribution_args)
+
+
+def offsets_of(lengths):
+    return list(accumulate((length + 1 for length in lengths), initial=0))
+
+
+def chunk_lengths(offsets, breaks):
+    # 块的长度不计最后一行的换行符
+    return [offsets[end] - offsets[start] - 1 for start, end in zip([0, *breaks], breaks)]
+
+
+def check_breaks(lengths, max_token_len, breaks):
+    offsets = offsets_of(lengths)
+    assert breaks == sorted(set(breaks)) and breaks[-1] == len(lengths) and breaks[0] > 0
+    for start, end, length in zip([0, *breaks], breaks, chunk_lengths(offsets, breaks)):
+        # 只有单行超长时块才超过最大长度
+        assert length <= max_token_len or end - start == 1
+
+
+@pytest.mark.parametrize("breaks_func", [greedy_breaks, balanced_breaks])
+def test_breaks_boundaries(breaks_func):
+    assert breaks_func([0], 10) == []
+    # 两行加一个换行符正好等于最大长度时放入同一块
+    assert breaks_func(offsets_of([9, 9]), 19) == [2]
+    assert breaks_func(offsets_of([9, 9]), 18) == [1, 2]
+    # 超长的行单独成块
+    assert breaks_func(offsets_of([5, 100, 5]), 20) == [1, 2, 3]
+    assert breaks_func(offsets_of([30]), 10) == [1]
+
+
+def test_greedy_fills_each_chunk():
+    rng = random.Random(0)
+    for _ in range(200):
+        lengths = [rng.randint(0, 60) for _ in range(rng.randint(1, 40))]
+        max_token_len = rng.randint(10, 150)
+        offsets = offsets_of(lengths)
+        breaks = greedy_breaks(offsets, max_token_len)
+        check_breaks(lengths, max_token_len, breaks)
+        # 除最后一块外，再加入下一行就会超过最大长度
+        for start, end in zip([0, *breaks], breaks[:-1]):
+            assert offsets[end + 1] - offsets[start] - 1 > max_token_len
+
+
+def test_balanced_evens_out_chunks():
+    # 贪心装填得到55与33，平衡装填得到两块44
+    offsets = offsets_of([10] * 8)
+    assert greedy_breaks(offsets, 59) == [5, 8]
+    assert balanced_breaks(offsets, 59) == [4, 8]
+
+    rng = random.Random(1)
+    for _ in range(200):
+        lengths = [rng.randint(0, 60) for _ in range(rng.randint(1, 40))]
+        max_token_len = rng.randint(10, 150)
+        offsets = offsets_of(lengths)
+        greedy = greedy_breaks(offsets, max_token_len)
+        balanced = balanced_breaks(offsets, max_token_len)
+        check_breaks(lengths, max_token_len, balanced)
+        target = offsets[-1] / len(greedy)
+        spread = [sum((length + 1 - target) ** 2 for length in chunk_lengths(offsets, breaks))
+                  for breaks in (greedy, balanced)]
+        assert spread[1] <= spread[0] + 1e-9
+
+
+@pytest.mark.parametrize("packing", ["greedy", "balanced"])
+def test_pack_lines_covers_all_lines(packing):
+    lines = [f"第{i}行" + "字" * (i % 7) for i in range(30)]
+    lengths = [len(line) for line in lines]
+    chunks = list(pack_lines(lines, lengths, 20, packing))
+    assert ''.join(chunk for chunk, _ in chunks) == '\n'.join(lines) + '\n'
+    assert all(len(chunk) == token_len and token_len - 1 <= 20 for chunk, token_len in chunks)
+
+    text = '\n'.join(lines)
+    starts = list(accumulate((len(line) + 1 for line in lines[:-1]), initial=0))
+    ranges = [segments for segments, _ in pack_lines(lines, lengths, 20, packing, starts)]
+    assert [text[start:end] + '\n' for (start, end), in ranges] == [chunk for chunk, _ in chunks]
+
+
+def chapter_bodies(text):
+    return [body for _, body in extract_chapters(text)]
+
+
+def split_dist(chapters, seed, distribution='uniform', workers=1):
+    args = {'max_token_range': [100, 300], 'distribution': distribution, 'tokenizer': 'approx', 'seed': seed}
+    return split_chunk_dist(chapters, workers=workers, **get_distribution_args({'args': args}))
+
+
+@pytest.mark.parametrize("distribution", ["uniform", "normal", "lognormal"])
+def test_distribution_split_is_reproducible(distribution):
+    chapters = chapter_bodies(novel_text(0, lines=40))
+    first = split_dist(chapters, 7, distribution)
+    assert split_dist(chapters, 7, distribution) == first
+    assert split_dist(chapters, 8, distribution) != first
+    assert ''.join(first) == ''.join(split_dist(chapters, 8, distribution))
+
+
+def test_chapter_split_independent_of_order():
+    chapters = list(enumerate(iter_chapter_lines(chapter_bodies(novel_text(1, lines=40)))))
+    pack = partial(pack_chapter_dist, dist_arg1=100, dist_arg2=300, distribution='uniform', tokenizer='approx',
+                   seed=7)
+    in_order = [pack(chapter) for chapter in chapters]
+    assert [pack(chapter) for chapter in reversed(chapters)] == in_order[::-1]
+    assert partial(pack, seed=8)(chapters[2]) != in_order[2]
+
+
+def test_chapter_split_unaffected_by_other_chapters():
+    chapters = chapter_bodies(novel_text(2, lines=40))
+    edited = list(chapters)
+    edited[3] = edited[3].replace("灯火", "烛火")
+    pack = partial(pack_chapter_dist, dist_arg1=100, dist_arg2=300, distribution='uniform', tokenizer='approx',
+                   seed=7)
+    before = [pack(chapter) for chapter in enumerate(iter_chapter_lines(chapters))]
+    after = [pack(chapter) for chapter in enumerate(iter_chapter_lines(edited))]
+    assert [chunks for index, chunks in enumerate(after) if index != 3] == \
+           [chunks for index, chunks in enumerate(before) if index != 3]
+
+
+def test_distribution_split_same_across_workers():
+    chapters = chapter_bodies(novel_text(3, chapters=8, lines=40))
+    assert split_dist(chapters, 7, workers=2) == split_dist(chapters, 7)
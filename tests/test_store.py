@@ -0,0 +1,61 @@
+import json
+
+import pytest
+
+from helpers import split_config, run_config, materialize, novel_text
+from src.store import (save_results_jsonl, load_results, build_ref_index, register_base_texts, LazyResults,
+                       find_results_path, REF_KEY)
+from src.tools import TextDocument, SpanArray, ChapterList, SPAN_KEY
+
+
+def read_lines(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+@pytest.mark.parametrize("compress", [None, "gzip"])
+def test_refs_and_spans_round_trip(tmp_path, compress):
+    docs = [TextDocument(novel_text(0), {'path': 'novel0.txt'}), novel_text(1)]
+    text = docs[0]
+    heading = len("序言：这是第0本测试小说。\n")
+    chapters = [ChapterList(text, [("序言", 0, heading), ("第1章", heading, len(text))])]
+    spans = [SpanArray.from_segments(text, [[(0, 10)], [(heading, heading + 20), (heading + 30, heading + 40)]],
+                                     line_end=True)]
+    pairs = [[["问题" * 20, docs[1]], ["短", "回答" * 20]]]
+
+    base_refs = {}
+    register_base_texts(base_refs, "reader1", docs)
+    save_results_jsonl(str(tmp_path / "reader1"), docs)
+    save_results_jsonl(str(tmp_path / "spliter1"), chapters, compress=compress, base_refs=base_refs)
+    save_results_jsonl(str(tmp_path / "spliter2"), spans, compress=compress, base_refs=base_refs)
+    save_results_jsonl(str(tmp_path / "pairs"), pairs, compress=compress, ref_index=build_ref_index({"reader1": docs}))
+
+    for worker, expected in (("spliter1", chapters), ("spliter2", spans), ("pairs", pairs)):
+        path = find_results_path(str(tmp_path), worker)
+        assert path.endswith(".jsonl.gz" if compress else ".jsonl")
+        loaded = load_results(path)
+        assert isinstance(loaded, LazyResults) != bool(compress)
+        assert materialize(loaded) == materialize(expected)
+        assert materialize(loaded[-1][-1]) == materialize(expected[-1][-1])
+
+    # 原文只在reader的结果中保存一次，下游只保存引用与范围
+    if compress is None:
+        records = read_lines(tmp_path / "spliter2.jsonl")[1:]
+        assert records == [{SPAN_KEY: [["reader1", 0], [[0, 10]], True]},
+                           {SPAN_KEY: [["reader1", 0], [[heading, heading + 20], [heading + 30, heading + 40]],
+                                       True]}]
+        assert read_lines(tmp_path / "pairs.jsonl")[1] == ["问题" * 20, {REF_KEY: ["reader1", 1]}]
+        assert text not in (tmp_path / "spliter1.jsonl").read_text(encoding='utf-8')
+
+    reader = load_results(str(tmp_path / "reader1.jsonl"))
+    assert reader[0].meta == {'path': 'novel0.txt'} and not hasattr(reader[1], 'meta')
+
+
+def test_saved_results_match_memory(tmp_path, novel_dir):
+    ling_data = run_config(tmp_path, split_config(tmp_path, novel_dir, CACHE=False, RELEASE_RESULTS=False))
+    save_dir = tmp_path / "saves" / "split"
+    for worker in ("reader1", "spliter1", "transformer1", "spliter2"):
+        loaded = load_results(find_results_path(str(save_dir), worker))
+        assert materialize(loaded) == materialize(ling_data.workers_dict[worker]['results'])
+    text = (save_dir / "reader1.jsonl").read_text(encoding='utf-8')
+    assert sum(path.stat().st_size for path in save_dir.glob("*.jsonl")) < 2 * len(text.encode('utf-8'))
@@ -0,0 +1,39 @@
+import pytest
+
+from helpers import story_config, run_config, load_json
+
+
+@pytest.mark.parametrize("queue_size, llm_workers", [(1, 4), (2, 4), (2, 16)])
+def test_stream_small_queue_does_not_deadlock(tmp_path, novel_dir, llm_server, queue_size, llm_workers):
+    # spliter2同时供给llm1与dataset1，队列长度小于2*workers，dataset按顺序同时读取spliter2与transformer2
+    config = story_config(tmp_path, novel_dir, llm_server, project="stream", llm_workers=llm_workers,
+                          STREAM_MODE=True, STREAM_QUEUE_SIZE=queue_size)
+    run_config(tmp_path, config, timeout=60)
+    run_config(tmp_path, story_config(tmp_path, novel_dir, llm_server, project="batch"))
+    assert load_json(tmp_path / "batch.json")
+    assert load_json(tmp_path / "stream.json") == load_json(tmp_path / "batch.json")
+
+
+def test_stream_edges_stay_bounded(tmp_path, novel_dir, llm_server, monkeypatch):
+    from src import stream
+
+    sizes = []
+    edge_init = stream.StreamEdge.__init__
+
+    def record(self, maxsize, *args, **kwargs):
+        sizes.append(maxsize)
+        edge_init(self, maxsize, *args, **kwargs)
+
+    monkeypatch.setattr(stream.StreamEdge, '__init__', record)
+    run_config(tmp_path, story_config(tmp_path, novel_dir, llm_server, project="stream",
+                                      STREAM_MODE=True, STREAM_QUEUE_SIZE=2), timeout=60)
+    assert sizes and all(size == 2 for size in sizes)
+
+
+def test_stream_matches_batch(tmp_path, novel_dir, llm_server):
+    run_config(tmp_path, story_config(tmp_path, novel_dir, llm_server, project="batch"))
+    run_config(tmp_path, story_config(tmp_path, novel_dir, llm_server, project="stream",
+                                      STREAM_MODE=True, STREAM_QUEUE_SIZE=4))
+    batch = load_json(tmp_path / "batch.json")
+    assert batch
+    assert load_json(tmp_path / "stream.json") == batch
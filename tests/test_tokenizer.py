@@ -0,0 +1,84 @@
+import json
+import os
+import random
+
+import pytest
+
+from helpers import split_config
+from src.spliter import divide_long_line
+from src.tools import ApproxTokenizer, TokenLen
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 1、2、3、4字节的UTF-8字符与分隔符
+ALPHABET = "abcxyz 019" + "éßж" + "山风吹过石阶" + "😀𠀋" + "，。！\n"
+
+
+def random_text(rng, length):
+    return ''.join(rng.choice(ALPHABET) for _ in range(length))
+
+
+@pytest.mark.parametrize("weights", [(1.0, 4.0), (1.29, 4.28), (0.6, 3.0), (2.5, 1.5)])
+def test_approx_offsets_match_prefix_counts(weights):
+    rng = random.Random(0)
+    tokenizer = ApproxTokenizer(*weights)
+    for _ in range(200):
+        text = random_text(rng, rng.randint(0, 80))
+        offsets = tokenizer.offsets(text)
+        assert len(offsets) == tokenizer.encode_len(text)
+        starts = [start for start, _ in offsets]
+        for p in range(len(text) + 1):
+            assert tokenizer.encode_len(text[:p]) == sum(start < p for start in starts)
+
+
+def test_approx_counts_every_non_ascii_char():
+    tokenizer = ApproxTokenizer(1.0, 4.0)
+    assert tokenizer.encode_len("éж") == tokenizer.encode_len("山风") == tokenizer.encode_len("😀𠀋") == 2
+    assert tokenizer.encode_len("abcd") == 1
+
+
+@pytest.mark.parametrize("limit", [1, 2, 3, 7, 20])
+def test_divide_long_line_respects_limit(limit):
+    rng = random.Random(limit)
+    token_len = TokenLen("approx")
+    for _ in range(300):
+        line = random_text(rng, rng.randint(1, 200))
+        pieces, piece_lens = divide_long_line(line, limit, token_len)
+        assert ''.join(pieces) == line
+        for piece, piece_len in zip(pieces, piece_lens):
+            assert token_len.encode_len(piece) <= piece_len <= limit or len(piece) == 1
+
+
+def test_default_tokenizer_always_loads():
+    from src.spliter import get_len_args, get_distribution_args
+
+    for get_args in (get_len_args, get_distribution_args):
+        for worker_dict in ({}, {'args': {}}):
+            tokenizer = get_args(worker_dict)['tokenizer']
+            assert TokenLen(tokenizer).encode_len("山风吹过石阶") > 0
+
+
+def write_args(tmp_path, config):
+    path = tmp_path / "args.json"
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(config, f, ensure_ascii=False)
+    return str(path)
+
+
+def test_missing_tokenizer_file_fails_at_load(tmp_path, novel_dir):
+    from src.processing_core import LingData
+
+    config = split_config(tmp_path, novel_dir)
+    config['spliter2']['args']['tokenizer'] = 'qwen'
+    with pytest.raises(ValueError, match="qwen"):
+        LingData(write_args(tmp_path, config))
+
+
+def test_example_config_loads(tmp_path):
+    from src.processing_core import LingData
+
+    with open(os.path.join(PROJECT_ROOT, "databuilder_args", "example_arg.json"), 'r', encoding='utf-8') as f:
+        config = json.load(f)
+    config['environ']['args']['SAVE_ROOT'] = str(tmp_path / "saves")
+    ling_data = LingData(write_args(tmp_path, config))
+    assert ling_data.build_dependency_graph()
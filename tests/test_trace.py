@@ -0,0 +1,21 @@
+import json
+
+from helpers import split_config, run_config
+from src.trace import SUMMARY_FILE, TRACE_FILE, SUMMARY_NOTES
+
+
+def test_trace_summary_labels_approximate_columns(tmp_path, novel_dir):
+    ling_data = run_config(tmp_path, split_config(tmp_path, novel_dir, CACHE=False, TRACE=True))
+    save_dir = tmp_path / "saves" / "split"
+    summaries = {row['worker']: row for row in ling_data.tracer.summaries()}
+    assert set(summaries) >= {"reader1", "spliter1", "transformer1", "spliter2"}
+    for row in summaries.values():
+        assert "thread_cpu_s" in row and "process_rss_peak_delta_mb" in row
+        assert row['wall_s'] >= 0 and row['thread_cpu_s'] >= 0
+
+    table = (save_dir / SUMMARY_FILE).read_text(encoding='utf-8')
+    assert table.splitlines()[0].split()[:4] == ["worker", "wall_s", "thread_cpu_s", "process_rss_peak_delta_mb"]
+    assert all(note in table for note in SUMMARY_NOTES)
+    with open(save_dir / TRACE_FILE, 'r', encoding='utf-8') as f:
+        events = json.load(f)['traceEvents']
+    assert {"run", "process"} <= {event['name'] for event in events}